@@ -0,0 +1,151 @@
+"""
+Compares thread per device states against AsyncAbstractState on the shared
+DeviceRuntime loop, for simulated devices. The threaded state mirrors
+PulseCountState, with a worker thread waiting for work and a reader thread
+polling its port with a 0.1s timeout. Events are delivered through a
+KeyedExecutor like DeviceManager does. Each mode runs in its own process so
+that RSS is comparable.
+
+python benchmarks/device_runtime.py --devices 200
+"""
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from usbipice.utils import KeyedExecutor
+from usbipice.worker.device.state.core import AbstractState, AsyncAbstractState
+
+class FakeDevice:
+    def __init__(self, serial):
+        self.serial = serial
+        self.logger = logging.getLogger(serial)
+
+class ThreadedState(AbstractState):
+    def __init__(self, device, latencies):
+        super().__init__(device)
+        self.latencies = latencies
+        self.cv = threading.Condition()
+        self.exiting = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def run(self):
+        with self.cv:
+            self.cv.wait_for(lambda : self.exiting)
+
+    def read(self):
+        # stands in for port.read with a 0.1s pyserial timeout
+        while not self.exiting:
+            time.sleep(0.1)
+
+    def handleAdd(self, dev):
+        self.latencies.append(time.perf_counter() - dev["sent"])
+
+    def handleExit(self):
+        with self.cv:
+            self.exiting = True
+            self.cv.notify_all()
+
+class AsyncState(AsyncAbstractState):
+    def __init__(self, device, latencies):
+        super().__init__(device)
+        self.latencies = latencies
+
+    async def onAdd(self, dev):
+        self.latencies.append(time.perf_counter() - dev["sent"])
+
+def rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+    return 0
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_mode(mode, devices, events, idle):
+    state_cls = ThreadedState if mode == "threads" else AsyncState
+    executor = KeyedExecutor(logging.getLogger(), workers=16, name="bench-events")
+    latencies = []
+
+    rss_before = rss_kb()
+    states = [state_cls(FakeDevice(f"serial{i}"), latencies) for i in range(devices)]
+    for state in states:
+        state.start()
+
+    # idle cost, threaded states keep polling with nothing to do
+    time.sleep(0.5)
+    cpu = cpu_seconds()
+    time.sleep(idle)
+    idle_cpu = cpu_seconds() - cpu
+
+    for _ in range(events):
+        for i, state in enumerate(states):
+            executor.submit(i, state.handleAdd, {"sent": time.perf_counter()})
+
+        time.sleep(0.01)
+
+    deadline = time.time() + 10
+    while len(latencies) < devices * events and time.time() < deadline:
+        time.sleep(0.01)
+
+    result = {
+        "threads": threading.active_count(),
+        "rss_kb": rss_kb() - rss_before,
+        "idle_cpu": idle_cpu / idle,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "received": len(latencies)
+    }
+
+    for state in states:
+        state.handleExit()
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Device runtime benchmark")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--events", type=int, default=20, help="events per device")
+    parser.add_argument("--idle", type=float, default=2, help="seconds to measure idle cpu over")
+    parser.add_argument("--mode", choices=["threads", "async"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.devices, args.events, args.idle)))
+        return
+
+    results = {}
+    for mode in ("threads", "async"):
+        out = subprocess.run([sys.executable, __file__, "--mode", mode, "--devices", str(args.devices),
+                              "--events", str(args.events), "--idle", str(args.idle)],
+                             stdout=subprocess.PIPE, check=True).stdout
+        results[mode] = json.loads(out.splitlines()[-1])
+
+    print(f"{args.devices} devices, {args.events} events per device")
+    for mode, result in results.items():
+        print(mode)
+        print(f"    threads: {result['threads']}")
+        print(f"    rss for states (kB): {result['rss_kb']}")
+        print(f"    idle cpu (cores): {result['idle_cpu']:.3f}")
+        print(f"    event latency p50 (ms): {result['p50_ms']:.3f}")
+        print(f"    event latency p99 (ms): {result['p99_ms']:.3f}")
+        print(f"    events received: {result['received']}")
+
+if __name__ == "__main__":
+    main()
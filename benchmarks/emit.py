@@ -0,0 +1,110 @@
+"""
+Measures emits from worker threads through SyncAsyncServer under uvicorn, the
+path used by EventSender.Session.flush in the docker deployment. Compares the
+loop bridge against the previous asyncio.run per emit.
+
+python benchmarks/emit.py --events 2000
+"""
+import argparse
+import asyncio
+import statistics
+import threading
+import socket
+import time
+
+import socketio
+import uvicorn
+
+from usbipice.utils.web import SyncAsyncServer
+
+class AsyncioRunServer(SyncAsyncServer):
+    """Previous behavior, creates a new event loop for every emit."""
+    def emit(self, event, data=None, to=None, room=None, skip_sid=None, namespace=None, callback=None, ignore_queue=False):
+        return asyncio.run(socketio.AsyncServer.emit(self, event, data, to, room, skip_sid, namespace, callback, ignore_queue))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(server_cls, events, timeout):
+    server = server_cls(async_mode="asgi")
+    connected = threading.Event()
+    sids = []
+
+    @server.on("connect")
+    def connect(sid, environ, auth):
+        sids.append(sid)
+        connected.set()
+
+    port = free_port()
+    app = socketio.ASGIApp(server, on_startup=server.bind_loop)
+    config = uvicorn.Config(app, port=port, log_level="error")
+    uv = uvicorn.Server(config)
+    threading.Thread(target=uv.run, daemon=True).start()
+
+    while not uv.started:
+        time.sleep(0.05)
+
+    received = []
+    done = threading.Event()
+    client = socketio.Client()
+
+    @client.on("event")
+    def event(data):
+        received.append(time.perf_counter() - data)
+        if len(received) == events:
+            done.set()
+
+    client.connect(f"http://localhost:{port}", transports=["websocket"])
+    connected.wait(5)
+    sid = sids[0]
+
+    call_latency = []
+
+    def send():
+        for _ in range(events):
+            start = time.perf_counter()
+            server.emit("event", time.perf_counter(), to=sid)
+            server.sleep(0)
+            call_latency.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    sender = threading.Thread(target=send)
+    sender.start()
+    sender.join()
+    done.wait(timeout)
+    elapsed = time.perf_counter() - start
+
+    client.disconnect()
+    uv.should_exit = True
+
+    return {
+        "emits/sec": len(received) / elapsed,
+        "received": f"{len(received)}/{events}",
+        "emit call p50 (ms)": statistics.median(call_latency) * 1000,
+        "emit call p99 (ms)": percentile(call_latency, 0.99) * 1000,
+        "delivery p50 (ms)": statistics.median(received) * 1000 if received else None,
+        "delivery p99 (ms)": percentile(received, 0.99) * 1000 if received else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="SyncAsyncServer emit benchmark")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    for name, cls in [("asyncio.run", AsyncioRunServer), ("loop bridge", SyncAsyncServer)]:
+        results = run(cls, args.events, args.timeout)
+        print(name)
+        for key, value in results.items():
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            print(f"    {key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Records udev event streams to a trace file and replays them into DeviceManager,
+to measure the udev ingestion path (UdevBus.publish, get_serial, get_busid and
+DeviceManager.handleDevEvent) under event storms. Replays use a stand in
+database and devices, so they need neither hardware nor postgres. Traces are
+json lines of {"time", "source", "action", "dev"}.
+
+Record real events on a worker host until interrupted:
+sudo python benchmarks/udev_trace.py record trace.jsonl --duration 60
+
+Generate a synthetic storm of bootloader resets instead:
+python benchmarks/udev_trace.py generate trace.jsonl --devices 200 --cycles 5
+
+Replay as fast as possible, or at --speed times the recorded rate:
+python benchmarks/udev_trace.py replay trace.jsonl --speed 0
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+from usbipice.utils import UdevBus, get_udev_bus
+from usbipice.utils.UdevBus import SOURCES
+from usbipice.worker.device import DeviceManager
+
+# added to replayed dev dicts to measure delivery latency
+SENT = "REPLAY_SENT"
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def record(args):
+    bus = get_udev_bus()
+    lock = threading.Lock()
+    start = time.perf_counter()
+    count = 0
+
+    with open(args.trace, "w") as f:
+        def write(source, action, dev):
+            nonlocal count
+            line = json.dumps({"time": time.perf_counter() - start, "source": source, "action": action, "dev": dev})
+
+            with lock:
+                f.write(line + "\n")
+                count += 1
+
+        for source in SOURCES:
+            bus.subscribe(lambda action, dev, source=source : write(source, action, dev), source=source)
+
+        print(f"recording to {args.trace}, interrupt to stop")
+
+        try:
+            while not args.duration or time.perf_counter() - start < args.duration:
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+
+        bus.stop()
+
+        with lock:
+            print(f"recorded {count} events")
+
+def generate(args):
+    """Each cycle, every device drops its tty and comes back as the bootloader partition, then
+    returns to a tty like after a flash. Kernel usb events and events of unrelated devices are
+    interleaved as on a busy host."""
+    events = []
+
+    def add(source, action, dev):
+        events.append({"time": len(events) / args.rate, "source": source, "action": action, "dev": dev})
+
+    for cycle in range(args.cycles):
+        for phase in ("bootloader", "firmware"):
+            for i in range(args.devices):
+                serial = f"DE{i:014X}"
+                busid = f"1-{i // 7 + 1}.{i % 7 + 1}"
+                usb = f"/devices/pci0000:00/0000:00:14.0/usb1/1-{i // 7 + 1}/{busid}"
+
+                tty = {
+                    "DEVPATH": f"{usb}/{busid}:1.0/tty/ttyACM{i}",
+                    "SUBSYSTEM": "tty",
+                    "DEVNAME": f"/dev/ttyACM{i}",
+                    "ID_VENDOR_ID": "1209",
+                    "ID_MODEL": "pico-ice",
+                    "ID_SERIAL_SHORT": serial,
+                    "ID_USB_INTERFACE_NUM": "00"
+                }
+                block = {
+                    "DEVPATH": f"{usb}/{busid}:1.0/host{i}/target{i}:0:0/{i}:0:0:0/block/sd{i}/sd{i}1",
+                    "SUBSYSTEM": "block",
+                    "DEVTYPE": "partition",
+                    "DEVNAME": f"/dev/sd{i}1",
+                    "ID_VENDOR_ID": "2e8a",
+                    "ID_MODEL": "RP2350",
+                    "ID_SERIAL_SHORT": serial
+                }
+                kernel = {
+                    "DEVPATH": usb,
+                    "SUBSYSTEM": "usb",
+                    "DEVTYPE": "usb_device"
+                }
+                other = {
+                    "DEVPATH": f"/devices/virtual/net/veth{cycle}x{i}",
+                    "SUBSYSTEM": "net",
+                    "INTERFACE": f"veth{cycle}x{i}"
+                }
+
+                gone, back = (tty, block) if phase == "bootloader" else (block, tty)
+
+                add("kernel", "remove", kernel)
+                add("udev", "remove", gone)
+                add("kernel", "add", kernel)
+                add("udev", "add", back)
+                add("udev", "add", other)
+
+    with open(args.trace, "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+    print(f"generated {len(events)} events")
+
+class StubDatabase:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def addDevice(self, serial):
+        if self.delay:
+            time.sleep(self.delay)
+
+        return True
+
+    def updateDeviceStatus(self, serial, status):
+        return True
+
+    def onExit(self):
+        pass
+
+class ReplayDevice:
+    """Records how long events took to reach the device, and optionally simulates handling them."""
+    def __init__(self, latencies, work):
+        self.latencies = latencies
+        self.work = work
+
+    def handleDeviceEvent(self, action, dev):
+        self.latencies.append(time.perf_counter() - dev[SENT])
+
+        if self.work:
+            time.sleep(self.work)
+
+    def handleExit(self):
+        pass
+
+class ReplayManager(DeviceManager):
+    def __init__(self, *args, latencies, work, **kwargs):
+        self.latencies = latencies
+        self.work = work
+        super().__init__(*args, **kwargs)
+
+    def createDevice(self, serial):
+        return ReplayDevice(self.latencies, self.work)
+
+def replay(args):
+    with open(args.trace) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+
+    logger = logging.getLogger("replay")
+    logger.setLevel(logging.WARNING)
+
+    config = SimpleNamespace(device_workers=args.workers, request_workers=8, request_queue=32,
+                             flash_concurrency=8, flash_per_hub=4)
+    bus = UdevBus(logger, listen=False)
+    latencies = []
+    manager = ReplayManager(None, config, logger, bus=bus, database=StubDatabase(args.db_ms / 1000),
+                            latencies=latencies, work=args.work_ms / 1000)
+
+    threads_max = 0
+    sampling = True
+
+    def sample():
+        nonlocal threads_max
+        while sampling:
+            threads_max = max(threads_max, threading.active_count())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    threads_before = threading.active_count()
+
+    dispatch = []
+    start = time.perf_counter()
+
+    for event in events:
+        if args.speed:
+            delay = start + event["time"] / args.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        dev = event["dev"]
+        dev[SENT] = time.perf_counter()
+        bus.publish(event["source"], event["action"], dev)
+        dispatch.append(time.perf_counter() - dev[SENT])
+
+    published = time.perf_counter() - start
+
+    while True:
+        stats = manager.executor.stats()
+        if not stats["running"] and not any(stats["depth"].values()):
+            break
+
+        time.sleep(0.001)
+
+    elapsed = time.perf_counter() - start
+    sampling = False
+    sampler.join()
+    manager.onExit()
+
+    print(f"{len(events)} events, {len(latencies)} delivered to {len(manager._devs)} devices")
+    print(f"    published in (s): {published:.3f}")
+    print(f"    drained in (s): {elapsed:.3f}")
+    print(f"    events/sec: {len(events) / elapsed:.0f}")
+    print(f"    dispatch p50 / p99 / max (us): {percentile(dispatch, 0.5) * 1e6:.1f} / "
+          f"{percentile(dispatch, 0.99) * 1e6:.1f} / {max(dispatch, default=0) * 1e6:.1f}")
+    print(f"    delivery p50 / p99 / max (ms): {percentile(latencies, 0.5) * 1000:.3f} / "
+          f"{percentile(latencies, 0.99) * 1000:.3f} / {max(latencies, default=0) * 1000:.3f}")
+    print(f"    threads before / high water: {threads_before} / {threads_max}")
+
+def main():
+    parser = argparse.ArgumentParser(description="udev trace recording and replay")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = commands.add_parser("record", help="record udev events to a trace")
+    parser_record.add_argument("trace")
+    parser_record.add_argument("--duration", type=float, help="seconds to record for, until interrupted if unset")
+
+    parser_generate = commands.add_parser("generate", help="generate a synthetic trace of bootloader resets")
+    parser_generate.add_argument("trace")
+    parser_generate.add_argument("--devices", type=int, default=200)
+    parser_generate.add_argument("--cycles", type=int, default=5, help="bootloader resets per device")
+    parser_generate.add_argument("--rate", type=float, default=5000, help="events per second in the trace")
+
+    parser_replay = commands.add_parser("replay", help="replay a trace into DeviceManager")
+    parser_replay.add_argument("trace")
+    parser_replay.add_argument("--speed", type=float, default=1, help="multiple of the recorded rate, 0 for no delay")
+    parser_replay.add_argument("--workers", type=int, default=16, help="device event workers")
+    parser_replay.add_argument("--work-ms", type=float, default=0, help="simulated handling time per event")
+    parser_replay.add_argument("--db-ms", type=float, default=0, help="simulated latency of adding a device")
+
+    args = parser.parse_args()
+
+    {"record": record, "generate": generate, "replay": replay}[args.command](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures per call overhead of argument validation for inject_and_return_json and
+EventMethod. Compares the previous typecheck, which inspected the signature on
+every call, against the check compiled once by compile_typecheck.
+
+python benchmarks/validators.py --calls 100000
+"""
+import argparse
+import inspect
+import timeit
+import types
+
+from usbipice.utils.utils import compile_typecheck
+
+def legacy_typecheck(fn, args) -> bool:
+    """Previous behavior, inspects the signature on every call."""
+    params = inspect.signature(fn).parameters.values()
+
+    if len(params) != len(args):
+        return False
+
+    for arg, param in zip(args, params):
+        annotation = param.annotation
+
+        if annotation is inspect._empty:
+            continue
+
+        if inspect.isclass(annotation):
+            if not isinstance(arg, annotation):
+                return False
+
+            continue
+
+        if not isinstance(annotation, types.GenericAlias):
+            return False
+
+        if annotation.__origin__ is dict:
+            continue
+
+        if annotation.__origin__ is not list or not isinstance(arg, list):
+            return False
+
+        type_ = annotation.__args__[0]
+
+        for value in arg:
+            if not isinstance(value, type_):
+                return False
+
+    return True
+
+def reserve(amount: int, name: str, kind: str, args: dict):
+    pass
+
+def extend(name: str, serials: list[str]):
+    pass
+
+def evaluate(self, files: dict[str, bytes | str]):
+    pass
+
+CASES = [
+    ("reserve", reserve, (5, "client", "pulsecount", {})),
+    ("extend 20 serials", extend, ("client", [f"serial{i}" for i in range(20)])),
+    # not supported by the previous typecheck, only the dict itself was checked
+    ("evaluate 10 files", evaluate, (None, {str(i): b"\x00" * 64 for i in range(10)})),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="Argument validator benchmark")
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, fn, fn_args in CASES:
+        check = compile_typecheck(fn)
+
+        before = timeit.timeit(lambda : legacy_typecheck(fn, fn_args), number=args.calls) / args.calls
+        after = timeit.timeit(lambda : check(fn_args), number=args.calls) / args.calls
+
+        print(name)
+        print(f"    typecheck (us/call): {before * 1e6:.3f}")
+        print(f"    compiled (us/call): {after * 1e6:.3f}")
+        print(f"    speedup: {before / after:.1f}x")
+
+if __name__ == "__main__":
+    main()
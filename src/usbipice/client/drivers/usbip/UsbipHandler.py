@@ -3,12 +3,10 @@ import time
 import threading
 from logging import Logger
 
-import pyudev
-
 from usbipice.client.lib.usbip import UsbipBaseClient, BaseUsbipEventHandler, register
 from usbipice.client.lib import EventServer
 
-from usbipice.utils.dev import get_serial
+from usbipice.utils import get_udev_bus
 from usbipice.utils.usbip import usbip_port, usbip_attach
 
 class DeviceStatus:
@@ -23,6 +21,7 @@ class DeviceStatus:
         self.lock = threading.Lock()
 
         self.timed_out = False
+        self.subscription = None
 
     def updateBus(self, bus: str):
         """Updates bus device is accessible on, updates last_event."""
@@ -66,23 +65,11 @@ class UsbipHandler(BaseUsbipEventHandler):
         self.poll = poll
         self.timeout = timeout
 
-        context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context)
-        self.observer = pyudev.MonitorObserver(monitor, lambda x, y : self.__handleDevEvent(x, y), name="timeoutdetector-observer")
-
         self.stop_poll_thread = False
         self.poll_thread = threading.Thread(target=lambda : self.__pollUsbipPort(), name="timeoutdetector-poll")
         self.poll_thread.start()
 
-    def __handleDevEvent(self, event, dev):
-        if event != "add":
-            return
-
-        serial = get_serial(dict(dev))
-
-        if not serial:
-            return
-
+    def __handleDevEvent(self, serial: str):
         with self.lock:
             if serial not in self.devices:
                 return
@@ -122,18 +109,23 @@ class UsbipHandler(BaseUsbipEventHandler):
 
         with self.lock:
             if serial not in self.devices:
-                self.devices[serial] = DeviceStatus(serial, server_ip, busid, timeout=self.timeout)
+                status = DeviceStatus(serial, server_ip, busid, timeout=self.timeout)
+                status.subscription = get_udev_bus().subscribe(lambda action, dev : self.__handleDevEvent(serial),
+                                                               serial=serial, action="add")
+                self.devices[serial] = status
                 return
 
             self.devices[serial].updateBus(busid)
 
     def __removeDevice(self, serial: str):
         with self.lock:
-            if serial not in self.devices:
-                return False
+            status = self.devices.pop(serial, None)
+
+        if not status:
+            return False
 
-            del self.devices[serial]
-            return True
+        status.subscription.unsubscribe()
+        return True
 
     @register("reservation end", "serial")
     def handleReservationEnd(self, serial: str):
@@ -144,6 +136,11 @@ class UsbipHandler(BaseUsbipEventHandler):
         self.__removeDevice(serial)
 
     def exit(self):
-        self.observer.send_stop()
+        with self.lock:
+            devices = list(self.devices.values())
+
+        for status in devices:
+            status.subscription.unsubscribe()
+
         self.stop_poll_thread = True
         self.poll_thread.join()
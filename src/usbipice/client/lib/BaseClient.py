@@ -58,6 +58,14 @@ class BaseClient(BaseAPI):
     def addEventHandler(self, eh: AbstractEventHandler):
         self.server.addEventHandler(eh)
 
+    def requestControl(self, endpoint: str, json: dict) -> dict:
+        """Sends the request over the control socket when it is connected, otherwise
+        falls back to a GET request. Returns False on error."""
+        if self.server.controlConnected():
+            return self.server.callControl(endpoint, json)
+
+        return super().requestControl(endpoint, json)
+
     def reserve(self, amount: int, kind: str, args: str):
         with self.reservation_lock:
             serials = super().reserve(amount, kind, args)
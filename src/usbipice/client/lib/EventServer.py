@@ -1,10 +1,13 @@
 from __future__ import annotations
 from logging import LoggerAdapter
 import threading
-import json
+import itertools
+import time
 
 import socketio
 
+from usbipice.utils.codec import JSON, available_codecs, decode, encode
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from usbipice.client.lib import AbstractEventHandler
@@ -27,6 +30,115 @@ class Event:
         self.event = event
         self.contents = contents
 
+class FrameSequencer:
+    """Handles the acknowledged event frames of a socket in sequence order. The socketio client calls
+    handlers on a thread per message, so frames sent one after another may be handled at the same time or
+    out of order. A frame that arrives ahead of its turn is buffered until the frames before it arrive,
+    and the frames are then handled in order by one thread. If the missing frames do not arrive within
+    gap_timeout seconds, for example because the server dropped them, they are skipped."""
+    def __init__(self, logger: LoggerAdapter, gap_timeout: float=5):
+        self.logger = logger
+        self.gap_timeout = gap_timeout
+
+        self.cond = threading.Condition()
+        # last session and sequence number handled
+        self.session = None
+        self.seq = -1
+        # first sequence number -> events of frames waiting for their turn
+        self.pending: dict[int, list] = {}
+        self.draining = False
+
+    def resume(self) -> dict:
+        """Returns the {session, seq} to resume from on reconnect."""
+        with self.cond:
+            return {"session": self.session, "seq": self.seq}
+
+    def handle(self, session: str, seq: int, msgs: list, callback) -> int:
+        """Calls callback with each event of the frame starting at seq once the frames before it have
+        been handled, skipping events that were already handled. Returns the last sequence number
+        handled, which acknowledges the frame, or None if the session changed in the meantime."""
+        with self.cond:
+            if session != self.session:
+                self.session = session
+                self.seq = -1
+                self.pending.clear()
+
+            if seq + len(msgs) - 1 <= self.seq:
+                # already handled before a reconnect
+                return self.seq
+
+            if len(msgs) > len(self.pending.get(seq, ())):
+                self.pending[seq] = msgs
+
+            deadline = None
+
+            while True:
+                if self.session != session:
+                    return None
+
+                if seq not in self.pending:
+                    # handled by another thread
+                    return self.seq
+
+                if self.draining:
+                    deadline = None
+                    self.cond.wait()
+                    continue
+
+                first = min(self.pending)
+                if first <= self.seq + 1:
+                    break
+
+                if deadline is None:
+                    deadline = time.monotonic() + self.gap_timeout
+
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+
+                self.logger.error(f"events {self.seq + 1} to {first - 1} did not arrive, skipping them")
+                self.seq = first - 1
+                break
+
+            self.draining = True
+
+        try:
+            self.__drain(session, callback)
+        finally:
+            with self.cond:
+                self.draining = False
+                self.cond.notify_all()
+
+        with self.cond:
+            return self.seq if self.session == session else None
+
+    def __drain(self, session: str, callback):
+        while True:
+            with self.cond:
+                if self.session != session:
+                    return
+
+                ready = [first for first in self.pending if first <= self.seq + 1]
+                if not ready:
+                    return
+
+                first = min(ready)
+                msgs = self.pending.pop(first)
+                start = self.seq + 1
+
+            for i, msg in enumerate(msgs):
+                if first + i < start:
+                    continue
+
+                callback(msg)
+
+                with self.cond:
+                    if self.session != session:
+                        return
+
+                    self.seq = first + i
+
 class EventServer:
     """Hosts a server for the workers and heartbeat process to send events to. When an event is received,
     it calls the corresponding method of the EventHandlers starting at the 0 index."""
@@ -37,10 +149,15 @@ class EventServer:
 
         self.worker_lock = threading.Lock()
         self.worker_sockets: dict[str, socketio.Client] = {}
+        # codec negotiated with each server, used for requests
+        self.codec_lock = threading.Lock()
+        self.codecs: dict[str, str] = {}
 
         self.control_lock = threading.Lock()
         self.control_socket = None
 
+        self.request_ids = itertools.count()
+
     def addEventHandler(self, eh: AbstractEventHandler):
         """Adds an event handler. Should not be called after reservations have
         been made."""
@@ -55,9 +172,14 @@ class EventServer:
 
         logger = SocketLogger(self.logger, url)
 
+        # last session and sequence number handled, sent again on reconnect to resume from there
+        sequencer = FrameSequencer(logger)
+
         @sio.event
         def connect():
             logger.info("connected")
+            # negotiated again on every connect, since the server forgets it on disconnect
+            sio.start_background_task(self.__negotiateCodec, sio, url, logger)
         @sio.event
         def connect_error(_):
             logger.error("connection attempt failed")
@@ -67,34 +189,85 @@ class EventServer:
         @sio.event
         def event(data):
             try:
-                msg = json.loads(data)
+                msg = decode(data)
             except Exception:
                 logger.error("received unparsable data")
                 return
 
-            serial = msg.get("serial")
-            contents = msg.get("contents")
+            self.__handleMessage(msg, logger)
 
-            if contents:
-                event = contents.get("event")
-            else:
-                event = None
+        @sio.event
+        def events(data):
+            try:
+                frame = decode(data)
+                msgs = frame.get("events")
+            except Exception:
+                logger.error("received unparsable data")
+                return
+
+            if not isinstance(msgs, list):
+                logger.error("bad event batch")
+                return
+
+            session = frame.get("session")
+            seq = frame.get("seq")
 
-            if not serial or not event or not contents:
-                logger.error("bad event contents")
+            if not session or not isinstance(seq, int):
+                for msg in msgs:
+                    self.__handleMessage(msg, logger)
                 return
 
-            logger.debug(f"received {event} event")
-            event = Event(serial, event, contents)
-            self.handleEvent(event)
+            # acknowledges the frame
+            return sequencer.handle(session, seq, msgs, lambda msg : self.__handleMessage(msg, logger))
+
+        def auth():
+            return {"client_id": self.client_id, "batching": True, "resume": sequencer.resume()}
 
         # TODO
         try:
-            sio.connect(url, auth={"client_id": self.client_id}, wait_timeout=10)
+            sio.connect(url, auth=auth, wait_timeout=10)
             return sio
         except Exception:
             return False
 
+    def __negotiateCodec(self, sio: socketio.Client, url: str, logger: LoggerAdapter):
+        """Agrees on a codec with the server. Servers without codec support don't answer, in which
+        case json is used."""
+        try:
+            codec = sio.call("codec", available_codecs(), timeout=5)
+        except Exception:
+            codec = None
+
+        if codec not in available_codecs():
+            codec = JSON
+
+        logger.debug(f"using {codec} codec")
+
+        with self.codec_lock:
+            self.codecs[url] = codec
+
+    def __handleMessage(self, msg: dict, logger: LoggerAdapter):
+        """Calls the event handlers with an event sent by a worker or control."""
+        if not isinstance(msg, dict):
+            logger.error("bad event contents")
+            return
+
+        serial = msg.get("serial")
+        contents = msg.get("contents")
+
+        if contents:
+            event = contents.get("event")
+        else:
+            event = None
+
+        if not serial or not event or not contents:
+            logger.error("bad event contents")
+            return
+
+        logger.debug(f"received {event} event")
+        event = Event(serial, event, contents)
+        self.handleEvent(event)
+
     def connectWorker(self, url):
         if not self.control_socket:
             raise Exception("Control socket not connected")
@@ -105,12 +278,10 @@ class EventServer:
             self.worker_sockets[url] = self.__createSocket(url)
 
     def sendWorker(self, url, event, data: dict):
-        """Sends data to worker socket."""
-        try:
-            data = json.dumps(data)
-        except Exception:
-            self.logger.error(f"failed to jsonify event {event} for worker {url}")
-            return
+        """Sends data to worker socket. bytes values are sent as binary when the worker supports msgpack,
+        otherwise as cp437 text."""
+        with self.codec_lock:
+            codec = self.codecs.get(url, JSON)
 
         with self.worker_lock:
             sio = self.worker_sockets.get(url)
@@ -118,6 +289,12 @@ class EventServer:
             if not sio:
                 return False
 
+            try:
+                data = encode(data, codec)
+            except Exception:
+                self.logger.error(f"failed to encode event {event} for worker {url}")
+                return False
+
             sio.emit(event, data)
 
             return True
@@ -126,6 +303,44 @@ class EventServer:
         with self.control_lock:
             self.control_socket = self.__createSocket(url)
 
+    def controlConnected(self) -> bool:
+        """Returns whether the control socket is currently connected."""
+        with self.control_lock:
+            sio = self.control_socket
+
+        return bool(sio) and sio.connected
+
+    def callControl(self, event: str, args: dict, timeout: int=20):
+        """Sends an acknowledged request to the control socket and waits for the response.
+        Returns the response data, True if the request succeeded without data, or False on
+        error or timeout."""
+        with self.control_lock:
+            sio = self.control_socket
+
+        if not sio or not sio.connected:
+            return False
+
+        req_id = next(self.request_ids)
+
+        try:
+            res = sio.call(event, {"id": req_id, "args": args}, timeout=timeout)
+        except socketio.exceptions.TimeoutError:
+            self.logger.error(f"control request {event} ({req_id}) timed out")
+            return False
+        except Exception as e:
+            self.logger.error(f"exception during control request {event} ({req_id}): {e}")
+            return False
+
+        if not isinstance(res, dict) or res.get("id") != req_id:
+            self.logger.error(f"bad response to control request {event} ({req_id})")
+            return False
+
+        if res.get("status") != 200:
+            self.logger.error(f"control request {event} ({req_id}) failed with status {res.get('status')}")
+            return False
+
+        return res.get("data", True)
+
     def disconnectWorker(self, url):
         with self.worker_lock:
             sio = self.worker_sockets.get(url)
@@ -137,6 +352,9 @@ class EventServer:
 
             del self.worker_sockets[url]
 
+        with self.codec_lock:
+            self.codecs.pop(url, None)
+
     def exit(self):
         for eh in self.eventhandlers:
             eh.exit()
@@ -22,7 +22,7 @@ class PulseCountBaseClient(BaseClient):
         files = {}
         for iden, path in bitstreams.items():
             with open(path, "rb") as f:
-                files[str(iden)] = f.read().decode("cp437")
+                files[str(iden)] = f.read()
 
         return self.requestBatchWorker(serials, "evaluate", {
             "files": files
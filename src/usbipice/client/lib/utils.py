@@ -16,6 +16,13 @@ class DefaultBaseEventHandler(AbstractEventHandler):
         that is not recoverable.
         """
 
+    @register("request rejected", "serial", "request")
+    def handleRequestRejected(self, serial: str, request: str):
+        """Called when a request was not queued because the worker
+        already has too many requests waiting for the device. The
+        request can be sent again later.
+        """
+
 class LoggerEventHandler(AbstractEventHandler):
     """Logs received events."""
     def __init__(self, event_server, logger: Logger):
@@ -10,8 +10,8 @@ class ControlEventSenderLogger(LoggerAdapter):
         return f"[ControlEventSender] {msg}", kwargs
 
 class ControlEventSender(EventSender):
-    def __init__(self, socketio, dburl, logger):
-        super().__init__(socketio, dburl, ControlEventSenderLogger(logger))
+    def __init__(self, socketio, dburl, logger, bus=None, **kwargs):
+        super().__init__(socketio, dburl, ControlEventSenderLogger(logger), bus=bus, **kwargs)
 
     def sendDeviceReservationEnd(self, serial: str, client_id: str) -> bool:
         """Sends a reservation end event for serial."""
@@ -0,0 +1,142 @@
+from __future__ import annotations
+from logging import Logger, LoggerAdapter
+from logging.handlers import RotatingFileHandler
+from collections import deque
+import logging
+import threading
+import time
+import re
+import os
+
+class LogIngestorLogger(LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[LogIngestor] {msg}", kwargs
+
+class LogIngestor:
+    """Writes logs submitted by workers to per-worker rotating files. Submissions are queued and
+    written in batches by a background thread, so request handlers never wait on disk. When more than
+    max_rows rows are waiting, submissions are rejected and counted as dropped so that the sender
+    can retry later."""
+    def __init__(self, logger: Logger, path: str="control_logs", max_rows: int=50000, batch_rows: int=2000,
+                 max_bytes: int=10 * 1024 * 1024, backup_count: int=5, report_seconds: int=60):
+        self.logger = LogIngestorLogger(logger)
+        self.path = path
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.report_seconds = report_seconds
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.cv = threading.Condition()
+        self.submissions = deque()
+        self.queued_rows = 0
+
+        self.written_rows = 0
+        self.dropped_rows: dict[str, int] = {}
+        self.unreported_drops = 0
+
+        self.handlers: dict[str, RotatingFileHandler] = {}
+
+        self.thread = threading.Thread(target=self.__run, name="log-ingestor", daemon=True)
+        self.thread.start()
+
+    def submit(self, name: str, addr: str, rows: list) -> bool:
+        """Queues rows of (level, msg) from a worker. Returns False if the queue is full."""
+        rows = [row for row in rows if isinstance(row, (list, tuple)) and len(row) == 2]
+
+        with self.cv:
+            if self.queued_rows + len(rows) > self.max_rows:
+                self.dropped_rows[name] = self.dropped_rows.get(name, 0) + len(rows)
+                self.unreported_drops += len(rows)
+                return False
+
+            self.submissions.append((name, addr, time.time(), rows))
+            self.queued_rows += len(rows)
+            self.cv.notify()
+
+        return True
+
+    def stats(self) -> dict:
+        """Returns the amount of rows waiting to be written, written and dropped per worker."""
+        with self.cv:
+            return {
+                "queued": self.queued_rows,
+                "written": self.written_rows,
+                "dropped": dict(self.dropped_rows)
+            }
+
+    def __handler(self, name: str) -> RotatingFileHandler:
+        if name not in self.handlers:
+            filename = re.sub("[^A-Za-z0-9_.-]", "_", name) or "_"
+            self.handlers[name] = RotatingFileHandler(
+                os.path.join(self.path, f"{filename}.log"),
+                maxBytes=self.max_bytes, backupCount=self.backup_count
+            )
+
+        return self.handlers[name]
+
+    def __take(self) -> list:
+        with self.cv:
+            self.cv.wait_for(lambda : self.submissions, timeout=self.report_seconds)
+
+            batch = []
+            rows = 0
+            while self.submissions and rows < self.batch_rows:
+                submission = self.submissions.popleft()
+                batch.append(submission)
+                rows += len(submission[3])
+
+            self.queued_rows -= rows
+            return batch
+
+    def __write(self, batch: list):
+        lines: dict[str, list[str]] = {}
+
+        for name, addr, created, rows in batch:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
+            out = lines.setdefault(name, [])
+
+            for level, msg in rows:
+                out.append(f"{timestamp} {logging.getLevelName(level)} [{name}@{addr}] {msg}\n")
+
+        for name, group in lines.items():
+            data = "".join(group)
+            handler = self.__handler(name)
+
+            try:
+                position = handler.stream.tell()
+                if position and position + len(data) >= self.max_bytes:
+                    handler.doRollover()
+
+                handler.stream.write(data)
+                handler.stream.flush()
+            except Exception:
+                self.logger.error(f"failed to write logs for {name}")
+                continue
+
+            with self.cv:
+                self.written_rows += len(group)
+
+    def __report(self):
+        with self.cv:
+            dropped, self.unreported_drops = self.unreported_drops, 0
+
+        if dropped:
+            self.logger.warning(f"dropped {dropped} log rows, queue full")
+
+    def __run(self):
+        last_report = time.time()
+
+        while True:
+            batch = self.__take()
+            if batch:
+                self.__write(batch)
+
+            if time.time() - last_report >= self.report_seconds:
+                self.__report()
+                last_report = time.time()
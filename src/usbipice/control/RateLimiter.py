@@ -0,0 +1,134 @@
+from __future__ import annotations
+from functools import wraps
+import inspect
+import threading
+import time
+import math
+import os
+
+from flask import Response
+
+class RateLimitConfig:
+    """Token bucket limits for control endpoints, as endpoint -> (requests per second, burst). Limits
+    can be overridden with USBIPICE_RATE_LIMITS, ex. reserve=0.2/5,extend=1/10."""
+    def __init__(self):
+        self.default: tuple[float, int] = (1, 10)
+        self.limits: dict[str, tuple[float, int]] = {
+            "reserve": (0.2, 5),
+            "extend": (1, 10),
+            "extendall": (1, 10),
+            "end": (1, 10),
+            "endall": (1, 10)
+        }
+        self.max_buckets: int = 10000
+
+        if (value := os.environ.get("USBIPICE_RATE_LIMITS")):
+            for item in value.split(","):
+                try:
+                    endpoint, limit = item.split("=")
+                    rate, burst = limit.split("/")
+                    self.limits[endpoint.strip()] = (float(rate), int(burst))
+                except ValueError:
+                    raise Exception(f"Invalid USBIPICE_RATE_LIMITS entry {item}, expected endpoint=rate/burst")
+
+    def get(self, endpoint: str) -> tuple[float, int]:
+        return self.limits.get(endpoint, self.default)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self) -> bool:
+        """Takes a token. Returns whether one was available."""
+        self.refill()
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def wait(self) -> float:
+        """Seconds until a token is available."""
+        if self.rate <= 0:
+            return math.inf
+
+        return max(0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+class RateLimiter:
+    """Admission control for control endpoints. Each (client name, endpoint) pair has its own
+    token bucket. Rejected calls return before any database access."""
+    def __init__(self, config: RateLimitConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.admitted: dict[str, int] = {}
+        self.rejected: dict[str, int] = {}
+
+    def __prune(self):
+        """Removes buckets of clients that have been idle long enough to refill."""
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill()
+            if bucket.full:
+                del self.buckets[key]
+
+    def admit(self, name: str, endpoint: str) -> float:
+        """Returns 0 if the call is admitted, otherwise the amount of seconds until the client
+        may try again."""
+        with self.lock:
+            bucket = self.buckets.get((name, endpoint))
+
+            if not bucket:
+                if len(self.buckets) >= self.config.max_buckets:
+                    self.__prune()
+
+                bucket = TokenBucket(*self.config.get(endpoint))
+                self.buckets[(name, endpoint)] = bucket
+
+            if bucket.take():
+                self.admitted[endpoint] = self.admitted.get(endpoint, 0) + 1
+                return 0
+
+            self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+            return bucket.wait()
+
+    def limit(self, endpoint: str):
+        """Decorator that applies the limits of endpoint to func. func must take the client name
+        as the name argument. Rejected calls return status=429 with a Retry-After header. Should be
+        used under inject_and_return_json or inject_and_return_ack."""
+        def decorator(func):
+            parameters = list(inspect.signature(func).parameters)
+            index = parameters.index("name")
+
+            @wraps(func)
+            def wrapper(*args):
+                if (wait := self.admit(args[index], endpoint)):
+                    retry = "3600" if math.isinf(wait) else str(math.ceil(wait))
+                    return Response(status=429, headers={"Retry-After": retry})
+
+                return func(*args)
+
+            return wrapper
+
+        return decorator
+
+    def stats(self) -> dict:
+        """Returns admitted and rejected calls per endpoint."""
+        with self.lock:
+            return {
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected),
+                "clients": len(self.buckets)
+            }
@@ -2,3 +2,5 @@ from usbipice.control.ControlDatabase import ControlDatabase
 from usbipice.control.ControlEventSender import ControlEventSender
 from usbipice.control.Heartbeat import HeartbeatConfig, Heartbeat
 from usbipice.control.Control import Control
+from usbipice.control.LogIngestor import LogIngestor
+from usbipice.control.RateLimiter import RateLimiter, RateLimitConfig
@@ -3,14 +3,18 @@ import logging
 import sys
 import threading
 
-from flask import Flask, request
+from flask import Flask, Response
 from flask_socketio import SocketIO
-from socketio import ASGIApp
+from socketio import ASGIApp, AsyncServer
 from asgiref.wsgi import WsgiToAsgi
 
-from usbipice.control import Control, Heartbeat, HeartbeatConfig, ControlEventSender
+from usbipice.control import Control, Heartbeat, HeartbeatConfig, ControlEventSender, LogIngestor
+from usbipice.control import RateLimiter, RateLimitConfig
 from usbipice.utils.web import SyncAsyncServer
-from usbipice.utils.web import flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json
+from usbipice.utils.EventBus import get_event_bus
+from usbipice.utils.codec import JSON, choose_codec
+from usbipice.utils.web import flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json, inject_and_return_ack
+from usbipice.utils.web import AsyncRouter, nonblocking, remote_addr, return_json
 
 class ControlLogger(logging.LoggerAdapter):
     def __init__(self, logger, extra=None):
@@ -29,50 +33,82 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
     sock_id_to_client_id = {}
     id_lock = threading.Lock()
 
-    event_sender = ControlEventSender(socketio, DATABASE_URL, logger)
+    bus = get_event_bus(os.environ.get("USBIPICE_EVENT_BUS"), DATABASE_URL, logger)
+    event_sender = ControlEventSender(socketio, DATABASE_URL, logger, bus=bus,
+                                      max_batch_size=int(os.environ.get("USBIPICE_EVENT_BATCH_SIZE", "50")),
+                                      linger=int(os.environ.get("USBIPICE_EVENT_LINGER_MS", "10")) / 1000,
+                                      max_queue_bytes=int(os.environ.get("USBIPICE_EVENT_MEMORY_KB", "1024")) * 1024,
+                                      max_spill_bytes=int(os.environ.get("USBIPICE_EVENT_SPILL_MB", "64")) * 1024 * 1024,
+                                      spill_path=os.environ.get("USBIPICE_EVENT_SPILL_DIR", "event_spill"),
+                                      drop_policy=os.environ.get("USBIPICE_EVENT_DROP_POLICY", "drop_oldest"))
     control = Control(event_sender, DATABASE_URL, logger)
 
     heartbeat_config = HeartbeatConfig()
     heartbeat = Heartbeat(event_sender, DATABASE_URL, heartbeat_config, logger)
     heartbeat.start()
 
-    @app.get("/reserve")
-    @inject_and_return_json
+    log_ingestor = LogIngestor(base_logger, path=os.environ.get("USBIPICE_LOG_DIR", "control_logs"))
+    limiter = RateLimiter(RateLimitConfig())
+
+    def control_route(endpoint: str):
+        """Makes a control operation available both as a json endpoint and as an acknowledged
+        socket event of the same name, so clients can reuse their existing control socket. Calls
+        are rate limited per client name. Under an asgi server, socket calls run in the loop's executor
+        like the json endpoint, since operations wait on the database and workers."""
+        def decorator(func):
+            limited = limiter.limit(endpoint)(func)
+            app.get(f"/{endpoint}")(inject_and_return_json(limited))
+
+            ack = inject_and_return_ack(limited)
+            if isinstance(socketio, AsyncServer):
+                socketio.on(endpoint)(ack.async_handler)
+            else:
+                socketio.on(endpoint)(flask_socketio_adapter_on(ack))
+
+            return func
+
+        return decorator
+
+    @control_route("reserve")
     def make_reservations(amount: int, name: str, kind: str, args: dict):
         return control.reserve(name, amount, kind, args)
 
-    @app.get("/extend")
-    @inject_and_return_json
+    @control_route("extend")
     def extend(name: str, serials: list):
         return control.extend(name, serials)
 
-    @app.get("/extendall")
-    @inject_and_return_json
+    @control_route("extendall")
     def extendall(name: str):
         return control.extendAll(name)
 
-    @app.get("/end")
-    @inject_and_return_json
+    @control_route("end")
     def end(name: str, serials: list):
         return control.end(name, serials)
 
-    @app.get("/endall")
-    @inject_and_return_json
+    @control_route("endall")
     def endall(name: str):
         return control.endAll(name)
 
     @app.get("/log")
     @inject_and_return_json
+    @nonblocking
     def log(name: str, logs: list):
-        for row in logs:
-            if len(row) != 2:
-                continue
-
-            level, msg = row[0], row[1]
-            base_logger.log(level, f"[{name}@{request.remote_addr[0]}] {msg}")
+        if not log_ingestor.submit(name, remote_addr(), logs):
+            # sender keeps its backlog and retries
+            return Response(status=503)
 
         return True
 
+    @app.get("/metrics")
+    @return_json
+    @nonblocking
+    def metrics():
+        return {
+            "admission": limiter.stats(),
+            "logs": log_ingestor.stats(),
+            "events": event_sender.stats()
+        }
+
     @socketio.on("connect")
     @flask_socketio_adapter_connect
     def connection(sid, environ, auth):
@@ -86,7 +122,7 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
         with id_lock:
             sock_id_to_client_id[sid] = client_id
 
-        event_sender.addSocket(sid, client_id)
+        event_sender.addSocket(sid, client_id, batching=bool(auth.get("batching")), resume=auth.get("resume"))
 
     @socketio.on("disconnect")
     @flask_socketio_adapter_on
@@ -102,6 +138,20 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, base_logger: lo
 
         event_sender.removeSocket(client_id)
 
+    @socketio.on("codec")
+    @flask_socketio_adapter_on
+    def codec(sid, codecs):
+        """Picks the codec of batched frames sent to the socket from the codecs the client supports."""
+        with id_lock:
+            client_id = sock_id_to_client_id.get(sid)
+
+        if not client_id:
+            return JSON
+
+        chosen = choose_codec(codecs)
+        event_sender.setCodec(client_id, chosen)
+        return chosen
+
 def run_debug():
     SERVER_PORT = int(os.environ.get("USBIPICE_CONTROL_PORT", "8080"))
 
@@ -124,9 +174,9 @@ def run_uvicorn():
     app = Flask(__name__)
     socketio = SyncAsyncServer(async_mode="asgi")
     create_app(app, socketio, logger)
-    app = WsgiToAsgi(app)
+    app = AsyncRouter(app, WsgiToAsgi(app))
 
-    return ASGIApp(socketio, app)
+    return ASGIApp(socketio, app, on_startup=socketio.bind_loop)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+CREATE TABLE EventBusMessages (
+    Id bigserial PRIMARY KEY,
+    Contents text NOT NULL,
+    Created timestamp NOT NULL
+);
+
+CREATE FUNCTION publishEventBusMessage(channel text, header text, contents text)
+RETURNS void
+LANGUAGE plpgsql
+AS
+$$
+DECLARE message_id bigint;
+BEGIN
+    -- messages are normally consumed right away, this only removes
+    -- messages for clients that disconnected before delivery
+    DELETE FROM EventBusMessages
+    WHERE Created < CURRENT_TIMESTAMP - interval '1 hour';
+
+    INSERT INTO EventBusMessages(Contents, Created)
+    VALUES(contents, CURRENT_TIMESTAMP)
+    RETURNING Id INTO message_id;
+
+    PERFORM pg_notify(channel, jsonb_set(header::jsonb, '{ref}', to_jsonb(message_id))::text);
+END
+$$;
+
+CREATE FUNCTION consumeEventBusMessage(message_id bigint)
+RETURNS TABLE (
+    "Contents" text
+)
+LANGUAGE plpgsql
+AS
+$$
+BEGIN
+    RETURN QUERY
+    DELETE FROM EventBusMessages
+    WHERE Id = message_id
+    RETURNING Contents;
+END
+$$;
@@ -0,0 +1,12 @@
+CREATE FUNCTION getClientReservations(client_name varchar(255))
+RETURNS TABLE (
+    "Device" varchar(255)
+)
+LANGUAGE plpgsql
+AS
+$$
+BEGIN
+    RETURN QUERY SELECT Reservations.Device FROM Reservations
+    WHERE Reservations.ClientName = client_name;
+END
+$$;
@@ -0,0 +1,120 @@
+from __future__ import annotations
+import threading
+
+from usbipice.utils.dev import get_serial
+from usbipice.utils.UdevBus import UdevBus, get_udev_bus
+
+class DeviceIndex:
+    """In memory index of pico2-ice dev files, keyed by serial and usb interface number. The system
+    is enumerated once when the index is created, after which it is kept current from udev add
+    and remove events, so lookups do not crawl sysfs. Dev files are returned as property dicts,
+    in the order they were added."""
+    def __init__(self, bus: UdevBus=None):
+        self.bus = bus if bus else get_udev_bus()
+
+        self.lock = threading.Lock()
+        # serial -> devpath -> dev
+        self.devs: dict[str, dict[str, dict]] = {}
+        # devpath -> serial
+        self.serials: dict[str, str] = {}
+
+        # devpaths removed while enumerating, so that the enumeration does not add them back
+        self.populating = True
+        self.removed: set[str] = set()
+
+        # subscribe first so that no event is missed between the enumeration and the subscription
+        self.subscription = self.bus.subscribe(self.__handleEvent)
+        self.__populate()
+
+    def __populate(self):
+        for device in self.bus.listDevices():
+            dev = dict(device)
+            path = dev.get("DEVPATH")
+            serial = get_serial(dev)
+
+            if not serial:
+                continue
+
+            with self.lock:
+                if path in self.removed or path in self.serials:
+                    continue
+
+                self.__add(serial, path, dev)
+
+        with self.lock:
+            self.populating = False
+            self.removed.clear()
+
+    def __handleEvent(self, action: str, dev: dict):
+        path = dev.get("DEVPATH")
+
+        if not path:
+            return
+
+        with self.lock:
+            if action == "remove":
+                if self.populating:
+                    self.removed.add(path)
+
+                self.__remove(path)
+                return
+
+            if action not in ("add", "change"):
+                return
+
+            serial = get_serial(dev)
+
+            if not serial:
+                return
+
+            self.removed.discard(path)
+            self.__remove(path)
+            self.__add(serial, path, dev)
+
+    def __add(self, serial: str, path: str, dev: dict):
+        self.devs.setdefault(serial, {})[path] = dev
+        self.serials[path] = serial
+
+    def __remove(self, path: str):
+        serial = self.serials.pop(path, None)
+
+        if not serial:
+            return
+
+        devs = self.devs[serial]
+        del devs[path]
+
+        if not devs:
+            del self.devs[serial]
+
+    def get(self, serial: str) -> list[dict]:
+        """Returns the dev files of serial."""
+        with self.lock:
+            return list(self.devs.get(serial, {}).values())
+
+    def getInterface(self, serial: str, interface: str) -> list[dict]:
+        """Returns the dev files of serial on usb interface number interface, ex. '00'."""
+        with self.lock:
+            return [dev for dev in self.devs.get(serial, {}).values() if dev.get("ID_USB_INTERFACE_NUM") == interface]
+
+    def serialsAvailable(self) -> list[str]:
+        """Returns the serials that currently have dev files."""
+        with self.lock:
+            return list(self.devs.keys())
+
+    def stop(self):
+        """Stops updating the index."""
+        self.subscription.unsubscribe()
+
+_device_index = None
+_device_index_lock = threading.Lock()
+
+def get_device_index() -> DeviceIndex:
+    """Returns the DeviceIndex shared by the process."""
+    global _device_index
+
+    with _device_index_lock:
+        if not _device_index:
+            _device_index = DeviceIndex()
+
+        return _device_index
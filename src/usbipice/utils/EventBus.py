@@ -0,0 +1,168 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+import logging
+import threading
+import queue
+import json
+import time
+
+import psycopg
+
+# pg_notify payloads must be shorter than 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
+CHANNEL = "usbipice_events"
+
+class EventBusLogger(logging.LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[EventBus] {msg}", kwargs
+
+class EventBus(ABC):
+    """Routes messages between EventSenders that may live in different processes. Messages
+    are dicts containing at least {type, origin, client_id}, and optionally contents."""
+    def __init__(self):
+        self.handlers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, handler):
+        """Calls handler(message) on every message published on the bus, including messages
+        published by the subscriber itself."""
+        with self.lock:
+            self.handlers.append(handler)
+
+    @abstractmethod
+    def publish(self, message: dict):
+        """Publishes a message to all subscribers."""
+
+    def resolve(self, message: dict) -> str:
+        """Returns the contents of a message. Returns None if the contents are not available."""
+        return message.get("contents")
+
+    def _dispatch(self, message: dict):
+        with self.lock:
+            handlers = list(self.handlers)
+
+        for handler in handlers:
+            handler(message)
+
+class LocalEventBus(EventBus):
+    """Stand-in for running a single process. Messages are only delivered to subscribers in the same
+    process."""
+    def publish(self, message: dict):
+        self._dispatch(message)
+
+class PostgresEventBus(EventBus):
+    """Routes messages between processes using postgres LISTEN/NOTIFY. Contents that do not fit
+    into a notification are stored in the EventBusMessages table and fetched by the receiver.
+    Messages are sent by a publisher thread in the order they were published, so publish does not
+    wait on the database and can be called from an event loop."""
+    def __init__(self, dburl: str, logger: logging.Logger, channel: str=CHANNEL):
+        super().__init__()
+        self.url = dburl
+        self.channel = channel
+        self.logger = EventBusLogger(logger)
+
+        # shared by publishers, reopened if it fails
+        self.conn: psycopg.Connection = None
+        self.conn_lock = threading.Lock()
+        # messages waiting for the publisher thread
+        self.outbox: queue.SimpleQueue[dict] = queue.SimpleQueue()
+
+        self.thread = threading.Thread(target=self.__listen, name="event-bus-listener", daemon=True)
+        self.thread.start()
+
+        self.publisher = threading.Thread(target=self.__publishLoop, name="event-bus-publisher", daemon=True)
+        self.publisher.start()
+
+    def __listen(self):
+        while True:
+            try:
+                with psycopg.connect(self.url, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {self.channel}")
+                    self.logger.info(f"listening on {self.channel}")
+
+                    for notify in conn.notifies():
+                        try:
+                            message = json.loads(notify.payload)
+                        except Exception:
+                            self.logger.error("received unparsable notification")
+                            continue
+
+                        self._dispatch(message)
+
+            except Exception:
+                self.logger.error("lost listener connection, reconnecting")
+                time.sleep(5)
+
+    def __execute(self, query: str, params: tuple) -> list:
+        """Runs query on the shared connection and returns its rows. The connection is reopened and
+        the query retried once if it fails, since it may have been closed by the server."""
+        with self.conn_lock:
+            for attempt in range(2):
+                try:
+                    if not self.conn or self.conn.closed:
+                        self.conn = psycopg.connect(self.url, autocommit=True)
+
+                    with self.conn.cursor() as cur:
+                        cur.execute(query, params)
+                        return cur.fetchall() if cur.description else []
+                except Exception:
+                    if self.conn:
+                        self.conn.close()
+                    self.conn = None
+
+                    if attempt:
+                        raise
+
+    def publish(self, message: dict):
+        self.outbox.put(message)
+
+    def __publishLoop(self):
+        while True:
+            self.__send(self.outbox.get())
+
+    def __send(self, message: dict):
+        try:
+            payload = json.dumps(message)
+        except Exception:
+            self.logger.error(f"failed to serialize {message.get('type')} message")
+            return
+
+        try:
+            if len(payload.encode()) < MAX_NOTIFY_PAYLOAD:
+                self.__execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                return
+
+            header = dict(message)
+            contents = header.pop("contents", None)
+            self.__execute("SELECT publishEventBusMessage(%s::text, %s::text, %s::text)",
+                           (self.channel, json.dumps(header), contents))
+        except Exception:
+            self.logger.error(f"failed to publish {message.get('type')} message")
+
+    def resolve(self, message: dict) -> str:
+        if "ref" not in message:
+            return message.get("contents")
+
+        try:
+            data = self.__execute("SELECT * FROM consumeEventBusMessage(%s::bigint)", (message["ref"],))
+        except Exception:
+            self.logger.error(f"failed to fetch contents of message {message['ref']}")
+            return None
+
+        if not data:
+            return None
+
+        return data[0][0]
+
+def get_event_bus(kind: str, dburl: str, logger: logging.Logger) -> EventBus:
+    """Creates an EventBus from a configuration value. Supported values are local and postgres."""
+    if not kind or kind == "local":
+        return LocalEventBus()
+
+    if kind == "postgres":
+        return PostgresEventBus(dburl, logger)
+
+    raise Exception(f"Unknown event bus {kind}, expected local or postgres")
@@ -1,12 +1,21 @@
 from __future__ import annotations
+import asyncio
 import logging
 import threading
 import json
+import uuid
+import os
+from collections import OrderedDict, deque
+from itertools import islice
 
 import psycopg
 from flask_socketio import SocketIO
 
 from usbipice.utils import Database
+from usbipice.utils.EventBus import EventBus, LocalEventBus
+from usbipice.utils.SpillQueue import SpillQueue, DROP_OLDEST, DROP_POLICIES
+from usbipice.utils.TimerService import get_timer_service
+from usbipice.utils.codec import JSON, MSGPACK, encode
 
 class EventSenderLogger(logging.LoggerAdapter):
     def __init__(self, logger, extra=None):
@@ -24,6 +33,18 @@ class SessionLogger(logging.LoggerAdapter):
         return f"[{self.client_id}] {msg}", kwargs
 
 class Session:
+    """Queues events for a client and sends them once the client's socket is connected. If the client
+    supports batching, queued events are sent as frames of up to max_batch_size events, and sends are
+    delayed by up to linger seconds so that bursts of events are coalesced into a single frame. Queued
+    events are held in a SpillQueue, so a disconnected client has a bounded memory footprint.
+
+    Clients that batch may also acknowledge frames by passing resume={session, seq} when connecting.
+    Frames to these clients carry the session id and the sequence number of their first event, and sent
+    events are kept until the client acknowledges them by returning the last sequence number it handled.
+    On reconnect, events after the sequence number in resume are sent again.
+
+    Batched frames are json strings unless the client negotiated msgpack with setCodec, in which case
+    they are sent as binary msgpack frames."""
     def __init__(self, socketio: SocketIO, event_sender, logger: logging.Logger, client_id: str):
         self.socketio = socketio
         self.event_sender = event_sender
@@ -31,42 +52,177 @@ class Session:
         self.client_id = client_id
 
         self.sock_id = None
-        self.message_queue = []
+        self.batching = False
+        self.codec = JSON
+
+        self.session_id = uuid.uuid4().hex
+        self.acks = False
+        self.next_seq = 0
+        # (seq, message) of events sent to the client but not acknowledged yet
+        self.unacked: deque[tuple[int, str]] = deque()
+        self.max_unacked = 10000
+        # amount of events at the end of unacked that have to be sent again
+        self.retransmit = 0
+        self.message_queue = SpillQueue(
+            event_sender.spill_path, client_id, self.logger,
+            max_memory=event_sender.max_queue_bytes,
+            max_spill=event_sender.max_spill_bytes,
+            policy=event_sender.drop_policy
+        )
+        self.dropping = False
+        # events of emits from the event loop that failed after the flush returned, in order
+        self.failed: list[str] = []
+
+        self.max_batch_size = event_sender.max_batch_size
+        self.linger = event_sender.linger
+        self.linger_timer = None
 
         self.lock = threading.Lock()
         self.timeout = None
 
+        # only one thread sends at a time to keep events in order
+        self.flushing = False
+        self.reflush = False
+
         self.startTimeout()
 
     def startTimeout(self, time: int=60):
         def timeout():
             self.logger.error("client did not connect in time")
-            self.event_sender.endSession(self.client_id)
+            self.event_sender.expireSession(self.client_id)
 
         with self.lock:
-            self.timeout = threading.Timer(time, timeout)
-            self.timeout.daemon = True
-            self.timeout.name = f"socket-session-{self.client_id}-timeout-monitor"
-            self.timeout.start()
+            if self.timeout:
+                self.timeout.cancel()
+
+            self.timeout = get_timer_service().schedule(time, timeout, name=f"socket-session-{self.client_id}-timeout")
 
     def stopTimeout(self):
         with self.lock:
             if self.timeout:
                 self.timeout.cancel()
 
+    @property
+    def connected(self) -> bool:
+        """Whether the session currently has a socket."""
+        with self.lock:
+            return self.sock_id is not None
+
+    def takeMessages(self, resume: dict=None) -> list[str]:
+        """Removes and returns all queued messages, including ones that were sent but not acknowledged.
+        resume is the {session, seq} the client connected elsewhere with. Sent messages the client
+        reports as handled in it are left out, so they are not delivered twice."""
+        with self.lock:
+            if isinstance(resume, dict) and resume.get("session") == self.session_id:
+                self.__acknowledge(resume.get("seq"))
+
+            messages = [message for _, message in self.unacked] + self.failed
+            self.unacked.clear()
+            self.retransmit = 0
+            self.failed = []
+
+            return messages + self.message_queue.takeAll()
+
+    def acknowledge(self, seq: int):
+        """Releases events up to and including seq. Used as the callback of sent frames."""
+        with self.lock:
+            self.__acknowledge(seq)
+
+    def __acknowledge(self, seq: int):
+        if not isinstance(seq, int):
+            return
+
+        while self.unacked and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+
+        self.retransmit = min(self.retransmit, len(self.unacked))
+
+    def __track(self, frame: list[str]) -> int:
+        """Assigns sequence numbers to a frame of new events. Returns the first one."""
+        first = self.next_seq
+
+        for message in frame:
+            self.unacked.append((self.next_seq, message))
+            self.next_seq += 1
+
+        if len(self.unacked) > self.max_unacked:
+            self.logger.warning("client is not acknowledging events, dropping unacknowledged events")
+            while len(self.unacked) > self.max_unacked:
+                self.unacked.popleft()
+                self.message_queue.dropped += 1
+
+            self.retransmit = min(self.retransmit, len(self.unacked))
+
+        return first
+
+    def close(self) -> int:
+        """Stops the session's timers and discards its queue. Returns the amount of events discarded."""
+        with self.lock:
+            if self.timeout:
+                self.timeout.cancel()
+            if self.linger_timer:
+                self.linger_timer.cancel()
+                self.linger_timer = None
+
+            discarded = len(self.unacked) + len(self.failed)
+            self.unacked.clear()
+            self.retransmit = 0
+            self.failed = []
+
+            return discarded + self.message_queue.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = self.message_queue.stats()
+            stats["unacked"] = len(self.unacked)
+            return stats
+
     def send(self, data: str):
         with self.lock:
-            self.message_queue.append(data)
+            dropped = self.message_queue.put(data)
+
+            if dropped and not self.dropping:
+                self.logger.warning(f"event queue full, dropping events ({self.message_queue.policy})")
+            self.dropping = bool(dropped)
+
+            if self.linger and self.batching and len(self.message_queue) < self.max_batch_size:
+                if not self.linger_timer:
+                    self.linger_timer = get_timer_service().schedule(
+                        self.linger, self.flush, name=f"socket-session-{self.client_id}-linger"
+                    )
+                return
+
         self.flush()
 
-    def setSocket(self, sock_id):
+    def setSocket(self, sock_id, batching: bool=False, resume: dict=None):
         with self.lock:
             self.sock_id = sock_id
+            self.batching = batching
+            self.codec = JSON
+            self.acks = batching and isinstance(resume, dict)
+
+            if self.acks:
+                if resume.get("session") == self.session_id:
+                    self.__acknowledge(resume.get("seq"))
+
+                self.retransmit = len(self.unacked)
+
+            elif self.unacked:
+                # client no longer acknowledges, send the events again as new events
+                self.message_queue.requeue([message for _, message in self.unacked])
+                self.unacked.clear()
+                self.retransmit = 0
+
         self.logger.info("socket connected")
 
         self.stopTimeout()
         self.flush()
 
+    def setCodec(self, codec: str):
+        """Sets the codec of batched frames for the current socket."""
+        with self.lock:
+            self.codec = codec
+
     def removeSocket(self):
         with self.lock:
             self.sock_id = None
@@ -76,37 +232,170 @@ class Session:
 
     def flush(self):
         with self.lock:
-            if not self.message_queue:
+            if self.flushing:
+                self.reflush = True
+                return
+
+            self.flushing = True
+
+        while True:
+            self.__flush()
+
+            with self.lock:
+                if not self.reflush:
+                    self.flushing = False
+                    return
+
+                self.reflush = False
+
+    def __flush(self):
+        with self.lock:
+            if self.linger_timer:
+                self.linger_timer.cancel()
+                self.linger_timer = None
+
+            if self.failed:
+                self.message_queue.requeue(self.failed)
+                self.failed = []
+
+            if not len(self.message_queue) and not self.retransmit:
                 return
 
             if not self.sock_id:
-                self.logger.warning("no socket to flush to")
+                self.logger.debug("no socket to flush to")
                 return
 
-            messages, self.message_queue = self.message_queue, []
-            sock_id = self.sock_id
+        sent = 0
+
+        # frames are taken one at a time so spilled events are read back as they are sent
+        while True:
+            with self.lock:
+                if not self.sock_id:
+                    break
+
+                sock_id = self.sock_id
+                batching = self.batching
+                acks = self.acks
+                codec = self.codec
+                size = self.max_batch_size if batching else 1
+
+                if acks and self.retransmit:
+                    start = len(self.unacked) - self.retransmit
+                    entries = list(islice(self.unacked, start, start + size))
+                    self.retransmit -= len(entries)
+
+                    first = entries[0][0]
+                    frame = [message for _, message in entries]
+                else:
+                    first = None
+                    frame = self.message_queue.take(size)
+                    if acks and frame:
+                        first = self.__track(frame)
+
+            if not frame:
+                break
 
-        for message in messages:
             try:
-                self.socketio.emit("event", message, to=sock_id)
+                if batching:
+                    callback = self.acknowledge if acks else None
+                    result = self.socketio.emit("events", self.__frame(frame, first, codec), to=sock_id, callback=callback)
+                else:
+                    result = self.socketio.emit("event", frame[0], to=sock_id)
+
+                # emits made from the event loop only finish after this returns
+                if isinstance(result, asyncio.Future):
+                    result.add_done_callback(lambda task, frame=frame, acks=acks : self.__emitted(task, frame, acks))
+
                 self.socketio.sleep(0)
             except Exception:
                 self.logger.warning("socket disconnected during flush")
-                with self.lock:
-                    self.message_queue.append(message)
-                    return
+                # unacknowledged events are sent again on reconnect
+                if not acks:
+                    with self.lock:
+                        self.message_queue.requeue(frame)
+                return
+
+            sent += len(frame)
+
+        self.logger.debug(f"flushed {sent} events")
+
+    def __emitted(self, task: asyncio.Future, frame: list[str], acks: bool):
+        """Done callback of emits scheduled on the event loop. Puts the frame back if the emit failed."""
+        if not task.cancelled() and task.exception() is None:
+            return
+
+        self.logger.warning("socket disconnected during flush")
+
+        # unacknowledged events are sent again on reconnect
+        if acks:
+            return
+
+        # put back by the next flush, since callbacks of several failed frames would reverse them
+        with self.lock:
+            self.failed.extend(frame)
+
+    def __frame(self, messages: list[str], first: int, codec: str) -> str | bytes:
+        """Builds a batched frame. first is the sequence number of the first message, or None if the
+        client does not acknowledge frames."""
+        if codec == MSGPACK:
+            frame = {"events": [json.loads(message) for message in messages]}
+            if first is not None:
+                frame["session"] = self.session_id
+                frame["seq"] = first
+
+            return encode(frame, MSGPACK)
+
+        # messages are already json, so the frame is built without decoding them
+        if first is not None:
+            return f'{{"session": "{self.session_id}", "seq": {first}, "events": [' + ", ".join(messages) + "]}"
 
-        self.logger.debug(f"flushed {len(messages)} events")
+        return '{"events": [' + ", ".join(messages) + "]}"
 
 class EventSender(Database):
-    def __init__(self, socketio: SocketIO, dburl: str, logger: logging.Logger):
+    """Sends events to client sockets. Sockets may be connected to a different process, in which case
+    events are routed over the EventBus. When a client connects, the process that owns the socket claims
+    the client on the bus, and any events queued for that client in other processes are forwarded to it.
+    Events that were sent by the previous process and that the client reports as handled in its resume
+    are not forwarded.
+
+    Each session holds at most max_queue_bytes of events in memory and max_spill_bytes on disk under
+    spill_path, after which events are dropped according to drop_policy. Events for a client whose
+    session timed out are dropped while the client has no reservation, and otherwise start a new
+    session."""
+    def __init__(self, socketio: SocketIO, dburl: str, logger: logging.Logger, bus: EventBus=None,
+                 max_batch_size: int=50, linger: float=0.01, max_queue_bytes: int=1024 * 1024,
+                 max_spill_bytes: int=64 * 1024 * 1024, spill_path: str="event_spill",
+                 drop_policy: str=DROP_OLDEST):
         super().__init__(dburl)
         self.socketio = socketio
         self.logger = EventSenderLogger(logger)
 
+        if drop_policy not in DROP_POLICIES:
+            raise Exception(f"Unknown drop policy {drop_policy}, expected one of {', '.join(DROP_POLICIES)}")
+
+        self.max_batch_size = max_batch_size
+        self.linger = linger
+        self.max_queue_bytes = max_queue_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.drop_policy = drop_policy
+
         self.sessions: dict[str, Session] = {}
+        # clients whose session timed out, oldest first
+        self.expired: OrderedDict[str, None] = OrderedDict()
+        self.max_expired = 10000
+        # drops of sessions that have ended, by reason
+        self.dropped = {"queue": 0, "expired": 0, "unrouted": 0}
+        # clients with a socket connected to another process, to the origin of that process
+        self.remote_clients: dict[str, str] = {}
         self.lock = threading.Lock()
 
+        self.origin = uuid.uuid4().hex
+        # separate directory per process, since sessions of other processes may use the same names
+        self.spill_path = os.path.join(spill_path, self.origin)
+
+        self.bus = bus if bus else LocalEventBus()
+        self.bus.subscribe(self.__handleBusMessage)
+
     def startSession(self, client_id):
         with self.lock:
             if client_id not in self.sessions:
@@ -116,9 +405,26 @@ class EventSender(Database):
 
         self.logger.info(f"started session {client_id}")
 
-    def addSocket(self, sock_id, client_id: str):
+    def addSocket(self, sock_id, client_id: str, batching: bool=False, resume: dict=None):
+        """Sets the socket of a client. If batching is set, the client receives events as batched
+        frames. If resume is also set, the client acknowledges frames and resumes after the
+        sequence number in resume, see Session."""
+        with self.lock:
+            self.remote_clients.pop(client_id, None)
+            self.expired.pop(client_id, None)
+
         session = self.startSession(client_id)
-        session.setSocket(sock_id)
+        session.setSocket(sock_id, batching=batching, resume=resume)
+        # lets the previous owner leave out events the client already handled
+        self.__publish("claim", client_id, resume=resume if batching else None)
+
+    def setCodec(self, client_id: str, codec: str):
+        """Sets the codec negotiated by the current socket of a client."""
+        with self.lock:
+            session = self.sessions.get(client_id)
+
+        if session:
+            session.setCodec(codec)
 
     def removeSocket(self, client_id):
         with self.lock:
@@ -126,12 +432,151 @@ class EventSender(Database):
 
         if session:
             session.removeSocket()
+            self.__publish("release", client_id)
         else:
             self.logger.error(f"tried to socket for {client_id} but session does not exist")
 
-    def endSession(self, client_id):
+    def endSession(self, client_id) -> Session:
+        """Removes the session of client_id without discarding its queue. Returns the session, or None."""
         with self.lock:
-            self.sessions.pop(client_id, None)
+            return self.sessions.pop(client_id, None)
+
+    def expireSession(self, client_id):
+        """Ends the session of a client that did not connect in time and discards its events. Later
+        events for the client are dropped until it connects or makes a reservation."""
+        with self.lock:
+            session = self.sessions.pop(client_id, None)
+
+            self.expired[client_id] = None
+            self.expired.move_to_end(client_id)
+            while len(self.expired) > self.max_expired:
+                self.expired.popitem(last=False)
+
+        if not session:
+            return
+
+        stats = session.stats()
+        discarded = session.close()
+
+        with self.lock:
+            self.dropped["queue"] += stats["dropped"]
+            self.dropped["expired"] += discarded
+
+        if discarded:
+            self.logger.warning(f"discarded {discarded} events of expired session {client_id}")
+
+    def stats(self) -> dict:
+        """Returns the amount of sessions, events queued in memory and on disk, and events dropped
+        because of a full queue, an expired session, or because they were forwarded to this process
+        after the client's session here ended."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            dropped = dict(self.dropped)
+
+        queued = memory_bytes = spill_bytes = spilled = unacked = connected = 0
+        for session in sessions:
+            stats = session.stats()
+            queued += stats["queued"]
+            memory_bytes += stats["memory_bytes"]
+            spill_bytes += stats["spill_bytes"]
+            spilled += stats["spilled"]
+            unacked += stats["unacked"]
+            dropped["queue"] += stats["dropped"]
+            connected += session.connected
+
+        return {
+            "sessions": len(sessions),
+            "connected": connected,
+            "queued": queued,
+            "memory_bytes": memory_bytes,
+            "spill_bytes": spill_bytes,
+            "spilled": spilled,
+            "unacked": unacked,
+            "dropped": dropped
+        }
+
+    def __publish(self, type_: str, client_id: str, contents: str=None, resume: dict=None, target: str=None):
+        message = {
+            "type": type_,
+            "origin": self.origin,
+            "client_id": client_id
+        }
+
+        if target is not None:
+            message["target"] = target
+
+        if contents is not None:
+            message["contents"] = contents
+
+        if resume is not None:
+            message["resume"] = resume
+
+        self.bus.publish(message)
+
+    def __handleBusMessage(self, message: dict):
+        if message.get("origin") == self.origin:
+            return
+
+        type_ = message.get("type")
+        client_id = message.get("client_id")
+
+        if not client_id:
+            return
+
+        if type_ == "claim":
+            with self.lock:
+                self.remote_clients[client_id] = message.get("origin")
+                session = self.sessions.get(client_id)
+
+            if not session or session.connected:
+                return
+
+            # socket is now owned by another process
+            self.endSession(client_id)
+
+            messages = session.takeMessages(message.get("resume"))
+            stats = session.stats()
+            session.close()
+
+            with self.lock:
+                self.dropped["queue"] += stats["dropped"]
+
+            for contents in messages:
+                self.__publish("deliver", client_id, contents, target=message.get("origin"))
+
+            if messages:
+                self.logger.info(f"forwarded {len(messages)} events for {client_id}")
+
+        elif type_ == "release":
+            with self.lock:
+                # the client may have already reconnected to another process, whose claim arrived first
+                if self.remote_clients.get(client_id) == message.get("origin"):
+                    del self.remote_clients[client_id]
+
+        elif type_ == "deliver":
+            target = message.get("target")
+
+            # deliveries without a target are from processes that do not track owners
+            if target is not None and target != self.origin:
+                return
+
+            with self.lock:
+                session = self.sessions.get(client_id)
+
+                if not session and target is not None:
+                    self.dropped["unrouted"] += 1
+
+            if not session:
+                if target is not None:
+                    self.logger.warning(f"dropped event forwarded for {client_id}, which has no session here")
+                return
+
+            contents = self.bus.resolve(message)
+            if contents is None:
+                self.logger.warning(f"failed to resolve forwarded event for {client_id}")
+                return
+
+            session.send(contents)
 
     def __getReservationClientId(self, serial: str):
         """Returns the event server url for a device, None if there is none, or False on error."""
@@ -150,7 +595,40 @@ class EventSender(Database):
 
         return data[0][0]
 
+    def __hasReservations(self, client_id: str) -> bool:
+        """Returns whether a client has reserved devices. Returns True on error, so that events are
+        queued rather than lost."""
+        try:
+            with psycopg.connect(self.url) as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT * FROM getClientReservations(%s::varchar(255))", (client_id,))
+                    data = cur.fetchall()
+        except Exception:
+            self.logger.warning(f"failed to get reservations of {client_id}")
+            return True
+
+        return bool(data)
+
     def sendClient(self, client_id: str, contents: str):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            remote = self.remote_clients.get(client_id)
+            expired = not session and not remote and client_id in self.expired
+
+        if expired:
+            # events of a new reservation may arrive before the client connects
+            if not self.__hasReservations(client_id):
+                with self.lock:
+                    self.dropped["expired"] += 1
+                return
+
+            with self.lock:
+                self.expired.pop(client_id, None)
+
+        if remote and not (session and session.connected):
+            self.__publish("deliver", client_id, contents, target=remote)
+            return
+
         session = self.startSession(client_id)
         session.send(contents)
 
@@ -1,10 +1,13 @@
 from __future__ import annotations
 import threading
+import logging
 import os
 
-import pyudev
-
 from usbipice.utils.dev import *
+from usbipice.utils.KeyedExecutor import KeyedExecutor
+from usbipice.utils.TimerService import get_timer_service
+from usbipice.utils.UdevBus import get_udev_bus
+from usbipice.utils.DeviceIndex import get_device_index
 
 class Device:
     def __init__(self, serial, firmware_path, flasher):
@@ -14,6 +17,7 @@ class Device:
 
         self.lock = threading.Lock()
         self.upload_finished = False
+        self.subscription = None
 
     def ttyExport(self, path):
         with self.lock:
@@ -49,7 +53,7 @@ class Device:
 
 class FirmwareFlasher:
     """Used to flash firmware."""
-    def __init__(self):
+    def __init__(self, logger: logging.Logger=None):
         self.remaining_serials = {}
         self.failed_serials = []
 
@@ -57,31 +61,37 @@ class FirmwareFlasher:
         self.timeout_thread = None
 
         self.cv = threading.Condition()
+        self.started = False
+
+        # uploads block for a while, so they are run off the udev bus thread, one at a time per serial
+        self.executor = KeyedExecutor(logger if logger else logging.getLogger(__name__), workers=8, name="flash-handler")
 
         if not os.path.exists("client_media"):
             os.mkdir("client_media")
 
-        context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context)
-        self.observer = pyudev.MonitorObserver(monitor, self.__handle_event, name="flash-observer")
-
     def startFlasher(self):
         """Start monitoring for device events."""
-        if not self.observer.is_alive():
-            self.observer.start()
+        with self.cv:
+            self.started = True
 
-    def __handle_event(self, action, dev):
-        """Reroutes events to corresponding Device objects."""
-        if action != "add":
-            return
+            for device in self.remaining_serials.values():
+                self.__subscribe(device)
 
-        dev = dict(dev)
+    def __subscribe(self, device: Device):
+        if not device.subscription:
+            device.subscription = get_udev_bus().subscribe(self.__handle_event, serial=device.serial, action="add")
 
-        serial = get_serial(dev)
+    def __unsubscribe(self, device: Device):
+        if device.subscription:
+            device.subscription.unsubscribe()
+            device.subscription = None
 
-        if not serial:
-            return
+    def __handle_event(self, action, dev):
+        """Reroutes events to corresponding Device objects."""
+        serial = get_serial(dev)
+        self.executor.submit(serial, self.__handle_add, serial, dev)
 
+    def __handle_add(self, serial, dev):
         path = dev.get("DEVNAME")
 
         if not path:
@@ -108,15 +118,17 @@ class FirmwareFlasher:
 
         with self.cv:
             for serial in serials:
-                self.remaining_serials[serial] = Device(serial, path, self)
+                device = Device(serial, path, self)
+                self.remaining_serials[serial] = device
 
-        info = get_devs()
-        devs = []
+                if self.started:
+                    self.__subscribe(device)
 
-        for serial, path in info.items():
-            if serial in serials:
-                devs.extend(path)
+        index = get_device_index()
+        devs = []
 
+        for serial in serials:
+            devs.extend(index.get(serial))
 
         for file in devs:
             if file.get("SUBSYSTEM") != "tty":
@@ -127,16 +139,25 @@ class FirmwareFlasher:
 
     def handleDone(self, serial):
         with self.cv:
-            self.remaining_serials.pop(serial)
+            device = self.remaining_serials.pop(serial, None)
+
+            if not device:
+                return
+
+            self.__unsubscribe(device)
 
             if not self.remaining_serials:
                 self.cv.notify_all()
 
     def handleFailed(self, serial):
         with self.cv:
-            if not self.remaining_serials.pop(serial):
+            device = self.remaining_serials.pop(serial, None)
+
+            if not device:
                 return
 
+            self.__unsubscribe(device)
+
             self.failed_serials.append(serial)
 
             if not self.remaining_serials:
@@ -150,13 +171,10 @@ class FirmwareFlasher:
 
         def ontimeout():
             with self.cv:
-                self.failed_serials.extend(self.remaining_serials.keys())
-                self.remaining_serials = {}
-                self.cv.notify_all()
+                self.__failRemaining()
 
         if timeout:
-            timer = threading.Timer(timeout, ontimeout)
-            timer.start()
+            timer = get_timer_service().schedule(timeout, ontimeout, name="firmware-flasher-timeout")
 
         with self.cv:
             self.cv.wait_for(lambda : not self.remaining_serials)
@@ -171,10 +189,14 @@ class FirmwareFlasher:
 
     def stopFlasher(self):
         """Stops monitoring for device events. Marks all devices currently flashing as failed to flash."""
-        if self.observer.is_alive():
-            self.observer.send_stop()
-
         with self.cv:
-            self.failed_serials.extend(self.remaining_serials.keys())
-            self.remaining_serials = {}
-            self.cv.notify_all()
+            self.started = False
+            self.__failRemaining()
+
+    def __failRemaining(self):
+        for device in self.remaining_serials.values():
+            self.__unsubscribe(device)
+
+        self.failed_serials.extend(self.remaining_serials.keys())
+        self.remaining_serials = {}
+        self.cv.notify_all()
@@ -0,0 +1,90 @@
+from __future__ import annotations
+from collections import deque
+from logging import Logger, LoggerAdapter
+import threading
+
+class KeyedExecutorLogger(LoggerAdapter):
+    def __init__(self, logger, name, extra=None):
+        super().__init__(logger, extra)
+        self.executor_name = name
+
+    def process(self, msg, kwargs):
+        return f"[{self.executor_name}] {msg}", kwargs
+
+class KeyedExecutor:
+    """Runs tasks on a fixed pool of threads with FIFO ordering per key. Tasks with the same key never
+    run concurrently, while tasks of different keys run in parallel. Keys take turns, so a key with a
+    long queue does not starve the others. If limit is set, each key can have at most limit tasks
+    waiting."""
+    def __init__(self, logger: Logger, workers: int=16, limit: int=None, name: str="keyed-executor"):
+        self.logger = KeyedExecutorLogger(logger, name)
+        self.limit = limit
+
+        self.cv = threading.Condition()
+        # waiting tasks of each key with waiting or running tasks
+        self.queues: dict[object, deque] = {}
+        # keys with waiting tasks and no running task
+        self.ready = deque()
+        self.running = set()
+        self.rejected = 0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__run, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args) -> bool:
+        """Queues fn(*args) to run after the tasks already queued for key. Returns False if the
+        queue of key is full."""
+        with self.cv:
+            queue = self.queues.setdefault(key, deque())
+
+            if self.limit and len(queue) >= self.limit:
+                self.rejected += 1
+                return False
+
+            queue.append((fn, args))
+
+            if key not in self.running and len(queue) == 1:
+                self.ready.append(key)
+                self.cv.notify()
+
+        return True
+
+    def depth(self, key) -> int:
+        """Amount of tasks of key that are waiting or running."""
+        with self.cv:
+            return len(self.queues.get(key, ())) + (key in self.running)
+
+    def stats(self) -> dict:
+        """Returns the amount of waiting and running tasks per key, and the amount of rejected tasks."""
+        with self.cv:
+            return {
+                "depth": {str(key): len(queue) + (key in self.running) for key, queue in self.queues.items()},
+                "running": len(self.running),
+                "rejected": self.rejected
+            }
+
+    def __run(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda : self.ready)
+
+                key = self.ready.popleft()
+                fn, args = self.queues[key].popleft()
+                self.running.add(key)
+
+            try:
+                fn(*args)
+            except Exception as e:
+                self.logger.error(f"exception in task for {key}: {e}")
+
+            with self.cv:
+                self.running.discard(key)
+
+                if self.queues[key]:
+                    self.ready.append(key)
+                    self.cv.notify()
+                else:
+                    del self.queues[key]
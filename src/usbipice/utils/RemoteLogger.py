@@ -6,16 +6,20 @@ from logging import Logger
 import requests
 
 class RemoteLogger:
-    """Drop in replacement for a logging.Logger to also post to logs control server."""
-    def __init__(self, logger: Logger, control_server: str, client_name: str, interval: int=30):
+    """Drop in replacement for a logging.Logger to also post to logs control server. If the control
+    server rejects the logs, they are kept and resent on the next interval. At most max_backlog
+    rows are kept, after which the oldest rows are dropped."""
+    def __init__(self, logger: Logger, control_server: str, client_name: str, interval: int=30, max_backlog: int=10000):
         self.logger: Logger = logger
 
         self.control_server = control_server
         self.client_name = client_name
         self.interval = interval
+        self.max_backlog = max_backlog
 
         self._backlog = []
         self._backlog_lock = threading.Lock()
+        self._dropped = 0
 
         self._thread = threading.Thread(target=self._send, name="remote-logger", daemon=True)
         self._thread.start()
@@ -39,6 +43,19 @@ class RemoteLogger:
                     raise Exception
             except Exception:
                 self.logger.error("[RemoteLogger] failed to send log results")
+                self._requeue(logs)
+
+    def _requeue(self, logs):
+        with self._backlog_lock:
+            self._backlog = logs + self._backlog
+            overflow = len(self._backlog) - self.max_backlog
+
+            if overflow > 0:
+                self._backlog = self._backlog[overflow:]
+                self._dropped += overflow
+
+        if overflow > 0:
+            self.logger.warning(f"[RemoteLogger] dropped {overflow} log rows ({self._dropped} total)")
 
     def __getattr__(self, attr):
         # can't inherit from logging.Logger since its an externally managed singleton
@@ -0,0 +1,250 @@
+from __future__ import annotations
+from collections import deque
+import selectors
+import threading
+import logging
+import os
+
+import serial
+
+# most bytes handed to the kernel per write, matching the chunks the pico firmware expects
+WRITE_CHUNK = 512
+READ_SIZE = 4096
+
+class SerialMuxLogger(logging.LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[SerialMux] {msg}", kwargs
+
+class SerialProtocol:
+    """Receives data from a SerialChannel. Called on the mux thread, so methods should not block."""
+    def dataReceived(self, data: bytes):
+        """Called with bytes as they are read from the port."""
+
+    def connectionLost(self):
+        """Called once the port is closed or fails."""
+
+class SerialChannel:
+    """A tty owned by a SerialMux. Writes are buffered and sent by the mux thread as the port
+    accepts them."""
+    def __init__(self, mux: SerialMux, port: serial.Serial, protocol: SerialProtocol):
+        self.mux = mux
+        self.port = port
+        self.fd = port.fileno()
+        self.protocol = protocol
+
+        self.out: deque[memoryview] = deque()
+        self.out_bytes = 0
+        self.closing = False
+        self.closed = threading.Event()
+
+    def write(self, data: bytes) -> bool:
+        """Queues data to be written. Returns False if the channel is closed."""
+        with self.mux.cv:
+            if self.closing:
+                return False
+
+            self.out.append(memoryview(bytes(data)))
+            self.out_bytes += len(data)
+
+        self.mux.update(self)
+        return True
+
+    def drain(self, timeout: float=None) -> bool:
+        """Waits until all queued data is written. Returns False on timeout or if the channel closed
+        with data left."""
+        with self.mux.cv:
+            return self.mux.cv.wait_for(lambda : not self.out or self.closing, timeout=timeout) and not self.out
+
+    def close(self):
+        """Stops reading and closes the port. Waits for the mux to release it, unless called from the
+        mux thread."""
+        with self.mux.cv:
+            if self.closing:
+                return
+
+            self.closing = True
+            self.mux.cv.notify_all()
+
+        self.mux.update(self)
+
+        if not self.mux.inMux():
+            self.closed.wait()
+
+class SerialMux:
+    """Owns the file descriptors of device ttys and serves them from a single thread blocked on a
+    selector, instead of a reading thread per port polling with a timeout. Received bytes are passed
+    to each port's SerialProtocol, and writes are sent without blocking as the port has room."""
+    def __init__(self, logger: logging.Logger=None):
+        self.logger = SerialMuxLogger(logger if logger else logging.getLogger(__name__))
+
+        self.selector = selectors.DefaultSelector()
+        self.cv = threading.Condition()
+        # channels whose registration needs to be updated by the mux thread
+        self.pending: set[SerialChannel] = set()
+        self.channels: set[SerialChannel] = set()
+
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self.__run, name="serial-mux", daemon=True)
+        self.thread.start()
+
+    def open(self, path: str, baud: int, protocol: SerialProtocol) -> SerialChannel:
+        """Opens path in raw non-blocking mode and starts delivering its data to protocol."""
+        port = serial.Serial(path, baud, timeout=0, write_timeout=0)
+        channel = SerialChannel(self, port, protocol)
+        self.update(channel)
+        return channel
+
+    def inMux(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def update(self, channel: SerialChannel):
+        """Asks the mux thread to register, update or release channel."""
+        with self.cv:
+            self.pending.add(channel)
+
+        try:
+            os.write(self.wake_write, b"\0")
+        except BlockingIOError:
+            # the pipe is full, the mux thread is already going to wake up
+            pass
+
+    def stats(self) -> dict:
+        with self.cv:
+            return {
+                "ports": len(self.channels),
+                "queued_bytes": sum(channel.out_bytes for channel in self.channels)
+            }
+
+    def __run(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self.__wake()
+                    continue
+
+                channel = key.data
+
+                if mask & selectors.EVENT_READ:
+                    self.__read(channel)
+
+                if mask & selectors.EVENT_WRITE and not channel.closed.is_set():
+                    self.__write(channel)
+
+    def __wake(self):
+        try:
+            while os.read(self.wake_read, READ_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.cv:
+            pending = self.pending
+            self.pending = set()
+
+        for channel in pending:
+            with self.cv:
+                closing = channel.closing
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if channel.out else 0)
+
+            if closing:
+                self.__release(channel)
+            elif channel in self.channels:
+                self.selector.modify(channel.fd, events, channel)
+            elif not channel.closed.is_set():
+                self.selector.register(channel.fd, events, channel)
+                self.channels.add(channel)
+
+    def __read(self, channel: SerialChannel):
+        try:
+            data = os.read(channel.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.warning(f"read failed on {channel.port.port}: {e}")
+            self.__release(channel)
+            return
+
+        if not data:
+            self.__release(channel)
+            return
+
+        try:
+            channel.protocol.dataReceived(data)
+        except Exception as e:
+            self.logger.error(f"exception in protocol of {channel.port.port}: {e}")
+
+    def __write(self, channel: SerialChannel):
+        with self.cv:
+            if not channel.out:
+                self.selector.modify(channel.fd, selectors.EVENT_READ, channel)
+                return
+
+            chunk = channel.out[0][:WRITE_CHUNK]
+
+        try:
+            written = os.write(channel.fd, chunk)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.warning(f"write failed on {channel.port.port}: {e}")
+            self.__release(channel)
+            return
+
+        with self.cv:
+            channel.out_bytes -= written
+            rest = channel.out[0][written:]
+
+            if rest:
+                channel.out[0] = rest
+            else:
+                channel.out.popleft()
+
+            if not channel.out:
+                self.selector.modify(channel.fd, selectors.EVENT_READ, channel)
+                self.cv.notify_all()
+
+    def __release(self, channel: SerialChannel):
+        if channel.closed.is_set():
+            return
+
+        with self.cv:
+            channel.closing = True
+            self.channels.discard(channel)
+            self.cv.notify_all()
+
+        try:
+            self.selector.unregister(channel.fd)
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            channel.port.close()
+        except Exception:
+            pass
+
+        channel.closed.set()
+
+        try:
+            channel.protocol.connectionLost()
+        except Exception as e:
+            self.logger.error(f"exception in protocol of {channel.port.port}: {e}")
+
+_serial_mux = None
+_serial_mux_lock = threading.Lock()
+
+def get_serial_mux() -> SerialMux:
+    """Returns the SerialMux shared by the process."""
+    global _serial_mux
+
+    with _serial_mux_lock:
+        if not _serial_mux:
+            _serial_mux = SerialMux()
+
+        return _serial_mux
@@ -0,0 +1,205 @@
+from __future__ import annotations
+from collections import deque
+import itertools
+import logging
+import struct
+import re
+import os
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+DROP_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+# records are stored as a 4 byte big endian length followed by utf-8 data
+HEADER = struct.Struct(">I")
+
+class SpillQueue:
+    """FIFO queue of strings with a memory bound. Once max_memory bytes are queued, new items are
+    appended to segment files under path and read back in order as the queue drains. Once max_spill
+    bytes are on disk, the drop policy decides what is lost: drop_newest discards the incoming item,
+    drop_oldest discards the oldest segment on disk. Not thread safe, callers must synchronize."""
+    def __init__(self, path: str, name: str, logger: logging.Logger, max_memory: int=1024 * 1024,
+                 max_spill: int=64 * 1024 * 1024, segment_bytes: int=1024 * 1024, policy: str=DROP_OLDEST):
+        if policy not in DROP_POLICIES:
+            raise Exception(f"Unknown drop policy {policy}, expected one of {', '.join(DROP_POLICIES)}")
+
+        self.path = path
+        self.name = re.sub("[^A-Za-z0-9_.-]", "_", name) or "_"
+        self.logger = logger
+        self.max_memory = max_memory
+        self.max_spill = max_spill
+        self.segment_bytes = segment_bytes
+        self.policy = policy
+
+        self.memory = deque()
+        self.memory_bytes = 0
+
+        # [filename, records, bytes], oldest first. Only the last segment is written to.
+        self.segments = deque()
+        self.writer = None
+        self.segment_ids = itertools.count()
+        self.spill_bytes = 0
+        self.spill_records = 0
+
+        self.spilled = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.memory) + self.spill_records
+
+    def put(self, item: str) -> int:
+        """Appends an item. Returns the amount of items dropped to make room, including the
+        item itself under drop_newest."""
+        # once anything is on disk, new items have to follow it to keep the order
+        if not self.segments and self.memory_bytes + len(item) <= self.max_memory:
+            self.memory.append(item)
+            self.memory_bytes += len(item)
+            return 0
+
+        data = item.encode()
+        size = HEADER.size + len(data)
+        dropped = 0
+
+        if self.policy == DROP_OLDEST:
+            while self.segments and self.spill_bytes + size > self.max_spill:
+                dropped += self.__dropSegment()
+
+        if self.spill_bytes + size > self.max_spill:
+            self.dropped += 1
+            return dropped + 1
+
+        try:
+            self.__write(data)
+        except OSError:
+            self.logger.error(f"failed to spill event to {self.path}")
+            self.dropped += 1
+            return dropped + 1
+
+        self.spilled += 1
+        return dropped
+
+    def requeue(self, items: list[str]):
+        """Puts items back at the front of the queue, in order. Items are kept in memory
+        regardless of the memory bound, since they were just taken from the queue."""
+        self.memory.extendleft(reversed(items))
+        self.memory_bytes += sum(len(item) for item in items)
+
+    def take(self, amount: int) -> list[str]:
+        """Removes and returns up to amount items from the front of the queue."""
+        items = []
+
+        while len(items) < amount:
+            if not self.memory:
+                if not self.__load():
+                    break
+                continue
+
+            item = self.memory.popleft()
+            self.memory_bytes -= len(item)
+            items.append(item)
+
+        return items
+
+    def takeAll(self) -> list[str]:
+        """Removes and returns all items."""
+        return self.take(len(self))
+
+    def close(self) -> int:
+        """Discards all items and removes segment files. Returns the amount of items discarded."""
+        discarded = len(self)
+        self.__closeWriter()
+
+        for filename, _, _ in self.segments:
+            self.__remove(filename)
+
+        self.segments.clear()
+        self.spill_bytes = 0
+        self.spill_records = 0
+        self.memory.clear()
+        self.memory_bytes = 0
+
+        return discarded
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self),
+            "memory_bytes": self.memory_bytes,
+            "spill_bytes": self.spill_bytes,
+            "spilled": self.spilled,
+            "dropped": self.dropped
+        }
+
+    def __write(self, data: bytes):
+        if not self.writer or self.segments[-1][2] >= self.segment_bytes:
+            self.__closeWriter()
+            os.makedirs(self.path, exist_ok=True)
+
+            filename = os.path.join(self.path, f"{self.name}-{next(self.segment_ids)}.seg")
+            self.writer = open(filename, "wb")
+            self.segments.append([filename, 0, 0])
+
+        self.writer.write(HEADER.pack(len(data)))
+        self.writer.write(data)
+
+        segment = self.segments[-1]
+        segment[1] += 1
+        segment[2] += HEADER.size + len(data)
+        self.spill_records += 1
+        self.spill_bytes += HEADER.size + len(data)
+
+    def __closeWriter(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def __popSegment(self) -> tuple[str, int, int]:
+        if len(self.segments) == 1:
+            self.__closeWriter()
+
+        filename, records, size = self.segments.popleft()
+        self.spill_records -= records
+        self.spill_bytes -= size
+
+        return filename, records, size
+
+    def __dropSegment(self) -> int:
+        filename, records, _ = self.__popSegment()
+        self.__remove(filename)
+        self.dropped += records
+        return records
+
+    def __load(self) -> bool:
+        """Moves the oldest segment into memory. Returns False if there are no segments."""
+        if not self.segments:
+            return False
+
+        filename, records, _ = self.__popSegment()
+
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.logger.error(f"failed to read spilled events from {filename}")
+            self.dropped += records
+            return True
+        finally:
+            self.__remove(filename)
+
+        position = 0
+        while position + HEADER.size <= len(data):
+            (length,) = HEADER.unpack_from(data, position)
+            position += HEADER.size
+
+            item = data[position:position + length].decode()
+            position += length
+
+            self.memory.append(item)
+            self.memory_bytes += len(item)
+
+        return True
+
+    def __remove(self, filename: str):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
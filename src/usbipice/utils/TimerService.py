@@ -0,0 +1,119 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import logging
+import heapq
+import time
+
+class TimerServiceLogger(logging.LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[TimerService] {msg}", kwargs
+
+class Timer:
+    """Handle to a callback scheduled on a TimerService."""
+    def __init__(self, service: TimerService, deadline: float, callback, name: str):
+        self.service = service
+        self.deadline = deadline
+        self.callback = callback
+        self.name = name
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self) -> bool:
+        """Cancels the timer. Returns False if the callback has already been started."""
+        return self.service.cancel(self)
+
+    @property
+    def active(self) -> bool:
+        """Whether the callback is still scheduled."""
+        return not self.cancelled and not self.fired
+
+class TimerService:
+    """Runs callbacks after a delay. Deadlines are kept in a heap and waited on by a single thread,
+    instead of a sleeping thread per timeout. Due callbacks are run on a small thread pool so that
+    a slow callback does not delay other timers."""
+    def __init__(self, logger: logging.Logger=None, workers: int=8):
+        self.logger = TimerServiceLogger(logger if logger else logging.getLogger(__name__))
+
+        self.cv = threading.Condition()
+        self.heap: list[tuple[float, int, Timer]] = []
+        self.ids = itertools.count()
+        self.cancelled = 0
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="timer-callback")
+
+        self.thread = threading.Thread(target=self.__run, name="timer-service", daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay: float, callback, name: str="timer") -> Timer:
+        """Calls callback() after delay seconds. Returns a Timer that can be used to cancel it."""
+        timer = Timer(self, time.monotonic() + delay, callback, name)
+
+        with self.cv:
+            heapq.heappush(self.heap, (timer.deadline, next(self.ids), timer))
+
+            # only wake the thread if it is waiting on a later deadline
+            if self.heap[0][2] is timer:
+                self.cv.notify()
+
+        return timer
+
+    def cancel(self, timer: Timer) -> bool:
+        with self.cv:
+            if not timer.active:
+                return timer.cancelled
+
+            timer.cancelled = True
+            self.cancelled += 1
+
+            # cancelled timers are removed lazily, rebuild once they make up most of the heap
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+            return True
+
+    def pending(self) -> int:
+        """Amount of scheduled timers."""
+        with self.cv:
+            return len(self.heap) - self.cancelled
+
+    def __call(self, timer: Timer):
+        try:
+            timer.callback()
+        except Exception as e:
+            self.logger.error(f"exception in timer {timer.name}: {e}")
+
+    def __run(self):
+        while True:
+            with self.cv:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cv.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+
+                _, _, timer = heapq.heappop(self.heap)
+
+                if timer.cancelled:
+                    self.cancelled -= 1
+                    continue
+
+                timer.fired = True
+
+            self.pool.submit(self.__call, timer)
+
+_timer_service = None
+_timer_service_lock = threading.Lock()
+
+def get_timer_service() -> TimerService:
+    """Returns the TimerService shared by the process."""
+    global _timer_service
+
+    with _timer_service_lock:
+        if not _timer_service:
+            _timer_service = TimerService()
+
+        return _timer_service
@@ -0,0 +1,173 @@
+from __future__ import annotations
+import threading
+import logging
+
+import pyudev
+
+from usbipice.utils.dev import get_serial, get_busid
+
+SOURCES = ("udev", "kernel")
+
+class UdevBusLogger(logging.LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[UdevBus] {msg}", kwargs
+
+class Subscription:
+    """Handle to a callback registered on a UdevBus."""
+    def __init__(self, bus: UdevBus, callback, serial: str, busid: str, subsystem: str, action: str, source: str):
+        self.bus = bus
+        self.callback = callback
+        self.serial = serial
+        self.busid = busid
+        self.subsystem = subsystem
+        self.action = action
+        self.source = source
+        # cleared by UdevBus.unsubscribe, so that events already being published skip the callback
+        self.active = True
+
+    def matches(self, action: str, dev: dict) -> bool:
+        """Checks the filters that are not used as dispatch keys."""
+        if self.action and self.action != action:
+            return False
+
+        if self.subsystem and self.subsystem != dev.get("SUBSYSTEM"):
+            return False
+
+        return True
+
+    def unsubscribe(self):
+        """Stops calling the callback. Safe to call more than once. A callback already running on
+        another thread is not waited for."""
+        self.bus.unsubscribe(self)
+
+class UdevBus:
+    """Process wide udev event bus. A single MonitorObserver is started per source (udev or kernel)
+    once something subscribes to it, instead of one netlink socket per listener. Subscriptions
+    are indexed by serial or busid, so an event is only checked against the subscriptions of
+    its device and those without either filter. Callbacks are called on the observer thread
+    with (action, dev dict) and should hand off slow work. Subscriptions without a serial or busid
+    are called first, then those filtered by serial, then those filtered by busid. Order of
+    subscription is only kept within each of these groups. If listen is False, no observers are
+    started and events only come from publish."""
+    def __init__(self, logger: logging.Logger=None, listen: bool=True):
+        self.logger = UdevBusLogger(logger if logger else logging.getLogger(__name__))
+        self.context = pyudev.Context()
+        self.listen = listen
+
+        self.lock = threading.Lock()
+        self.observers: dict[str, pyudev.MonitorObserver] = {}
+
+        # dicts are used as ordered sets, so subscribers of an index are called in the order they subscribed
+        self.by_serial: dict[str, dict[str, dict[Subscription, None]]] = {source: {} for source in SOURCES}
+        self.by_busid: dict[str, dict[str, dict[Subscription, None]]] = {source: {} for source in SOURCES}
+        self.unkeyed: dict[str, dict[Subscription, None]] = {source: {} for source in SOURCES}
+
+    def subscribe(self, callback, serial: str=None, busid: str=None, subsystem: str=None, action: str=None,
+                  source: str="udev") -> Subscription:
+        """Calls callback(action, dev) for events of source matching every given filter. Returns a
+        Subscription that can be used to unsubscribe."""
+        if source not in SOURCES:
+            raise Exception(f"Unknown udev source {source}, expected one of {', '.join(SOURCES)}")
+
+        subscription = Subscription(self, callback, serial, busid, subsystem, action, source)
+
+        with self.lock:
+            self.__index(subscription)[subscription] = None
+
+            if self.listen and source not in self.observers:
+                self.__startObserver(source)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscription.active = False
+            source = subscription.source
+
+            if subscription.serial:
+                table, key = self.by_serial[source], subscription.serial
+            elif subscription.busid:
+                table, key = self.by_busid[source], subscription.busid
+            else:
+                self.unkeyed[source].pop(subscription, None)
+                return
+
+            subscriptions = table.get(key)
+
+            if subscriptions is None:
+                return
+
+            subscriptions.pop(subscription, None)
+
+            if not subscriptions:
+                del table[key]
+
+    def __index(self, subscription: Subscription) -> dict[Subscription, None]:
+        source = subscription.source
+
+        if subscription.serial:
+            return self.by_serial[source].setdefault(subscription.serial, {})
+
+        if subscription.busid:
+            return self.by_busid[source].setdefault(subscription.busid, {})
+
+        return self.unkeyed[source]
+
+    def __startObserver(self, source: str):
+        monitor = pyudev.Monitor.from_netlink(self.context, source=source)
+        observer = pyudev.MonitorObserver(monitor, lambda action, dev : self.publish(source, action, dict(dev)),
+                                          name=f"udev-bus-{source}")
+        observer.daemon = True
+        observer.start()
+        self.observers[source] = observer
+
+    def publish(self, source: str, action: str, dev: dict):
+        """Calls the subscribers of source matching the event on the calling thread. Called by the
+        observers, and can be used to replay recorded events."""
+        with self.lock:
+            candidates = list(self.unkeyed[source])
+
+            if self.by_serial[source] and (serial := get_serial(dev)):
+                candidates.extend(self.by_serial[source].get(serial, ()))
+
+            if self.by_busid[source] and (path := dev.get("DEVPATH")) and (busid := get_busid(path)):
+                candidates.extend(self.by_busid[source].get(busid, ()))
+
+        for subscription in candidates:
+            # an earlier callback, or another thread, may have unsubscribed it since the copy
+            if not subscription.active or not subscription.matches(action, dev):
+                continue
+
+            try:
+                subscription.callback(action, dev)
+            except Exception as e:
+                self.logger.error(f"exception in {source} subscriber: {e}")
+
+    def listDevices(self):
+        """Lists devices currently known to udev."""
+        return self.context.list_devices()
+
+    def stop(self):
+        """Stops all observers."""
+        with self.lock:
+            observers = list(self.observers.values())
+            self.observers = {}
+
+        for observer in observers:
+            observer.send_stop()
+
+_udev_bus = None
+_udev_bus_lock = threading.Lock()
+
+def get_udev_bus() -> UdevBus:
+    """Returns the UdevBus shared by the process."""
+    global _udev_bus
+
+    with _udev_bus_lock:
+        if not _udev_bus:
+            _udev_bus = UdevBus()
+
+        return _udev_bus
@@ -1,5 +1,12 @@
 from usbipice.utils.Database import Database, DeviceState
 from usbipice.utils.FirmwareFlasher import FirmwareFlasher
 from usbipice.utils.RemoteLogger import RemoteLogger
+from usbipice.utils.EventBus import EventBus, LocalEventBus, PostgresEventBus, get_event_bus
+from usbipice.utils.KeyedExecutor import KeyedExecutor
+from usbipice.utils.UdevBus import UdevBus, Subscription, get_udev_bus
+from usbipice.utils.DeviceIndex import DeviceIndex, get_device_index
+from usbipice.utils.TimerService import TimerService, Timer, get_timer_service
+from usbipice.utils.SpillQueue import SpillQueue
+from usbipice.utils.SerialMux import SerialMux, SerialChannel, SerialProtocol, get_serial_mux
 from usbipice.utils.EventSender import EventSender
 from usbipice.utils.utils import *
@@ -0,0 +1,54 @@
+"""Encoding of socket payloads. MessagePack is used when both sides have the optional msgpack
+dependency installed, otherwise payloads are sent as json strings. Binary payloads are always
+msgpack and text payloads are always json, so the receiver does not need to know which codec the
+sender picked."""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = "msgpack"
+JSON = "json"
+
+def available_codecs() -> list[str]:
+    """Codecs supported by this process, in order of preference."""
+    if msgpack:
+        return [MSGPACK, JSON]
+
+    return [JSON]
+
+def choose_codec(offered) -> str:
+    """Returns the first codec of offered that is supported, or json."""
+    if isinstance(offered, list):
+        for codec in offered:
+            if codec in available_codecs():
+                return codec
+
+    return JSON
+
+def _json_default(obj):
+    # files are sent as cp437 text to clients that only support json
+    if isinstance(obj, (bytes, bytearray)):
+        return bytes(obj).decode("cp437")
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def encode(obj, codec: str=JSON) -> bytes | str:
+    """Encodes obj. bytes values are kept as raw bytes with msgpack, and are cp437 decoded into strings
+    with json."""
+    if codec == MSGPACK and msgpack:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    return json.dumps(obj, default=_json_default)
+
+def decode(data: bytes | str):
+    """Decodes data encoded with either codec. Raises an exception if data can't be decoded."""
+    if isinstance(data, (bytes, bytearray)):
+        if not msgpack:
+            raise Exception("received msgpack payload but msgpack is not installed")
+
+        return msgpack.unpackb(data, raw=False)
+
+    return json.loads(data)
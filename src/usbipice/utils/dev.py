@@ -4,9 +4,23 @@ A collection of functions for interacting with device files.
 import os
 import re
 import subprocess
+import termios
 
 import pyudev
 
+from usbipice.utils.fat import FatError, write_bootloader_file
+
+# name firmware is written as on the bootloader drive
+FIRMWARE_NAME = "FIRMWARE.UF2"
+
+# models of pico2-ice device files
+MODELS = ("RP2350", "pico-ice", "Pico")
+
+# user format, /usb1/.../(busid)
+USER_BUSID = re.compile("/usb[0-9]/.*?/(.*?)([:/]|$)")
+# kernel format, /usb1/(busid)
+KERNEL_BUSID = re.compile("/usb[0-9]/([0-9]-(?:[0-9]|\\.)+)$")
+
 def get_serial(dev):
     """Obtains the serial from a dev file dict. Returns false if the dev file 
     is not related to pico2-ice."""
@@ -15,12 +29,10 @@ def get_serial(dev):
     if not devname:
         return False
 
-    if not re.match("/dev/", devname) or re.match("/dev/bus/", devname):
+    if not devname.startswith("/dev/") or devname.startswith("/dev/bus/"):
         return False
 
-    id_model = dev.get("ID_MODEL")
-
-    if id_model != "RP2350" and id_model != 'pico-ice' and id_model != 'Pico':
+    if dev.get("ID_MODEL") not in MODELS:
         return False
 
     serial = dev.get("ID_SERIAL_SHORT")
@@ -41,13 +53,11 @@ def format_dev_file(udevinfo) -> str:
 def get_busid(dev_path: str) -> str:
     """Returns the bus from a devpath, or None. Obtains the bus from matching
     /usb1/.../() on DEVPATH."""
-    # user format
-    capture = re.search("/usb[0-9]/.*?/(.*?)([:/]|$)", dev_path)
+    capture = USER_BUSID.search(dev_path)
     if capture:
         return capture.group(1)
 
-    # kernel format
-    capture = re.search("/usb[0-9]/([0-9]-(?:[0-9]|\\.)+)$", dev_path)
+    capture = KERNEL_BUSID.search(dev_path)
     if capture:
         return capture.group(1)
     return None
@@ -70,10 +80,37 @@ def umount(loc: str) -> bool:
 
     return True
 
-def send_bootloader(path: str, timeout: int=10):
-    """Connects with picocom using a 1200 baud at path. Returns whether successful."""
+def send_bootloader(path: str, timeout: int=10) -> bool:
+    """Opens the tty at path with a 1200 baud and closes it, dropping DTR, which reboots the pico
+    into its bootloader. If the tty can not be opened or configured by this process, falls back
+    to picocom with sudo. Returns whether successful."""
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return send_bootloader_picocom(path, timeout=timeout)
+
+    try:
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = termios.B1200
+        # drop DTR on close
+        attrs[2] |= termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        return send_bootloader_picocom(path, timeout=timeout)
+    finally:
+        try:
+            os.close(fd)
+        except OSError:
+            # the device may already have disconnected to reboot
+            pass
+
+    return True
+
+def send_bootloader_picocom(path: str, timeout: int=10) -> bool:
+    """Connects with picocom using a 1200 baud at path, exiting once the port is set up. Returns
+    whether successful."""
     try:
-        subprocess.run(["sudo", "picocom", "--baud", "1200", path], timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        subprocess.run(["sudo", "picocom", "--baud", "1200", "--exit", path], timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except Exception:
         return False
 
@@ -82,7 +119,7 @@ def send_bootloader(path: str, timeout: int=10):
 def get_devs():
     """Returns a dict mapping device serials to list of dev info dicts. This operation 
     looks through all available dev files and is intended to be only used once after reserving devices.
-    If you are dealing with frequent dev file changes, you should use a pyudev MonitorObserver instead."""
+    For repeated lookups, use usbipice.utils.get_device_index instead, which is kept current from udev events."""
     out = {}
 
     context = pyudev.Context().list_devices()
@@ -107,7 +144,7 @@ def get_devs():
 def get_dev_paths():
     """Returns a dict mapping device serials to list of dev paths. This operation 
     looks through all available dev files and is intended to be only used once after reserving devices.
-    If you are dealing with frequent dev file changes, you should use a pyudev MonitorObserver instead."""
+    For repeated lookups, use usbipice.utils.get_device_index instead, which is kept current from udev events."""
     out = get_devs()
     for key in out:
         items = map(lambda x : x.get("DEVNAME"), out[key])
@@ -120,9 +157,24 @@ class FirmwareUploadFail(Exception):
     def __init__(self, *args):
         super().__init__(*args)
 
+def write_firmware(partition_path: str, firmware_bytes: bytes):
+    """Writes firmware_bytes directly to the FAT filesystem of the bootloader drive. Returns whether
+    the drive was a bootloader drive, or None if the partition can not be opened by this process."""
+    try:
+        return write_bootloader_file(partition_path, FIRMWARE_NAME, firmware_bytes)
+    except OSError:
+        return None
+    except FatError:
+        raise FirmwareUploadFail()
+
 def upload_firmware(partition_path: str, mount_location: str, firmware_bytes: bytes, mount_timeout=30):
-    """Mounts the partition at location and uploads firmware_bytes to the drive. Requires sudo 
-    to write to drive.."""
+    """Uploads firmware_bytes to the bootloader drive at partition_path without mounting it. If the
+    partition can not be opened by this process, mounts it at location instead, which requires sudo."""
+    written = write_firmware(partition_path, firmware_bytes)
+
+    if written is not None:
+        return written
+
     mounted = mount(partition_path, mount_location, timeout=mount_timeout)
 
     if not mounted:
@@ -144,7 +196,19 @@ def upload_firmware(partition_path: str, mount_location: str, firmware_bytes: by
     return True
 
 def upload_firmware_path(partition_path: str, mount_location: str, firmware_path: str, mount_timeout=10):
-    """Mounts the partition at location and copies firmware_path to the drive."""
+    """Copies firmware_path to the bootloader drive at partition_path without mounting it. If the
+    partition can not be opened by this process, mounts it at location instead, which requires sudo."""
+    try:
+        with open(firmware_path, "rb") as f:
+            firmware_bytes = f.read()
+    except OSError:
+        raise FirmwareUploadFail()
+
+    written = write_firmware(partition_path, firmware_bytes)
+
+    if written is not None:
+        return written
+
     mounted = mount(partition_path, mount_location, timeout=mount_timeout)
 
     if not mounted:
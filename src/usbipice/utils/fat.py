@@ -0,0 +1,230 @@
+"""
+Writes files to the root directory of FAT12 and FAT16 filesystems, on block
+devices or image files, without mounting them. Used to copy firmware to the
+pico bootloader drive.
+"""
+import struct
+import time
+import os
+
+# 8.3 names of the files on the drive of the pico bootloader
+BOOTLOADER_FILES = ["INDEX.HTM", "INFO_UF2.TXT"]
+
+DIR_ENTRY_SIZE = 32
+ATTR_VOLUME_ID = 0x08
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+ENTRY_FREE = 0xE5
+ENTRY_END = 0x00
+
+class FatError(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+def short_name(name: str) -> bytes:
+    """Returns the 11 byte directory entry name of an 8.3 file name."""
+    base, _, ext = name.upper().partition(".")
+
+    if not base or len(base) > 8 or len(ext) > 3:
+        raise FatError(f"{name} is not an 8.3 name")
+
+    return base.ljust(8).encode("ascii") + ext.ljust(3).encode("ascii")
+
+def dos_timestamp(now: float=None) -> tuple[int, int]:
+    """Returns the FAT (time, date) of now."""
+    t = time.localtime(now)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+           ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class FatVolume:
+    """A FAT12 or FAT16 filesystem starting at offset 0 of fd. Only the root directory is supported,
+    which is all the pico bootloader drive has."""
+    def __init__(self, fd: int):
+        self.fd = fd
+
+        boot = os.pread(fd, 512, 0)
+
+        if len(boot) < 512 or boot[510:512] != b"\x55\xaa":
+            raise FatError("no boot sector signature")
+
+        self.sector_size, self.cluster_sectors, reserved, self.fats, self.root_entries, total16, _, \
+            fat_size = struct.unpack_from("<HBHBHHBH", boot, 11)
+        total32, = struct.unpack_from("<I", boot, 32)
+
+        if not self.sector_size or not self.cluster_sectors or not self.fats:
+            raise FatError("invalid bios parameter block")
+
+        if not fat_size:
+            raise FatError("FAT32 is not supported")
+
+        self.total_sectors = total16 if total16 else total32
+        self.cluster_size = self.sector_size * self.cluster_sectors
+
+        self.fat_offset = reserved * self.sector_size
+        self.fat_bytes = fat_size * self.sector_size
+        self.root_offset = self.fat_offset + self.fats * self.fat_bytes
+        root_sectors = (self.root_entries * DIR_ENTRY_SIZE + self.sector_size - 1) // self.sector_size
+        self.data_offset = self.root_offset + root_sectors * self.sector_size
+
+        data_sectors = self.total_sectors - self.data_offset // self.sector_size
+        self.clusters = data_sectors // self.cluster_sectors
+
+        if self.clusters < 4085:
+            self.bits = 12
+        elif self.clusters < 65525:
+            self.bits = 16
+        else:
+            raise FatError("FAT32 is not supported")
+
+        self.end_of_chain = 0xFFF if self.bits == 12 else 0xFFFF
+
+        # the data region holds clusters 2 to clusters + 1, which must also have entries in the FAT
+        self.clusters = min(self.clusters, self.fat_bytes * 8 // self.bits - 2)
+
+        self.fat = bytearray(os.pread(fd, self.fat_bytes, self.fat_offset))
+
+    def __getEntry(self, cluster: int) -> int:
+        if self.bits == 16:
+            return struct.unpack_from("<H", self.fat, cluster * 2)[0]
+
+        value, = struct.unpack_from("<H", self.fat, cluster * 3 // 2)
+        return value >> 4 if cluster & 1 else value & 0xFFF
+
+    def __setEntry(self, cluster: int, value: int):
+        if self.bits == 16:
+            struct.pack_into("<H", self.fat, cluster * 2, value)
+            return
+
+        offset = cluster * 3 // 2
+        current, = struct.unpack_from("<H", self.fat, offset)
+
+        if cluster & 1:
+            current = (current & 0x000F) | (value << 4)
+        else:
+            current = (current & 0xF000) | value
+
+        struct.pack_into("<H", self.fat, offset, current)
+
+    def __readRoot(self) -> bytes:
+        return os.pread(self.fd, self.root_entries * DIR_ENTRY_SIZE, self.root_offset)
+
+    def listRoot(self) -> list[str]:
+        """Returns the 8.3 names of the files and directories in the root directory, like os.listdir
+        on the mounted drive."""
+        root = self.__readRoot()
+        names = []
+
+        for offset in range(0, len(root), DIR_ENTRY_SIZE):
+            entry = root[offset:offset + DIR_ENTRY_SIZE]
+
+            if entry[0] == ENTRY_END:
+                break
+
+            if entry[0] == ENTRY_FREE or entry[11] == ATTR_LONG_NAME or entry[11] & ATTR_VOLUME_ID:
+                continue
+
+            base = entry[0:8].decode("ascii", "replace").rstrip()
+            ext = entry[8:11].decode("ascii", "replace").rstrip()
+            names.append(f"{base}.{ext}" if ext else base)
+
+        return sorted(names)
+
+    def __allocate(self, count: int) -> list[int]:
+        clusters = []
+
+        for cluster in range(2, self.clusters + 2):
+            if len(clusters) == count:
+                break
+
+            if self.__getEntry(cluster) == 0:
+                clusters.append(cluster)
+
+        if len(clusters) < count:
+            raise FatError("not enough free space")
+
+        return clusters
+
+    def __freeDirEntry(self, root: bytes) -> int:
+        for offset in range(0, len(root), DIR_ENTRY_SIZE):
+            if root[offset] in (ENTRY_END, ENTRY_FREE):
+                return offset
+
+        raise FatError("root directory is full")
+
+    def writeFile(self, name: str, data: bytes):
+        """Creates a file in the root directory holding data. The directory entry and FATs are written
+        before the contents, since the pico bootloader reboots as soon as it has received every block
+        of a uf2 file."""
+        entry_name = short_name(name)
+        root = self.__readRoot()
+        offset = self.__freeDirEntry(root)
+
+        count = (len(data) + self.cluster_size - 1) // self.cluster_size
+        clusters = self.__allocate(count)
+
+        for cluster, following in zip(clusters, clusters[1:] + [self.end_of_chain]):
+            self.__setEntry(cluster, following)
+
+        if clusters:
+            # only the sectors holding changed entries are written back
+            sector = self.sector_size
+            start = clusters[0] * self.bits // 8 // sector * sector
+            end = min((clusters[-1] * self.bits // 8 + 2 + sector - 1) // sector * sector, self.fat_bytes)
+
+            for fat in range(self.fats):
+                os.pwrite(self.fd, self.fat[start:end], self.fat_offset + fat * self.fat_bytes + start)
+
+        write_time, write_date = dos_timestamp()
+        first = clusters[0] if clusters else 0
+        entry = struct.pack("<11sBBBHHHHHHHI", entry_name, ATTR_ARCHIVE, 0, 0, write_time, write_date, write_date,
+                            0, write_time, write_date, first, len(data))
+        os.pwrite(self.fd, entry, self.root_offset + offset)
+
+        view = memoryview(data)
+        i = 0
+
+        # contiguous clusters are written with a single call
+        while i < len(clusters):
+            j = i
+            while j + 1 < len(clusters) and clusters[j + 1] == clusters[j] + 1:
+                j += 1
+
+            position = self.data_offset + (clusters[i] - 2) * self.cluster_size
+            chunk = view[i * self.cluster_size:(j + 1) * self.cluster_size]
+
+            while chunk:
+                written = os.pwrite(self.fd, chunk, position)
+                chunk = chunk[written:]
+                position += written
+
+            i = j + 1
+
+def write_bootloader_file(partition_path: str, name: str, data: bytes) -> bool:
+    """Writes data as name to the pico bootloader drive at partition_path without mounting it. Returns
+    False if the drive is not FAT12 or FAT16 or does not hold exactly the files of the bootloader.
+    Raises OSError if the partition can not be opened, and FatError if the file can not be written."""
+    fd = os.open(partition_path, os.O_RDWR)
+
+    try:
+        try:
+            volume = FatVolume(fd)
+        except FatError:
+            return False
+
+        if volume.listRoot() != BOOTLOADER_FILES:
+            return False
+
+        try:
+            volume.writeFile(name, data)
+        except OSError as e:
+            raise FatError(f"failed to write {name}: {e}")
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            # the bootloader may have rebooted once it had every block, before the cache was flushed
+            pass
+    finally:
+        os.close(fd)
+
+    return True
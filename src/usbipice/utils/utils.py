@@ -7,7 +7,9 @@ import re
 import subprocess
 import os
 import inspect
+import typing
 import types
+from itertools import repeat
 from configparser import ConfigParser
 
 from pexpect import fdpexpect
@@ -65,50 +67,100 @@ def get_ip() -> str:
     if group:
         return group.group(0)
 
-def typecheck(fn, args) -> bool:
-    """Checks whether args are valid types for fn. Only works on classes
-    and non nested list generics. For dict, only checks if arg is a dict."""
-    params = inspect.signature(fn).parameters.values()
-
-    if len(params) != len(args):
-        return False
-
-    for arg, param in zip(args, params):
-        annotation = param.annotation
-
-        if annotation is inspect._empty:
-            continue
-
-        if inspect.isclass(annotation):
-            if not isinstance(arg, annotation):
-                return False
-
-            continue
-
-        if not isinstance(annotation, types.GenericAlias):
+def _annotation_classes(annotation) -> tuple | None:
+    """Returns the classes of an annotation that is a class or a union of classes, otherwise None."""
+    if inspect.isclass(annotation) and not isinstance(annotation, types.GenericAlias):
+        return (annotation,)
+
+    if typing.get_origin(annotation) in (types.UnionType, typing.Union):
+        args = typing.get_args(annotation)
+        if all(inspect.isclass(arg) and not isinstance(arg, types.GenericAlias) for arg in args):
+            return args
+
+    return None
+
+def compile_validator(annotation):
+    """Returns a function that checks whether a value matches annotation, or None if any value
+    matches. Supports classes, unions and list/dict generics, which may be nested. Raises TypeError
+    for other annotations."""
+    if annotation is inspect.Parameter.empty or annotation is typing.Any:
+        return None
+
+    # plain classes are checked with a single isinstance call
+    if (classes := _annotation_classes(annotation)):
+        return lambda value : isinstance(value, classes)
+
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin is types.UnionType or origin is typing.Union:
+        validators = [compile_validator(arg) for arg in args]
+        if None in validators:
+            return None
+
+        return lambda value : any(validator(value) for validator in validators)
+
+    if origin is list and len(args) == 1:
+        if (classes := _annotation_classes(args[0])):
+            return lambda value : isinstance(value, list) and all(map(isinstance, value, repeat(classes)))
+
+        item = compile_validator(args[0])
+        if not item:
+            return lambda value : isinstance(value, list)
+
+        return lambda value : isinstance(value, list) and all(map(item, value))
+
+    if origin is dict and len(args) == 2:
+        key = compile_validator(args[0])
+        item = compile_validator(args[1])
+        if not key and not item:
+            return lambda value : isinstance(value, dict)
+
+        key_classes = _annotation_classes(args[0])
+        item_classes = _annotation_classes(args[1])
+        if key_classes and item_classes:
+            return lambda value : (
+                isinstance(value, dict)
+                and all(map(isinstance, value.keys(), repeat(key_classes)))
+                and all(map(isinstance, value.values(), repeat(item_classes)))
+            )
+
+        key = key if key else lambda _ : True
+        item = item if item else lambda _ : True
+        return lambda value : isinstance(value, dict) and all(map(key, value.keys())) and all(map(item, value.values()))
+
+    raise TypeError(f"unsupported annotation {annotation}")
+
+def compile_typecheck(fn):
+    """Compiles a typecheck for the arguments of fn. Returns a function that takes a sequence of
+    arguments and returns whether they are valid types for fn. See compile_validator for the
+    supported annotations. String annotations are evaluated."""
+    params = inspect.signature(fn, eval_str=True).parameters.values()
+    validators = [(i, validator) for i, param in enumerate(params) if (validator := compile_validator(param.annotation))]
+    length = len(params)
+
+    def check(args) -> bool:
+        if len(args) != length:
             return False
 
-        if annotation.__origin__ is dict:
-            continue
+        for i, validator in validators:
+            if not validator(args[i]):
+                return False
 
-        if annotation.__origin__ is not list or not isinstance(arg, list):
-            return False
+        return True
 
-        if len(annotation.__args__) != 1:
-            return False
+    return check
 
-        type_ = annotation.__args__[0]
-
-        for value in arg:
-            if not isinstance(value, type_):
-                return False
-
-    return True
+def typecheck(fn, args) -> bool:
+    """Checks whether args are valid types for fn. Compiles the check on every call, use
+    compile_typecheck for repeated checks."""
+    return compile_typecheck(fn)(args)
 
 def json_to_args(json, parameters):
+    """Returns the values of parameters in json, or None if any of them are missing."""
     values = list(map(json.get, parameters))
-    if any(map(lambda x : x is None, parameters)):
-        return False
+    if None in values:
+        return None
 
     return values
 
@@ -1,22 +1,108 @@
 import asyncio
+import contextvars
 import inspect
+import json
+import time
 from functools import wraps
 
-from flask import Response, jsonify, request
+from flask import Flask, Response, jsonify, request
 from socketio import AsyncServer
 
-from usbipice.utils.utils import json_to_args, typecheck
+from usbipice.utils.utils import json_to_args, compile_typecheck
+
+_remote_addr = contextvars.ContextVar("remote_addr", default=None)
+
+def remote_addr() -> str:
+    """Address of the client of the current request, for both flask and asgi handlers."""
+    addr = _remote_addr.get()
+    if addr is not None:
+        return addr
+
+    return request.remote_addr
+
+def nonblocking(func):
+    """Marks a handler as safe to run on the event loop. Handlers that are not marked are run in
+    the loop's executor by the asgi handlers of inject_and_return_json and return_json. Should be
+    applied before either of them."""
+    func.nonblocking = True
+    return func
+
+def _to_flask(res) -> Response:
+    if res is True or res is None:
+        return Response(status=200)
+    if res is False:
+        return Response(status=500)
+    if isinstance(res, Response):
+        return res
+
+    return jsonify(res)
+
+async def _send_asgi(send, res):
+    """Sends the result of a handler with the same status semantics as _to_flask."""
+    if res is True or res is None:
+        status, headers, body = 200, [], b""
+    elif res is False:
+        status, headers, body = 500, [], b""
+    elif isinstance(res, Response):
+        status = res.status_code
+        headers = [(key.lower().encode(), value.encode()) for key, value in res.headers.items()
+                   if key.lower() != "content-length"]
+        body = res.get_data()
+    else:
+        status = 200
+        headers = [(b"content-type", b"application/json")]
+        body = json.dumps(res).encode()
+
+    headers.append((b"content-length", str(len(body)).encode()))
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+async def _receive_body(receive) -> bytes:
+    body = b""
+
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def _call_async(func, args):
+    """Calls func on the loop if it is nonblocking, otherwise in the loop's executor with the
+    caller's context."""
+    if getattr(func, "nonblocking", False):
+        return func(*args)
+
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, lambda : context.run(func, *args))
+
+async def _call_asgi(func, scope, args):
+    """Calls func with _call_async. remote_addr() is available in both cases."""
+    client = scope.get("client")
+    token = _remote_addr.set(client[0] if client else "")
+
+    try:
+        return await _call_async(func, args)
+    finally:
+        _remote_addr.reset(token)
 
 def inject_and_return_json(func):
-    """Injects request json values into arguments. Uses argument names as the json key. Typechecks arguments,
-    only classes are supported. Returns a status=400 if a key is missing or the typecheck fails.
-    Returns status=200 on True and status=500 on false. Otherwise, returns flask.jsonify of the result."""
+    """Injects request json values into arguments. Uses argument names as the json key. Typechecks arguments
+    with a check compiled from the annotations of func, see compile_validator. Returns a status=400 if a key is missing or the typecheck fails.
+    Returns status=200 on True and status=500 on false. If the result is a flask.Response, it is returned
+    as is. Otherwise, returns flask.jsonify of the result. The wrapper also has an asgi_handler attribute
+    that does the same without flask, for use with AsyncRouter."""
     parameter_strings = [] # func args as string
     parameters = inspect.signature(func).parameters.values()
 
     for param in parameters:
         parameter_strings.append(param.name)
 
+    check = compile_typecheck(func)
+
     @wraps(func)
     def handler_wrapper(*args):
         if request.content_type != "application/json":
@@ -28,19 +114,139 @@ def inject_and_return_json(func):
 
         args = json_to_args(json, parameter_strings)
 
-        if not typecheck(func, args):
+        if args is None or not check(args):
             return Response(status=400)
 
-        res = func(*args)
+        return _to_flask(func(*args))
+
+    async def asgi_handler(scope, receive, send):
+        body = await _receive_body(receive)
+        if body is None:
+            return
+
+        content_type = dict(scope["headers"]).get(b"content-type")
+        if content_type != b"application/json":
+            return await _send_asgi(send, Response(status=400))
+
+        try:
+            data = json.loads(body)
+        except Exception:
+            return await _send_asgi(send, Response(status=400))
+
+        if not isinstance(data, dict):
+            return await _send_asgi(send, Response(status=400))
+
+        args = json_to_args(data, parameter_strings)
+
+        if args is None or not check(args):
+            return await _send_asgi(send, Response(status=400))
+
+        await _send_asgi(send, await _call_asgi(func, scope, args))
+
+    handler_wrapper.asgi_handler = asgi_handler
+    return handler_wrapper
+
+def return_json(func):
+    """Wrapper for handlers without arguments, with the same status semantics as inject_and_return_json.
+    Also provides an asgi_handler for use with AsyncRouter."""
+    @wraps(func)
+    def handler_wrapper():
+        return _to_flask(func())
+
+    async def asgi_handler(scope, receive, send):
+        await _send_asgi(send, await _call_asgi(func, scope, ()))
+
+    handler_wrapper.asgi_handler = asgi_handler
+    return handler_wrapper
+
+class AsyncRouter:
+    """ASGI app that serves the views of a flask app that have an asgi_handler directly on the event
+    loop, see inject_and_return_json. All other requests are passed to fallback, usually the flask
+    app wrapped in WsgiToAsgi. Should be created after all routes are registered."""
+    def __init__(self, app: Flask, fallback):
+        self.fallback = fallback
+        self.routes = {}
+
+        for rule in app.url_map.iter_rules():
+            handler = getattr(app.view_functions.get(rule.endpoint), "asgi_handler", None)
+
+            # only static paths, flask handles the rest
+            if not handler or rule.arguments:
+                continue
+
+            for method in rule.methods - {"HEAD", "OPTIONS"}:
+                self.routes[(method, rule.rule)] = handler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            handler = self.routes.get((scope["method"], scope["path"]))
+            if handler:
+                return await handler(scope, receive, send)
+
+        return await self.fallback(scope, receive, send)
+
+def inject_and_return_ack(func):
+    """Socket equivalent of inject_and_return_json, for use with acknowledged events. The event data
+    should be a dict of {id, args}, where args is injected into the arguments in the same way as
+    the request json. Returns the acknowledgement as {id, status, data}, using the same status semantics
+    as inject_and_return_json. With flask_socketio.SocketIO, the returned handler should then be wrapped
+    with flask_socketio_adapter_on. The wrapper also has an async_handler attribute for use with
+    socketio.AsyncServer, which runs func in the loop's executor unless it is marked nonblocking."""
+    parameter_strings = [] # func args as string
+    parameters = inspect.signature(func).parameters.values()
+
+    for param in parameters:
+        parameter_strings.append(param.name)
+
+    check = compile_typecheck(func)
+
+    def parse(data):
+        """Returns (id, args), or (id, None) if the event data is invalid."""
+        if not isinstance(data, dict):
+            return None, None
+
+        req_id = data.get("id")
+        json = data.get("args")
+
+        if not isinstance(json, dict):
+            return req_id, None
+
+        args = json_to_args(json, parameter_strings)
+
+        if args is None or not check(args):
+            return req_id, None
+
+        return req_id, args
+
+    def ack(req_id, res):
         if res is True or res is None:
-            return Response(status=200)
+            return {"id": req_id, "status": 200}
         if res is False:
-            return Response(status=500)
+            return {"id": req_id, "status": 500}
+        if isinstance(res, Response):
+            return {"id": req_id, "status": res.status_code}
 
-        return jsonify(res)
+        return {"id": req_id, "status": 200, "data": res}
 
-    return handler_wrapper
+    @wraps(func)
+    def handler_wrapper(sid, data):
+        req_id, args = parse(data)
+
+        if args is None:
+            return {"id": req_id, "status": 400}
+
+        return ack(req_id, func(*args))
 
+    async def async_handler(sid, data):
+        req_id, args = parse(data)
+
+        if args is None:
+            return {"id": req_id, "status": 400}
+
+        return ack(req_id, await _call_async(func, args))
+
+    handler_wrapper.async_handler = async_handler
+    return handler_wrapper
 
 def flask_socketio_adapter_connect(func):
     """Adapter to allow flask_socketio.SocketIO eventhandlers to use the same interface as
@@ -72,9 +278,47 @@ def flask_socketio_adapter_on(func):
 
 class SyncAsyncServer(AsyncServer):
     """Adapter to allow flask_socketio.SocketIO to have the same interface as socketio.AsyncServer while
-    running as an ASGI app"""
+    running as an ASGI app. Calls made from other threads are run on the event loop the server is
+    running on and wait for the result. Calls made from the event loop itself are scheduled as tasks,
+    since they can't block the loop, and return the task so callers can check whether the call failed.
+    The loop is recorded by bind_loop, or on the first call made from inside of it."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop: asyncio.AbstractEventLoop = None
+        self.tasks = set()
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop=None):
+        """Records the event loop the server runs on. Can be used as the on_startup
+        callback of socketio.ASGIApp."""
+        self.loop = loop if loop else asyncio.get_running_loop()
+
+    def __run(self, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running:
+            if not self.loop:
+                self.loop = running
+
+            task = running.create_task(coro)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return task
+
+        if self.loop and self.loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+        # not running under a server yet
+        return asyncio.run(coro)
+
     def emit(self, event, data=None, to=None, room=None, skip_sid=None, namespace=None, callback=None, ignore_queue=False):
-        return asyncio.run(super().emit(event, data, to, room, skip_sid, namespace, callback, ignore_queue))
+        return self.__run(super().emit(event, data, to, room, skip_sid, namespace, callback, ignore_queue))
 
     def sleep(self, seconds=0):
-        return asyncio.run(super().sleep(seconds))
+        """Sleeps the calling thread. Does nothing when called from the event loop."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            time.sleep(seconds)
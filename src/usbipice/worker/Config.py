@@ -40,3 +40,19 @@ class Config:
 
         self.default_firmware_path = config_else_env("USBIPICE_DEFAULT", "Firmware", parser)
         self.pulse_firmware_path = config_else_env("USBIPICE_PULSE_COUNT", "Firmware", parser)
+
+        self.device_workers = int(config_else_env("USBIPICE_DEVICE_WORKERS", "Devices", parser, default="16"))
+        self.device_shards = int(config_else_env("USBIPICE_DEVICE_SHARDS", "Devices", parser, default="1"))
+        self.request_workers = int(config_else_env("USBIPICE_REQUEST_WORKERS", "Devices", parser, default="8"))
+        self.request_queue = int(config_else_env("USBIPICE_REQUEST_QUEUE", "Devices", parser, default="32"))
+        self.probe_on_start = config_else_env("USBIPICE_PROBE_ON_START", "Devices", parser, default="true").lower() == "true"
+
+        self.flash_concurrency = int(config_else_env("USBIPICE_FLASH_CONCURRENCY", "Flashing", parser, default="8"))
+        self.flash_per_hub = int(config_else_env("USBIPICE_FLASH_PER_HUB", "Flashing", parser, default="4"))
+
+        self.event_batch_size = int(config_else_env("USBIPICE_EVENT_BATCH_SIZE", "Events", parser, default="50"))
+        self.event_linger = int(config_else_env("USBIPICE_EVENT_LINGER_MS", "Events", parser, default="10")) / 1000
+        self.event_memory = int(config_else_env("USBIPICE_EVENT_MEMORY_KB", "Events", parser, default="1024")) * 1024
+        self.event_spill = int(config_else_env("USBIPICE_EVENT_SPILL_MB", "Events", parser, default="64")) * 1024 * 1024
+        self.event_spill_path = config_else_env("USBIPICE_EVENT_SPILL_DIR", "Events", parser, default="event_spill")
+        self.event_drop_policy = config_else_env("USBIPICE_EVENT_DROP_POLICY", "Events", parser, default="drop_oldest")
@@ -20,10 +20,16 @@ class WorkerDataBaseLogger(LoggerAdapter):
 # TODO use __execute
 class WorkerDatabase(Database):
     """Provides access to database operations related to the worker process."""
-    def __init__(self, config: Config, logger):
+    def __init__(self, config: Config, logger, register: bool=True):
+        """If register is False, the worker is assumed to be added by another process, which also
+        removes it on exit."""
         super().__init__(config.libpg_string)
         self.worker_name = config.worker_name
         self.logger = WorkerDataBaseLogger(logger)
+        self.registered = register
+
+        if not register:
+            return
 
         try:
             with psycopg.connect(self.url) as conn:
@@ -62,6 +68,9 @@ class WorkerDatabase(Database):
 
     def onExit(self):
         """Removes the worker and all related devices from the database."""
+        if not self.registered:
+            return
+
         try:
             with psycopg.connect(self.url) as conn:
                 with conn.cursor() as cur:
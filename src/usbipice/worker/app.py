@@ -3,18 +3,19 @@ import os
 import logging
 import sys
 import threading
-import json
 
-from flask import Flask, Response
+from flask import Flask
 from flask_socketio import SocketIO
 from socketio import ASGIApp
 from asgiref.wsgi import WsgiToAsgi
 
 from usbipice.utils.web import SyncAsyncServer, flask_socketio_adapter_connect, flask_socketio_adapter_on, inject_and_return_json
-from usbipice.worker.device import DeviceManager
+from usbipice.utils.web import AsyncRouter, nonblocking, return_json
+from usbipice.worker.device import DeviceManager, ShardedDeviceManager
 from usbipice.worker import Config, EventSender
 
-from usbipice.utils import RemoteLogger
+from usbipice.utils import RemoteLogger, KeyedExecutor
+from usbipice.utils.codec import JSON, choose_codec, decode
 
 # 100 bitstreams
 MAX_REQUEST_SIZE = 104.2 * 8000 * 100
@@ -22,23 +23,49 @@ MAX_REQUEST_SIZE = 104.2 * 8000 * 100
 def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config, logger: logging.Logger):
     logger = RemoteLogger(logger, config.control_server_url, config.worker_name)
 
-    event_sender = EventSender(socketio, config.libpg_string, logger)
-    manager = DeviceManager(event_sender, config, logger)
+    event_sender = EventSender(socketio, config.libpg_string, logger,
+                               max_batch_size=config.event_batch_size, linger=config.event_linger,
+                               max_queue_bytes=config.event_memory, max_spill_bytes=config.event_spill,
+                               spill_path=config.event_spill_path, drop_policy=config.event_drop_policy)
+    if config.device_shards > 1:
+        manager = ShardedDeviceManager(event_sender, config, logger, config.device_shards)
+        # calls to the manager wait on a shard process, keep them off the event loop
+        manager_call = lambda fn : fn
+        # requests are forwarded in the order each client sent them
+        forwarder = KeyedExecutor(logger, workers=config.request_workers, limit=config.request_queue,
+                                  name="shard-request-forwarder")
+    else:
+        manager = DeviceManager(event_sender, config, logger)
+        manager_call = nonblocking
+        forwarder = None
 
     sock_id_to_client_id = {}
     id_lock = threading.Lock()
 
     @app.get("/heartbeat")
+    @return_json
+    @nonblocking
     def heartbeat():
-        return Response(status=200)
+        return True
+
+    @app.get("/metrics")
+    @return_json
+    @manager_call
+    def metrics():
+        return {
+            "devices": manager.stats(),
+            "events": event_sender.stats()
+        }
 
     @app.get("/reserve")
     @inject_and_return_json
+    @manager_call
     def reserve(serial: str, kind: str, args: dict):
         return manager.reserve(serial, kind, args)
 
     @app.get("/unreserve")
     @inject_and_return_json
+    @manager_call
     def devices_bus(serial: str):
         return manager.unreserve(serial)
 
@@ -53,7 +80,7 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
         with id_lock:
             sock_id_to_client_id[sid] = client_id
 
-        event_sender.addSocket(sid, client_id)
+        event_sender.addSocket(sid, client_id, batching=bool(auth.get("batching")), resume=auth.get("resume"))
 
     @socketio.on("disconnect")
     @flask_socketio_adapter_on
@@ -67,6 +94,20 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
 
         event_sender.removeSocket(client_id)
 
+    @socketio.on("codec")
+    @flask_socketio_adapter_on
+    def codec(sid, codecs):
+        """Picks the codec of batched frames sent to the socket from the codecs the client supports."""
+        with id_lock:
+            client_id = sock_id_to_client_id.get(sid)
+
+        if not client_id:
+            return JSON
+
+        chosen = choose_codec(codecs)
+        event_sender.setCodec(client_id, chosen)
+        return chosen
+
     @socketio.on("request")
     @flask_socketio_adapter_on
     def handle(sid, data):
@@ -78,9 +119,13 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
             return
 
         try:
-            data = json.loads(data)
+            data = decode(data)
         except Exception:
-            logger.error(f"failed to load json string from client {client_id}")
+            logger.error(f"failed to decode request from client {client_id}")
+            return
+
+        if not isinstance(data, dict):
+            logger.error(f"bad request packet from client {client_id}")
             return
 
         serial = data.get("serial")
@@ -91,13 +136,33 @@ def create_app(app: Flask, socketio: SocketIO | SyncAsyncServer, config: Config,
             logger.error(f"bad request packet from client {client_id}")
             return
 
-        if isinstance(serial, list):
-            for s in serial:
-                thread = threading.Thread(target=lambda : manager.handleRequest(s, event, contents), name="socket-request")
-                thread.start()
+        serials = serial if isinstance(serial, list) else [serial]
+
+        if not all(isinstance(s, str) for s in serials):
+            logger.error(f"bad request packet from client {client_id}")
+            return
+
+        if forwarder:
+            if forwarder.submit(client_id, submit, client_id, serials, event, contents):
+                return
+
+            for s in serials:
+                reject(client_id, s, event)
+            return
+
+        submit(client_id, serials, event, contents)
+
+    def submit(client_id: str, serials: list[str], event: str, contents: dict):
+        for s in serials:
+            if not manager.submitRequest(s, event, contents):
+                reject(client_id, s, event)
 
-        else:
-            manager.handleRequest(serial, event, contents)
+    def reject(client_id: str, serial: str, event: str):
+        logger.warning(f"request queue of {serial} full, rejected {event} from client {client_id}")
+        event_sender.sendClientJson(serial, client_id, {
+            "event": "request rejected",
+            "request": event
+        })
 
 def run_debug():
     logger = logging.getLogger(__name__)
@@ -130,9 +195,9 @@ def run_uvicorn():
     app = Flask(__name__)
     socketio = SyncAsyncServer(async_mode="asgi", max_http_buffer_size=MAX_REQUEST_SIZE)
     create_app(app, socketio, config, logger)
-    app = WsgiToAsgi(app)
+    app = AsyncRouter(app, WsgiToAsgi(app))
 
-    return ASGIApp(socketio, app)
+    return ASGIApp(socketio, app, on_startup=socketio.bind_loop)
 
 if __name__ == "__main__":
     run_debug()
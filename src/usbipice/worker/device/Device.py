@@ -1,9 +1,11 @@
 from __future__ import annotations
+from collections import deque
 from pathlib import Path
 from logging import Logger, LoggerAdapter
 import threading
 
 from usbipice.worker.device import DeviceEventSender
+from usbipice.worker.device.DeviceStore import DeviceStore, firmware_digest
 from usbipice.worker.device.state.core import FlashState, TestState
 from usbipice.worker.device.state.reservable import get_reservation_state_fac
 
@@ -34,34 +36,84 @@ class Device:
         self._device: AbstractState = None
         self._device_lock = threading.RLock()
 
+        # amount of scheduled transitions that have not finished, calls to the state are buffered
+        # until it is back to 0 and then replayed into the new state
+        self._transitions = 0
+        self._buffered: deque = deque()
+        self._replaying = False
+        # only guards the fields above, never held while calling into a state
+        self._pending_lock = threading.Lock()
+
         self.path = Path(WORKER_MEDIA).joinpath(self.serial)
 
         self.path.joinpath("mount").mkdir(parents=True, exist_ok=True)
         self.path.joinpath("media").mkdir(exist_ok=True)
 
-        self.__flashDefault()
+        self.store = DeviceStore(self.path.joinpath("state.json"), self.logger)
 
-    def __flashDefault(self):
+        if self.config.probe_on_start and self.__defaultFirmwareLoaded():
+            self.logger.info("default firmware unchanged since last run, probing")
+            self.switch(lambda : TestState(self, timeout=5, fallback_factory=self.__defaultFlashState))
+        else:
+            self.__flashDefault()
+
+    def __defaultFirmwareLoaded(self) -> bool:
+        """Whether the device was last known to be ready with the current default firmware."""
+        if self.store.get("state") != "ReadyState":
+            return False
+
+        firmware = self.store.get("firmware")
+        return firmware is not None and firmware == firmware_digest(self.config.default_firmware_path)
+
+    def __defaultFlashState(self) -> AbstractState:
         self.database.updateDeviceStatus(self.serial, "flashing_default")
-        self.switch(lambda : FlashState(self, self.config.default_firmware_path, lambda : TestState(self), timeout=60))
+        return FlashState(self, self.config.default_firmware_path, lambda : TestState(self), timeout=60)
 
-    def handleDeviceEvent(self, action, dev):
+    def __flashDefault(self):
+        self.switch(self.__defaultFlashState)
+
+    def __deliver(self, fn, *args):
+        """Calls fn(state, *args) on the current state, or buffers the call while a transition is
+        pending."""
+        with self._pending_lock:
+            # calls also wait behind a replay, so they reach the state in the order they were received
+            if self._transitions or self._replaying:
+                self._buffered.append((fn, args))
+                return
+
+        self.__call(fn, args)
+
+    def __call(self, fn, args):
         with self._device_lock:
             if not self._device:
                 return
 
             with self._device.switching_lock:
-                self.logger.debug(f"device {dev["DEVPATH"]}")
+                return fn(self._device, *args)
 
-                if action == "add":
-                    self._device.handleAdd(dev)
-                    return
+    def handleDeviceEvent(self, action, dev):
+        self.__deliver(self.__handleDeviceEvent, action, dev)
 
-                if action == "remove":
-                    self._device.handleRemove(dev)
-                    return
+    def __handleDeviceEvent(self, state: AbstractState, action, dev):
+        self.logger.debug(f"device {dev["DEVPATH"]}")
 
-                self.logger.warning(f"unhandled device action: {action}")
+        if action == "add":
+            state.handleAdd(dev)
+            return
+
+        if action == "remove":
+            state.handleRemove(dev)
+            return
+
+        self.logger.warning(f"unhandled device action: {action}")
+
+    def handleStateCallback(self, state: AbstractState, fn):
+        """Calls fn if state is still the current state, holding the same locks as device events."""
+        def call(current: AbstractState):
+            if current is state and not state.switching:
+                fn()
+
+        self.__deliver(call)
 
     def handleReserve(self, kind, args):
         fn = get_reservation_state_fac(self, kind, args)
@@ -77,8 +129,7 @@ class Device:
         return True
 
     def handleRequest(self, event, json):
-        with self._device_lock:
-            self._device.handleRequest(event, json)
+        self.__deliver(lambda state : state.handleRequest(event, json))
 
     def handleExit(self):
         with self._device_lock:
@@ -86,12 +137,56 @@ class Device:
                 self._device.handleExit()
 
     def switch(self, state_factory):
-        with self._device_lock:
-            if self._device:
-                self._device.handleExit()
-            device = state_factory()
-            self._device = device
-            self._device.start()
+        """Schedules a transition to the state returned by state_factory behind the device's queued
+        events and returns. Events and requests received until the new state has started are buffered
+        and replayed into it in order."""
+        with self._pending_lock:
+            self._transitions += 1
+
+        self.manager.executor.submit(self.serial, self.__switch, state_factory)
+
+    def __switch(self, state_factory):
+        try:
+            with self._device_lock:
+                if self._device:
+                    # a replaced state can't schedule further transitions
+                    with self._device.switching_lock:
+                        self._device._switching = True
+
+                    self._device.handleExit()
+                    self._device = None
+
+                device = state_factory()
+                self._device = device
+                self.store.update(state=type(device).__name__)
+                self._device.start()
+        finally:
+            with self._pending_lock:
+                self._transitions -= 1
+
+            self.__replay()
+
+    def __replay(self):
+        """Calls the buffered calls in order once no transition is pending. A replayed call may schedule
+        another transition, the rest then waits for it."""
+        with self._pending_lock:
+            if self._replaying:
+                return
+
+            self._replaying = True
+
+        while True:
+            with self._pending_lock:
+                if self._transitions or not self._buffered:
+                    self._replaying = False
+                    return
+
+                fn, args = self._buffered.popleft()
+
+            try:
+                self.__call(fn, args)
+            except Exception as e:
+                self.logger.error(f"exception while replaying buffered call: {e}")
 
     @property
     def config(self) -> Config:
@@ -2,12 +2,12 @@ from __future__ import annotations
 from logging import Logger, LoggerAdapter
 import threading
 import atexit
-
-import pyudev
+import zlib
 
 from usbipice.utils.dev import *
+from usbipice.utils import KeyedExecutor, UdevBus, get_udev_bus, get_device_index
 from usbipice.worker import WorkerDatabase
-from usbipice.worker.device import Device
+from usbipice.worker.device import Device, FlashScheduler
 
 import typing
 if typing.TYPE_CHECKING:
@@ -20,14 +20,30 @@ class ManagerLogger(LoggerAdapter):
     def process(self, msg, kwargs):
         return f"[DeviceManager] {msg}", kwargs
 
+def shard_of(serial: str, shards: int) -> int:
+    """Returns the shard that owns serial. Stable across processes and restarts."""
+    return zlib.crc32(serial.encode()) % shards
+
 class DeviceManager:
     """Tracks device events and routes them to their corresponding Device object. Also listens to kernel
-    device events to identify usbip disconnects."""
-    def __init__(self, event_sender: EventSender, config: Config, logger: Logger):
+    device events to identify usbip disconnects. Events and client requests are handled on bounded pools
+    of threads, in the order they were received for each device. When running as one of several shards,
+    only devices with shard_of(serial, shards) == shard are managed. If bus is given, events are
+    taken from it instead of the process udev bus and connected devices are not scanned, which allows
+    replaying recorded events with a stand in database."""
+    def __init__(self, event_sender: EventSender, config: Config, logger: Logger, shard: int=0, shards: int=1,
+                 bus: UdevBus=None, database: WorkerDatabase=None):
         self.config: Config = config
         self.logger: Logger = ManagerLogger(logger)
         self.event_sender: EventSender = event_sender
-        self.database: WorkerDatabase = WorkerDatabase(config, self.logger)
+        self.shard = shard
+        self.shards = shards
+
+        if not database:
+            # shards share the worker registered by the parent process
+            database = WorkerDatabase(config, self.logger, register=shards == 1)
+
+        self.database: WorkerDatabase = database
 
         atexit.register(self.onExit)
 
@@ -36,52 +52,68 @@ class DeviceManager:
 
         self.exiting: bool = False
 
-        context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context)
-        monitor.filter_by("tty")
-        monitor.filter_by("block")
+        self.executor = KeyedExecutor(self.logger, workers=config.device_workers, name="dev-event-handler")
+        self.requests = KeyedExecutor(self.logger, workers=config.request_workers, limit=config.request_queue,
+                                      name="dev-request-handler")
+        self.flash_scheduler = FlashScheduler(self.logger, max_flashing=config.flash_concurrency,
+                                              max_per_hub=config.flash_per_hub)
 
-        observer = pyudev.MonitorObserver(monitor, self.handleDevEvent, name="manager-userevents")
-        observer.start()
+        scan = bus is None
+        if not bus:
+            # the index subscribes when created, and must see an event before the devices handling it look it up
+            get_device_index()
+            bus = get_udev_bus()
 
-        self.scan()
+        self.subscriptions = [bus.subscribe(self.handleDevEvent, subsystem=subsystem) for subsystem in ("tty", "block")]
+
+        if scan:
+            self.scan()
 
     def scan(self):
         """Trigger add events for devices that are already connected."""
         self.logger.info("Scanning for devices")
-        context = pyudev.Context().list_devices()
+        index = get_device_index()
 
-        for dev in context:
-            self.handleDevEvent("add", dev)
+        for serial in index.serialsAvailable():
+            for dev in index.get(serial):
+                self.handleDevEvent("add", dev)
 
         self.logger.info("Finished scan")
 
-    def handleDevEvent(self, action: str, dev: pyudev.Device):
+    def handleDevEvent(self, action: str, dev: dict):
         """Ensures that a device is related to pico2ice and reroutes the event to handleAddDevice or
         handleRemoveDevice."""
         if self.exiting:
             return
 
-        if dev.properties.get("ID_VENDOR_ID") not in ["2e8a", "1209"]:
+        if dev.get("ID_VENDOR_ID") not in ["2e8a", "1209"]:
             return
 
-        dev = dict(dev)
-
         serial = get_serial(dev)
 
         if not serial:
             return
 
+        if self.shards > 1 and shard_of(serial, self.shards) != self.shard:
+            return
+
         with self._dev_lock:
             device = self._devs.get(serial)
 
             if not device:
                 self.database.addDevice(serial)
-                device = Device(serial, self, self.event_sender, self.database, self.logger)
+                device = self.createDevice(serial)
                 self._devs[serial] = device
 
-        thread = threading.Thread(target=lambda : device.handleDeviceEvent(action, dev), name="dev-event-handler")
-        thread.start()
+        self.executor.submit(serial, device.handleDeviceEvent, action, dev)
+
+    def createDevice(self, serial: str) -> Device:
+        """Creates the Device of a newly seen serial."""
+        return Device(serial, self, self.event_sender, self.database, self.logger)
+
+    def submitRequest(self, serial: str, event: str, contents: dict) -> bool:
+        """Queues a request for serial. Returns False if the request queue of serial is full."""
+        return self.requests.submit(serial, self.handleRequest, serial, event, contents)
 
     def handleRequest(self, serial: str, event: str, contents: dict):
         with self._dev_lock:
@@ -112,11 +144,27 @@ class DeviceManager:
 
         return dev.handleUnreserve()
 
+    def stats(self) -> dict:
+        """Returns the amount of device events and requests waiting or being handled per device, and
+        the devices flashing or waiting to flash."""
+        return {
+            "events": self.executor.stats(),
+            "requests": self.requests.stats(),
+            "flashing": self.flash_scheduler.stats()
+        }
+
     def onExit(self):
         """Callback for cleanup on program exit"""
         with self._dev_lock:
+            if self.exiting:
+                return
+
+            self.exiting = True
             devs = list(self._devs.values())
 
+        for subscription in self.subscriptions:
+            subscription.unsubscribe()
+
         for dev in devs:
             dev.handleExit()
 
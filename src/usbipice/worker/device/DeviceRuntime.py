@@ -0,0 +1,64 @@
+from __future__ import annotations
+from concurrent.futures import Future
+import threading
+import logging
+import asyncio
+
+class DeviceRuntimeLogger(logging.LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[DeviceRuntime] {msg}", kwargs
+
+class DeviceRuntime:
+    """A single asyncio event loop on a dedicated thread, shared by every AsyncAbstractState of the
+    worker. Blocking work should be moved off the loop with runBlocking."""
+    def __init__(self, logger: logging.Logger=None):
+        self.logger = DeviceRuntimeLogger(logger if logger else logging.getLogger(__name__))
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_exception_handler(self.__handleException)
+
+        self.thread = threading.Thread(target=self.__run, name="device-runtime", daemon=True)
+        self.thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def __handleException(self, loop, context):
+        self.logger.error(f"{context.get('message')}: {context.get('exception')}")
+
+    def submit(self, coro) -> Future:
+        """Runs coro on the loop. Safe to call from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, fn, *args):
+        """Calls fn(*args) on the loop. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def inLoop(self) -> bool:
+        """Whether the caller is running on the loop thread."""
+        return threading.current_thread() is self.thread
+
+    async def runBlocking(self, fn, *args):
+        """Runs fn(*args) in the loop's executor and returns its result."""
+        return await self.loop.run_in_executor(None, fn, *args)
+
+    def stats(self) -> dict:
+        return {
+            "tasks": len(asyncio.all_tasks(self.loop))
+        }
+
+_device_runtime = None
+_device_runtime_lock = threading.Lock()
+
+def get_device_runtime() -> DeviceRuntime:
+    """Returns the DeviceRuntime shared by the process."""
+    global _device_runtime
+
+    with _device_runtime_lock:
+        if not _device_runtime:
+            _device_runtime = DeviceRuntime()
+
+        return _device_runtime
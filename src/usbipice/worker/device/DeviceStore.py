@@ -0,0 +1,78 @@
+from __future__ import annotations
+from logging import Logger
+from pathlib import Path
+import threading
+import hashlib
+import json
+import os
+
+_digests: dict[str, tuple[int, int, str]] = {}
+_digests_lock = threading.Lock()
+
+def firmware_digest(path: str) -> str:
+    """Returns the sha256 of a firmware file, or None if it can't be read. Digests are cached until
+    the file's size or modification time changes."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    with _digests_lock:
+        cached = _digests.get(path)
+
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+    digest = hashlib.sha256()
+
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda : f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+
+    with _digests_lock:
+        _digests[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+
+    return digest.hexdigest()
+
+class DeviceStore:
+    """Last known firmware and state of a device, kept as a small json file so that a restarted
+    worker can tell whether the device still needs to be reflashed. Writes replace the file
+    atomically, so a crash leaves either the old or the new record."""
+    def __init__(self, path: Path, logger: Logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.record = self.__load()
+
+    def __load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            self.logger.warning(f"ignoring unreadable device store {self.path}")
+            return {}
+
+        return record if isinstance(record, dict) else {}
+
+    def get(self, key: str):
+        with self.lock:
+            return self.record.get(key)
+
+    def update(self, **values):
+        """Sets values and writes the record to disk."""
+        with self.lock:
+            self.record.update(values)
+            tmp = self.path.with_suffix(".tmp")
+
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(self.record, f)
+
+                os.replace(tmp, self.path)
+            except OSError:
+                self.logger.warning(f"failed to write device store {self.path}")
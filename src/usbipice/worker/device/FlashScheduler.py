@@ -0,0 +1,160 @@
+from __future__ import annotations
+from collections import deque
+from logging import Logger, LoggerAdapter
+import threading
+import time
+
+from usbipice.utils.dev import get_busid
+
+# lower values are granted first
+PRIORITY_RESERVATION = 0
+PRIORITY_DEFAULT = 1
+PRIORITIES = (PRIORITY_RESERVATION, PRIORITY_DEFAULT)
+
+class FlashSchedulerLogger(LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[FlashScheduler] {msg}", kwargs
+
+def get_hub(dev_path: str) -> str:
+    """Returns the hub a device is plugged into from its DEVPATH, ex. 1-2.3 -> 1-2, 1-2 -> usb1.
+    Returns None if the DEVPATH is not a usb device."""
+    busid = get_busid(dev_path) if dev_path else None
+
+    if not busid:
+        return None
+
+    if "." in busid:
+        return busid.rsplit(".", 1)[0]
+
+    return f"usb{busid.split('-', 1)[0]}"
+
+class FlashTicket:
+    """A device's place in the flash queue. The callback is called once when the ticket is granted.
+    The ticket has to be released once flashing is done, or it keeps its slot."""
+    def __init__(self, scheduler: FlashScheduler, serial: str, hub: str, priority: int, callback):
+        self.scheduler = scheduler
+        self.serial = serial
+        self.hub = hub
+        self.priority = priority
+        self.callback = callback
+
+        self.queued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+
+    @property
+    def wait(self) -> float:
+        """Seconds spent waiting for a slot."""
+        return (self.granted_at if self.granted_at else time.monotonic()) - self.queued_at
+
+    def release(self):
+        """Frees the slot, or leaves the queue if the ticket was not granted yet. Safe to call more
+        than once."""
+        self.scheduler.release(self)
+
+class FlashScheduler:
+    """Limits how many devices are flashed at once, in total and per usb hub. Waiting devices are
+    granted in priority order, then in the order they were queued, skipping devices whose hub is
+    full. Grant callbacks are called outside of the scheduler lock, possibly on the thread that
+    released the previous slot, and should only hand off work."""
+    def __init__(self, logger: Logger, max_flashing: int=8, max_per_hub: int=4):
+        self.logger = FlashSchedulerLogger(logger)
+        self.max_flashing = max_flashing
+        self.max_per_hub = max_per_hub
+
+        self.lock = threading.Lock()
+        self.waiting: dict[int, deque[FlashTicket]] = {priority: deque() for priority in PRIORITIES}
+        self.flashing: set[FlashTicket] = set()
+        self.hubs: dict[str, int] = {}
+
+        self.granted = 0
+        # serial -> seconds waited before its last grant
+        self.last_wait: dict[str, float] = {}
+
+    def request(self, serial: str, callback, dev_path: str=None, priority: int=PRIORITY_DEFAULT) -> FlashTicket:
+        """Queues serial for flashing. callback() is called once a slot is available."""
+        if priority not in PRIORITIES:
+            raise Exception(f"Unknown flash priority {priority}")
+
+        ticket = FlashTicket(self, serial, get_hub(dev_path), priority, callback)
+
+        with self.lock:
+            self.waiting[priority].append(ticket)
+            granted = self.__grant()
+
+        self.__notify(granted)
+        return ticket
+
+    def release(self, ticket: FlashTicket):
+        with self.lock:
+            if ticket.released:
+                return
+
+            ticket.released = True
+
+            if ticket.granted_at is None:
+                self.waiting[ticket.priority].remove(ticket)
+                return
+
+            self.flashing.discard(ticket)
+
+            if ticket.hub:
+                self.hubs[ticket.hub] -= 1
+                if not self.hubs[ticket.hub]:
+                    del self.hubs[ticket.hub]
+
+            granted = self.__grant()
+
+        self.__notify(granted)
+
+    def __hubAvailable(self, hub: str) -> bool:
+        return not hub or not self.max_per_hub or self.hubs.get(hub, 0) < self.max_per_hub
+
+    def __grant(self) -> list[FlashTicket]:
+        granted = []
+
+        for priority in PRIORITIES:
+            queue = self.waiting[priority]
+
+            for ticket in list(queue):
+                if len(self.flashing) >= self.max_flashing:
+                    return granted
+
+                if not self.__hubAvailable(ticket.hub):
+                    continue
+
+                queue.remove(ticket)
+                ticket.granted_at = time.monotonic()
+
+                self.flashing.add(ticket)
+                if ticket.hub:
+                    self.hubs[ticket.hub] = self.hubs.get(ticket.hub, 0) + 1
+
+                self.granted += 1
+                self.last_wait[ticket.serial] = ticket.wait
+                granted.append(ticket)
+
+        return granted
+
+    def __notify(self, granted: list[FlashTicket]):
+        for ticket in granted:
+            self.logger.debug(f"{ticket.serial} granted flash slot after {ticket.wait:.2f}s")
+
+            try:
+                ticket.callback()
+            except Exception as e:
+                self.logger.error(f"exception in flash grant of {ticket.serial}: {e}")
+
+    def stats(self) -> dict:
+        """Returns devices flashing and waiting, with the seconds each has waited."""
+        with self.lock:
+            return {
+                "flashing": {ticket.serial: ticket.wait for ticket in self.flashing},
+                "waiting": {ticket.serial: ticket.wait for queue in self.waiting.values() for ticket in queue},
+                "hubs": dict(self.hubs),
+                "granted": self.granted,
+                "last_wait": dict(self.last_wait)
+            }
@@ -0,0 +1,236 @@
+from __future__ import annotations
+from concurrent.futures import Future
+from logging import Logger, LoggerAdapter
+import multiprocessing
+import itertools
+import threading
+import copy
+import logging
+import atexit
+import sys
+
+from usbipice.utils import KeyedExecutor, RemoteLogger
+from usbipice.worker import WorkerDatabase
+from usbipice.worker.device.DeviceManager import DeviceManager, shard_of
+
+import typing
+if typing.TYPE_CHECKING:
+    from usbipice.worker import Config, EventSender
+
+# methods of DeviceManager that can be called from the parent process
+SHARD_METHODS = ("reserve", "unreserve", "submitRequest", "stats")
+
+# seconds to wait for a shard to answer a call
+CALL_TIMEOUT = 10
+# seconds to wait for a shard to exit
+EXIT_TIMEOUT = 30
+
+class ShardedManagerLogger(LoggerAdapter):
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+
+    def process(self, msg, kwargs):
+        return f"[ShardedDeviceManager] {msg}", kwargs
+
+class ShardEventSender:
+    """Stands in for EventSender inside a shard. Device events are forwarded to the parent process,
+    which owns the client sockets."""
+    def __init__(self, conn, send_lock: threading.Lock):
+        self.conn = conn
+        self.send_lock = send_lock
+
+    def sendSerialJson(self, serial: str, contents: dict) -> bool:
+        try:
+            with self.send_lock:
+                self.conn.send(("event", serial, contents))
+        except (OSError, ValueError):
+            return False
+
+        return True
+
+def shard_main(shard: int, shards: int, config: Config, conn):
+    """Entry point of a shard process. Runs a DeviceManager for the serials of shard and answers calls
+    from the parent until told to exit or the pipe closes."""
+    logger = logging.getLogger(f"{__name__}.shard{shard}")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger = RemoteLogger(logger, config.control_server_url, f"{config.worker_name}-shard{shard}")
+
+    send_lock = threading.Lock()
+    manager = DeviceManager(ShardEventSender(conn, send_lock), config, logger, shard=shard, shards=shards)
+
+    while True:
+        try:
+            call_id, method, args = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if method == "exit":
+            break
+
+        result = None
+
+        if method in SHARD_METHODS:
+            try:
+                result = getattr(manager, method)(*args)
+            except Exception as e:
+                logger.error(f"[shard {shard}] exception in {method}: {e}")
+        else:
+            logger.error(f"[shard {shard}] unknown method {method}")
+
+        try:
+            with send_lock:
+                conn.send(("reply", call_id, result))
+        except (OSError, ValueError):
+            break
+
+    manager.onExit()
+
+class Shard:
+    """Parent side of a shard process."""
+    def __init__(self, index: int, shards: int, config: Config, event_sender: EventSender, events: KeyedExecutor,
+                 logger: Logger):
+        self.index = index
+        self.event_sender = event_sender
+        self.events = events
+        self.logger = logger
+
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=shard_main, args=(index, shards, config, child_conn),
+                                       name=f"device-shard-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending: dict[int, Future] = {}
+        self.alive = True
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.__read, name=f"device-shard-{index}-reader", daemon=True)
+        self.thread.start()
+
+    def call(self, method: str, *args, timeout: float=CALL_TIMEOUT):
+        """Calls method on the shard's DeviceManager and returns the result, or None if the shard
+        does not answer in time."""
+        future = Future()
+
+        with self.lock:
+            if not self.alive:
+                return None
+
+            call_id = next(self.ids)
+            self.pending[call_id] = future
+
+        try:
+            with self.send_lock:
+                self.conn.send((call_id, method, args))
+
+            return future.result(timeout=timeout)
+        except Exception:
+            self.logger.error(f"shard {self.index} did not answer {method}")
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(call_id, None)
+
+    def __read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == "event":
+                _, serial, contents = message
+                # keeps the order of each device's events without blocking replies on the database
+                self.events.submit(serial, self.event_sender.sendSerialJson, serial, contents)
+                continue
+
+            _, call_id, result = message
+
+            with self.lock:
+                future = self.pending.get(call_id)
+
+            if future:
+                future.set_result(result)
+
+        with self.lock:
+            self.alive = False
+            pending = list(self.pending.values())
+
+        for future in pending:
+            future.cancel()
+
+        if not self.stopping:
+            self.logger.error(f"shard {self.index} exited unexpectedly")
+
+    def exit(self):
+        self.stopping = True
+
+        try:
+            with self.send_lock:
+                self.conn.send((None, "exit", ()))
+        except (OSError, ValueError):
+            pass
+
+        self.process.join(EXIT_TIMEOUT)
+
+        if self.process.is_alive():
+            self.logger.error(f"shard {self.index} did not exit, terminating")
+            self.process.terminate()
+
+class ShardedDeviceManager:
+    """Runs device state machines in shard processes that each own a disjoint set of serials, so that
+    device I/O is not bound by the GIL of the web process. Exposes the parts of DeviceManager used by
+    the worker's routes, and forwards each call to the shard owning the serial over a pipe. Device
+    events from the shards are sent to clients through event_sender."""
+    def __init__(self, event_sender: EventSender, config: Config, logger: Logger, shards: int):
+        self.logger = ShardedManagerLogger(logger)
+        self.event_sender = event_sender
+        self.exiting = False
+
+        # registers the worker before the shards add their devices
+        self.database = WorkerDatabase(config, self.logger)
+        atexit.register(self.onExit)
+
+        self.events = KeyedExecutor(self.logger, workers=config.device_workers, name="shard-event-sender")
+
+        # flash limits are for the whole worker, each shard gets an equal share
+        shard_config = copy.copy(config)
+        shard_config.flash_concurrency = max(1, config.flash_concurrency // shards)
+        if config.flash_per_hub:
+            shard_config.flash_per_hub = max(1, config.flash_per_hub // shards)
+
+        self.shards = [Shard(i, shards, shard_config, event_sender, self.events, self.logger) for i in range(shards)]
+
+    def __shard(self, serial: str) -> Shard:
+        return self.shards[shard_of(serial, len(self.shards))]
+
+    def reserve(self, serial: str, kind: str, args: dict):
+        return self.__shard(serial).call("reserve", serial, kind, args) or False
+
+    def unreserve(self, serial: str):
+        return self.__shard(serial).call("unreserve", serial) or False
+
+    def submitRequest(self, serial: str, event: str, contents: dict) -> bool:
+        return bool(self.__shard(serial).call("submitRequest", serial, event, contents))
+
+    def stats(self) -> dict:
+        return {
+            "shards": [shard.call("stats") for shard in self.shards],
+            "events": self.events.stats()
+        }
+
+    def onExit(self):
+        if self.exiting:
+            return
+
+        self.exiting = True
+
+        for shard in self.shards:
+            shard.exit()
+
+        self.database.onExit()
@@ -1,3 +1,6 @@
 from usbipice.worker.device.DeviceEventSender import DeviceEventSender
+from usbipice.worker.device.FlashScheduler import FlashScheduler
+from usbipice.worker.device.DeviceRuntime import DeviceRuntime, get_device_runtime
 from usbipice.worker.device.Device import Device
 from usbipice.worker.device.DeviceManager import DeviceManager
+from usbipice.worker.device.ShardedDeviceManager import ShardedDeviceManager
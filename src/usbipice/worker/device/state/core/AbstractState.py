@@ -2,7 +2,7 @@ from __future__ import annotations
 import threading
 from logging import Logger, LoggerAdapter
 
-from usbipice.utils import typecheck
+from usbipice.utils import compile_typecheck
 from usbipice.utils.dev import *
 from usbipice.worker.device import Device
 
@@ -14,6 +14,7 @@ class EventMethod:
     def __init__(self, method, parms):
         self.method = method
         self.parms = parms
+        self.check = compile_typecheck(method)
 
     def __call__(self, device, data):
         args = list(map(data.get, self.parms))
@@ -21,7 +22,7 @@ class EventMethod:
         if None in args:
             return
 
-        if not typecheck(self.method, (device, *args)):
+        if not self.check((device, *args)):
             return
 
         return self.method(device, *args)
@@ -38,9 +39,8 @@ class AbstractState:
     methods = {}
 
     def __init__(self, device: Device):
-        """NOTE: switch CANNOT be called inside __init__(). This will result
-        in the lock for Device being a acquired a second time. If this behavior
-        is needed, use start() instead."""
+        """NOTE: switch should not be called inside __init__(), as the state is
+        not live yet. If this behavior is needed, use start() instead."""
         self.device: Device = device
 
         name = type(self).__name__
@@ -83,8 +83,9 @@ class AbstractState:
     def switch(self, state_factory):
         """Switches the Device's state to a new one. This happens by first calling
         exit on the existing state. After the existing state has exited, the
-        state factory is called and the result is set as the state. Subsequent calls
-        to switch from the original state object are ignored."""
+        state factory is called and the result is set as the state. The switch is
+        scheduled on the device's event queue and this returns immediately. Subsequent
+        calls to switch from the original state object are ignored."""
         with self.switching_lock:
             if self._switching:
                 return
@@ -101,9 +102,11 @@ class AbstractState:
         """Adds a method to the methods dictionary, which allows it to be called
         using the handleEvent function with event=event. These arguments specify which json
         key should be used to get the value of that positional argument when handleEvent is called.
-        The values passed in from the client are typechecked. Currently, only type and list[type]
-        are supported. Files should be sent as cp437 encoded bytes. If the file is needed later, it
-        should be saved under self.getDevice().getMediaPath(). Parameters without types are treated as Any.
+        The values passed in from the client are typechecked against a check compiled when the
+        method is registered. Classes, unions and nested list and dict generics are supported. Files
+        should be sent as bytes. They arrive as bytes from msgpack clients and as cp437 decoded strings
+        from json clients. If the file is needed later, it should be saved under
+        self.getDevice().getMediaPath(). Parameters without types are treated as Any.
 
         Ex.
         >>> class ExampleDevice:
@@ -0,0 +1,114 @@
+from __future__ import annotations
+import inspect
+import asyncio
+
+from usbipice.worker.device.state.core import AbstractState
+from usbipice.worker.device.DeviceRuntime import DeviceRuntime, get_device_runtime
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from usbipice.worker.device import Device
+
+# seconds handleExit waits for onExit before the next state is created
+EXIT_TIMEOUT = 10
+
+_STOP = object()
+
+class AsyncAbstractState(AbstractState):
+    """AbstractState whose hooks are coroutines run on the worker's shared DeviceRuntime loop, instead
+    of holding threads of their own. Subclasses override onStart, onAdd, onRemove and onExit. Methods
+    registered with AbstractState.register may be coroutines. Calls are queued and awaited one at a
+    time in the order they were received, so hooks of the same state never overlap. Blocking work
+    should be awaited with self.runtime.runBlocking, and delays with asyncio.sleep or self.later.
+
+    Ex.
+    >>> class ExampleState(AsyncAbstractState):
+            async def onAdd(self, dev):
+                await asyncio.sleep(1)
+                self.logger.info(dev.get("DEVNAME"))
+    """
+    def __init__(self, device: Device):
+        super().__init__(device)
+        self.runtime: DeviceRuntime = get_device_runtime()
+
+        # not bound to a loop until first awaited, only touched from the loop after this
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.timers: set[asyncio.TimerHandle] = set()
+        self.consumer = self.runtime.submit(self.__consume())
+
+    async def onStart(self):
+        """Called once the state is live."""
+
+    async def onAdd(self, dev: dict):
+        """Called on ADD device event."""
+
+    async def onRemove(self, dev: dict):
+        """Called on REMOVE device event."""
+
+    async def onExit(self):
+        """Cleanup. Pending timers are cancelled before this is called."""
+
+    def later(self, delay: float, fn):
+        """Queues the coroutine fn() after delay seconds. Must be called from a hook. Timers are
+        cancelled when the state exits."""
+        def fire():
+            self.timers.discard(handle)
+            self.queue.put_nowait(fn())
+
+        handle = self.runtime.loop.call_later(delay, fire)
+        self.timers.add(handle)
+        return handle
+
+    def __enqueue(self, item):
+        if self.runtime.inLoop():
+            self.queue.put_nowait(item)
+        else:
+            self.runtime.call(self.queue.put_nowait, item)
+
+    async def __consume(self):
+        while True:
+            item = await self.queue.get()
+
+            if item is _STOP:
+                return
+
+            try:
+                await item
+            except Exception as e:
+                self.logger.error(f"exception in async hook: {e}")
+
+    async def __exit(self):
+        for handle in self.timers:
+            handle.cancel()
+
+        self.timers.clear()
+        await self.onExit()
+
+    def start(self):
+        self.__enqueue(self.onStart())
+
+    def handleAdd(self, dev: dict):
+        self.__enqueue(self.onAdd(dev))
+
+    def handleRemove(self, dev: dict):
+        self.__enqueue(self.onRemove(dev))
+
+    def handleRequest(self, event, json):
+        result = super().handleRequest(event, json)
+
+        if inspect.iscoroutine(result):
+            self.__enqueue(result)
+
+    def handleExit(self):
+        """Queues onExit behind the calls already queued and waits for it, so that the next state
+        is only created once this one has cleaned up."""
+        self.__enqueue(self.__exit())
+        self.__enqueue(_STOP)
+
+        if self.runtime.inLoop():
+            return
+
+        try:
+            self.consumer.result(timeout=EXIT_TIMEOUT)
+        except Exception:
+            self.logger.warning("timed out waiting for async state to exit")
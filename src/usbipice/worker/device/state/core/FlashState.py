@@ -1,38 +1,60 @@
-import threading
-
 from usbipice.worker.device.state.core import AbstractState, BrokenState
+from usbipice.worker.device.FlashScheduler import PRIORITY_DEFAULT
+from usbipice.worker.device.DeviceStore import firmware_digest
+from usbipice.utils.TimerService import get_timer_service
 
-from usbipice.utils.dev import send_bootloader, upload_firmware_path, get_devs
+from usbipice.utils.dev import send_bootloader, upload_firmware_path
+from usbipice.utils.DeviceIndex import get_device_index
 
 class FlashState(AbstractState):
-    def __init__(self, state, firmware_path, next_state_factory, timeout=None):
+    """Flashes firmware_path once the worker's FlashScheduler grants a slot, then switches to
+    next_state_factory. Device events are ignored until then. The timeout starts once the slot
+    is granted, so time spent waiting in the queue does not count against it."""
+    def __init__(self, state, firmware_path, next_state_factory, timeout=None, priority=PRIORITY_DEFAULT):
         super().__init__(state)
         self.firmware_path = firmware_path
         self.next_state_factory = next_state_factory
+        self.timeout = timeout
+        self.priority = priority
         self.timer = None
 
-        if timeout:
-            def do_timeout():
-                self.logger.error("flashing timed out")
-                self.switch(lambda : BrokenState(self.device))
-
-            self.timer = threading.Timer(timeout, do_timeout)
-            self.timer.daemon = True
-            self.timer.name = f"{self.serial}-flash-timeout"
-            self.timer.start()
+        self.ticket = None
+        self.granted = False
 
     def start(self):
-        devs = get_devs().get(self.serial)
-        if not devs:
-            return
+        devs = get_device_index().get(self.serial)
+        dev_path = devs[0].get("DEVPATH") if devs else None
+
+        self.ticket = self.device.manager.flash_scheduler.request(self.serial, self.__onGrant, dev_path=dev_path,
+                                                                  priority=self.priority)
+
+    def __onGrant(self):
+        # may be called from another device's thread, so the flash is queued behind this device's events
+        self.device.manager.executor.submit(self.serial, self.device.handleStateCallback, self, self.__flash)
+
+    def __flash(self):
+        self.granted = True
+        # the firmware on the device is unknown until the upload finishes
+        self.device.store.update(firmware=None)
+        self.logger.debug(f"flash slot granted after {self.ticket.wait:.2f}s")
 
-        for file in devs:
+        if self.timeout:
+            self.timer = get_timer_service().schedule(self.timeout, self.__timeout, name=f"{self.serial}-flash-timeout")
+
+        for file in get_device_index().get(self.serial):
             if self.switching:
                 return
 
             self.handleAdd(file)
 
+    def __timeout(self):
+        self.logger.error("flashing timed out")
+        self.switch(lambda : BrokenState(self.device))
+
     def handleAdd(self, dev):
+        if not self.granted:
+            return
+
         devname = dev.get("DEVNAME")
 
         if not devname:
@@ -58,4 +80,12 @@ class FlashState(AbstractState):
 
             if self.timer:
                 self.timer.cancel()
+            self.device.store.update(firmware=firmware_digest(self.firmware_path))
             self.switch(self.next_state_factory)
+
+    def handleExit(self):
+        if self.timer:
+            self.timer.cancel()
+
+        if self.ticket:
+            self.ticket.release()
@@ -2,17 +2,23 @@ import threading
 
 from usbipice.worker.device.state.core import AbstractState, BrokenState, ReadyState
 from usbipice.utils import check_default
+from usbipice.utils.TimerService import get_timer_service
 
 class TestState(AbstractState):
-    def __init__(self, state):
+    """Checks that the device is running the default firmware and switches to ReadyState. A failed
+    or timed out check switches to fallback_factory, BrokenState by default. Devices are probed
+    on startup with a reflash as the fallback."""
+    def __init__(self, state, timeout=30, fallback_factory=None):
         super().__init__(state)
         self.lock = threading.Lock()
         self.exiting = False
+        self.fallback_factory = fallback_factory if fallback_factory else lambda : BrokenState(self.device)
 
         self.database.updateDeviceStatus(self.serial, "testing")
 
-        self.timer = threading.Timer(30, lambda : self.switch(lambda : BrokenState(self.device)))
-        self.timer.start()
+        self.timer = get_timer_service().schedule(
+            timeout, lambda : self.switch(self.fallback_factory), name=f"{self.serial}-test-timeout"
+        )
 
     def handleAdd(self, dev):
         path = dev.get("DEVNAME")
@@ -21,6 +27,10 @@ class TestState(AbstractState):
             self.logger.warning("add event with no devname")
             return
 
+        # the default firmware reports over serial, partitions and disks can't be checked
+        if dev.get("SUBSYSTEM") != "tty":
+            return
+
         with self.lock:
             if self.exiting:
                 return
@@ -30,3 +40,11 @@ class TestState(AbstractState):
             if check_default(path):
                 self.timer.cancel()
                 self.switch(lambda : ReadyState(self.device))
+                return
+
+            self.logger.warning("default firmware check failed")
+            self.timer.cancel()
+            self.switch(self.fallback_factory)
+
+    def handleExit(self):
+        self.timer.cancel()
@@ -1,4 +1,5 @@
 from usbipice.worker.device.state.core.AbstractState import AbstractState
+from usbipice.worker.device.state.core.AsyncAbstractState import AsyncAbstractState
 from usbipice.worker.device.state.core.BrokenState import BrokenState
 from usbipice.worker.device.state.core.FlashState import FlashState
 from usbipice.worker.device.state.core.ReadyState import ReadyState
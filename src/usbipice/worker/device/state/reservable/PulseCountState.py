@@ -6,11 +6,11 @@ from dataclasses import dataclass
 import time
 import os
 
-import serial
-
+from usbipice.utils.SerialMux import SerialProtocol, get_serial_mux
 from usbipice.worker.device.state.core import AbstractState, FlashState, BrokenState
 from usbipice.worker.device.state.reservable import reservable
-from usbipice.utils.dev import get_devs
+from usbipice.worker.device.FlashScheduler import PRIORITY_RESERVATION
+from usbipice.utils import get_device_index
 
 import typing
 if typing.TYPE_CHECKING:
@@ -19,8 +19,6 @@ if typing.TYPE_CHECKING:
 #from  https://github.com/evolvablehardware/BitstreamEvolutionPico/blob/main/exampleProjectsC/bitstream_over_usb/bitstream_transfer_test.py
 # TODO config file
 BAUD = 115200            # ignored by TinyUSB but needed by pyserial
-CHUNK_SIZE = 512         # bytes per write
-INTER_CHUNK_DELAY = 0.00001  # seconds
 BITSTREAM_SIZE = 0 #TODO
 
 @dataclass
@@ -32,7 +30,8 @@ class Bitstream:
 class PulseCountStateFlasher(AbstractState):
     def start(self):
         pulse_fac = lambda : PulseCountState(self.device)
-        self.switch(lambda : FlashState(self.device, self.config.pulse_firmware_path, pulse_fac))
+        self.switch(lambda : FlashState(self.device, self.config.pulse_firmware_path, pulse_fac,
+                                        priority=PRIORITY_RESERVATION))
 class PulseCountState(AbstractState):
     def __init__(self, state):
         super().__init__(state)
@@ -44,20 +43,15 @@ class PulseCountState(AbstractState):
 
         # ensure new ports show correctly
         time.sleep(2)
-        paths = get_devs().get(self.serial)
-
-        if not paths:
-            self.switch(lambda : BrokenState(self.device))
-
-        port = list(filter(lambda x : x.get("ID_USB_INTERFACE_NUM") == "00", paths))
+        port = get_device_index().getInterface(self.serial, "00")
 
         if not port:
             self.switch(lambda : BrokenState(self.device))
 
         port = port[0].get("DEVNAME")
 
-        self.ser = serial.Serial(port, BAUD, timeout=0.1)
-        self.reader = Reader(self.ser)
+        self.reader = Reader()
+        self.channel = get_serial_mux().open(port, BAUD, self.reader)
         self.sender = PulseCountEventSender(self.device_event_sender)
 
         self.exiting = False
@@ -67,13 +61,17 @@ class PulseCountState(AbstractState):
         self.device_event_sender.sendDeviceInitialized()
 
     @AbstractState.register("evaluate", "files")
-    def queue(self, files):
+    def queue(self, files: dict[str, bytes | str]):
         media_path = self.device.media_path
         paths = [str(media_path.joinpath(str(uuid.uuid4()))) for _ in range(len(files))]
 
         for path, data in zip(paths, files.values()):
+            # raw bytes from msgpack clients, cp437 text from json clients
+            if isinstance(data, str):
+                data = data.encode("cp437")
+
             with open(path, "wb") as f:
-                f.write(data.encode("cp437"))
+                f.write(data)
                 f.flush()
 
         self.logger.debug(f"queued bitstreams: {list(files.keys())}")
@@ -104,17 +102,15 @@ class PulseCountState(AbstractState):
             with open(bitstream.location, "rb") as f:
                 data = f.read()
 
-            data_len = len(data)
-
             self.reader.waitUntilReady()
 
+            if self.exiting:
+                return
+
             self.logger.debug(f"uploading bitstream {bitstream.name}")
 
-            for i in range(0, data_len, CHUNK_SIZE):
-                chunk = data[i:i+CHUNK_SIZE]
-                self.ser.write(chunk)
-                self.ser.flush()
-                time.sleep(INTER_CHUNK_DELAY)
+            self.channel.write(data)
+            self.channel.drain()
 
             self.logger.debug("waiting for pulse")
 
@@ -122,6 +118,10 @@ class PulseCountState(AbstractState):
 
             self.logger.debug(f"got pulse: {result}")
 
+            # the port closed while waiting
+            if result is None:
+                return
+
             if result is False:
                 with self.cv:
                     self.bitstream_queue.append(bitstream)
@@ -141,49 +141,57 @@ class PulseCountState(AbstractState):
         self.exiting = True
         with self.cv:
             self.cv.notify_all()
-        self.thread.join()
         self.reader.exit()
-        self.ser.close()
+        self.thread.join()
+        self.channel.close()
 
-class Reader:
-    def __init__(self, port: serial.Serial):
-        self.port = port
+class Reader(SerialProtocol):
+    """Parses the pulse count firmware's output. Data arrives from the worker's SerialMux, lines are
+    matched once they are complete."""
+    def __init__(self):
         self.cv = threading.Condition()
         self.ready = True
         self.last_pulse = None
         self.exiting = False
+        self.buffer = ""
 
-        self.thread = threading.Thread(target=self.read, daemon=True)
-        self.thread.start()
+    def dataReceived(self, data: bytes):
+        self.buffer += data.decode(errors="replace")
+        *lines, self.buffer = self.buffer.split("\n")
 
-    def read(self):
-        while self.port.is_open and not self.exiting:
-            data = self.port.read(self.port.in_waiting or 1)
-            if not data:
-                continue
-            data = str(data)
+        # output without newlines is matched as is instead of growing forever
+        if len(self.buffer) > 4096:
+            lines.append(self.buffer)
+            self.buffer = ""
 
-            pulses = re.search("pulses: ([0-9]+)", data)
-            if pulses:
-                with self.cv:
-                    self.last_pulse = pulses.group(1)
-                    self.cv.notify_all()
+        for line in lines:
+            self.handleLine(line)
 
-            timeout = re.search("Watchdog timeout", data)
-            if timeout:
-                with self.cv:
-                    self.last_pulse = False
-                    self.cv.notify_all()
+    def handleLine(self, line: str):
+        pulses = re.search("pulses: ([0-9]+)", line)
+        if pulses:
+            with self.cv:
+                self.last_pulse = pulses.group(1)
+                self.cv.notify_all()
 
-            wait = re.search("Waiting for bitstream transfer", data)
-            if wait:
-                with self.cv:
-                    self.ready = True
-                    self.cv.notify_all()
+        timeout = re.search("Watchdog timeout", line)
+        if timeout:
+            with self.cv:
+                self.last_pulse = False
+                self.cv.notify_all()
+
+        wait = re.search("Waiting for bitstream transfer", line)
+        if wait:
+            with self.cv:
+                self.ready = True
+                self.cv.notify_all()
+
+    def connectionLost(self):
+        self.exit()
 
     def waitUntilReady(self):
         with self.cv:
-            self.cv.wait_for(lambda : self.ready)
+            self.cv.wait_for(lambda : self.ready or self.exiting)
             self.ready = False
 
     def waitUntilPulse(self):
@@ -194,10 +202,9 @@ class Reader:
             return last_pulse
 
     def exit(self):
-        self.exiting = True
         with self.cv:
+            self.exiting = True
             self.cv.notify_all()
-        self.thread.join()
 
 class PulseCountEventSender:
     def __init__(self, event_sender):
@@ -1,16 +1,11 @@
 from __future__ import annotations
-import pyudev
-
-from usbipice.utils.dev import get_busid, get_devs
+from usbipice.utils import get_udev_bus, get_device_index
+from usbipice.utils.dev import get_busid
 from usbipice.utils.usbip import usbip_bind, usbip_unbind
 
 from usbipice.worker.device.state.core import AbstractState
 from usbipice.worker.device.state.reservable import reservable
 
-import typing
-if typing.TYPE_CHECKING:
-    from usbipice.worker.device import Device
-
 PORT = "3240"
 
 @reservable("usbip")
@@ -35,24 +30,14 @@ class UsbipState(AbstractState):
         self.busid = None
         self.notif = UsbipEventSender(self)
 
-        # TODO this disconnect detection has nowhere to go, ideally it's done by a single MO, but if it
-        # goes in DeviceManager it results in 6 different fn chains of DM -> Device -> ABS,
-        # which goes unused by probably every other reservable. if this causes performance issues,
-        # or another reservable needs this behavior , i think i'll make the MO a global?
-
-        context = pyudev.Context()
-        monitor = pyudev.Monitor.from_netlink(context, source="kernel")
-        monitor.filter_by("usb", device_type="usb_device")
-        self.observer = pyudev.MonitorObserver(monitor, lambda x, y : self.handleKernel(x, y), name=f"usbip-disconnect-detection-{self.getSerial()}")
-        self.observer.start()
+        # kernel remove events of the exported bus, registered on the shared bus once the busid is known
+        self.subscription = None
 
     def start(self):
-        devs = get_devs().get(self.getSerial())
-        if not devs:
-            return
+        devs = get_device_index().get(self.serial)
 
         for file in devs:
-            if self.isSwitching():
+            if self.switching:
                 return
 
             self.handleAdd(file)
@@ -65,24 +50,33 @@ class UsbipState(AbstractState):
         busid = get_busid(path)
 
         if not busid:
-            self.getLogger().warning(f"failed to get busid: {dev.get('DEVNAME')}")
+            self.logger.warning(f"failed to get busid: {dev.get('DEVNAME')}")
             return
 
-        self.busid = busid
+        if busid != self.busid:
+            self.__watchBus(busid)
 
         binded = usbip_bind(busid)
 
         if not binded:
-            self.getLogger().warning("failed to bind device")
+            self.logger.warning("failed to bind device")
             return
 
-        self.getLogger().debug(f"now exporting on bus {busid}")
+        self.logger.debug(f"now exporting on bus {busid}")
 
-        if not self.notif.export(busid, self.getConfig().getVirtualIp(), PORT):
-            self.getLogger().debug(f"failed to send export event (bus {busid})")
+        if not self.notif.export(busid, self.config.virtual_ip, PORT):
+            self.logger.debug(f"failed to send export event (bus {busid})")
+
+    def __watchBus(self, busid: str):
+        if self.subscription:
+            self.subscription.unsubscribe()
+
+        self.busid = busid
+        self.subscription = get_udev_bus().subscribe(self.handleKernel, busid=busid, subsystem="usb",
+                                                     action="remove", source="kernel")
 
     def handleKernel(self, event: str, dev: dict):
-        if event != "remove":
+        if event != "remove" or dev.get("DEVTYPE") != "usb_device":
             return
 
         path = dev.get("DEVPATH")
@@ -93,38 +87,39 @@ class UsbipState(AbstractState):
         busid = get_busid(path)
 
         if not busid:
-            self.getLogger().debug(f"failed to parse busid on kernel remove (devpath: {path})")
+            self.logger.debug(f"failed to parse busid on kernel remove (devpath: {path})")
             return
 
         if busid != self.busid:
             return
 
-        self.getLogger().warning(f"disconnected from usbip (bus: {busid})")
+        self.logger.warning(f"disconnected from usbip (bus: {busid})")
         self.notif.disconnect()
 
     @AbstractState.register("unbind")
     def unbind(self):
         if not self.busid:
-            self.getLogger().warning("unbind request but no busid")
+            self.logger.warning("unbind request but no busid")
             return
 
         if not usbip_unbind(self.busid):
-            self.getLogger().warning(f"failed to unbind on request - bus {self.busid}")
+            self.logger.warning(f"failed to unbind on request - bus {self.busid}")
             return False
 
         return True
 
     def handleExit(self):
         super().handleExit()
-        if not usbip_unbind(self.busid):
-            self.getLogger().error(f"failed to unbind on exit - bus {self.busid}")
+        if self.subscription:
+            self.subscription.unsubscribe()
 
-        self.observer.stop()
+        if not usbip_unbind(self.busid):
+            self.logger.error(f"failed to unbind on exit - bus {self.busid}")
 
 class UsbipEventSender:
-    def __init__(self, device: Device):
-        self.notif = device.getEventSender()
-        self.serial = device.getSerial()
+    def __init__(self, state: UsbipState):
+        self.notif = state.device_event_sender
+        self.serial = state.serial
 
     def export(self, busid: str, ip: str, usbip_port: int):
         """Event signifies that a bus is now available through usbip
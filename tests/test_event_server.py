@@ -0,0 +1,61 @@
+"""
+Checks that acknowledged event frames are handled in sequence order when the socketio client
+handles them on separate threads.
+"""
+import logging
+import threading
+import time
+
+from usbipice.client.lib.EventServer import FrameSequencer
+
+logger = logging.getLogger(__name__)
+
+def wait_pending(sequencer: FrameSequencer, seq: int):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with sequencer.cond:
+            if seq in sequencer.pending:
+                return
+        time.sleep(0.001)
+
+    raise TimeoutError(f"frame {seq} was not buffered")
+
+def test_frames_in_reverse_order():
+    sequencer = FrameSequencer(logger)
+    handled = []
+    acks = {}
+
+    def deliver(seq, msgs):
+        acks[seq] = sequencer.handle("session", seq, msgs, handled.append)
+
+    later = threading.Thread(target=deliver, args=(2, ["c", "d"]))
+    later.start()
+    wait_pending(sequencer, 2)
+
+    # the later frame waits for the first one instead of being handled or acknowledged
+    assert handled == []
+
+    deliver(0, ["a", "b"])
+    later.join(5)
+
+    assert handled == ["a", "b", "c", "d"]
+    assert acks[0] == 3
+    assert acks[2] == 3
+    assert sequencer.resume() == {"session": "session", "seq": 3}
+
+def test_handled_frames_skipped():
+    sequencer = FrameSequencer(logger)
+    handled = []
+
+    assert sequencer.handle("session", 0, ["a", "b"], handled.append) == 1
+    # sent again after a reconnect, overlapping the events already handled
+    assert sequencer.handle("session", 1, ["b", "c"], handled.append) == 2
+
+    assert handled == ["a", "b", "c"]
+
+def test_missing_frames_skipped():
+    sequencer = FrameSequencer(logger, gap_timeout=0.05)
+    handled = []
+
+    assert sequencer.handle("session", 5, ["f"], handled.append) == 5
+    assert handled == ["f"]
@@ -0,0 +1,234 @@
+"""
+Checks the mount free firmware writer against FAT12 and FAT16 loopback images
+laid out like the drive of the pico bootloader.
+"""
+import os
+import struct
+
+import pytest
+
+from usbipice.utils.dev import FIRMWARE_NAME, upload_firmware_path
+from usbipice.utils.fat import FatError, FatVolume, write_bootloader_file
+
+SECTOR = 512
+ROOT_ENTRIES = 512
+
+BOOTLOADER_CONTENTS = {
+    "INDEX.HTM": b"<html><head><meta http-equiv='refresh' content='0;URL=https://raspberrypi.com/device/RP2?version=0'/></head></html>\n",
+    "INFO_UF2.TXT": b"UF2 Bootloader v1.0\nModel: Raspberry Pi RP2350\nBoard-ID: RP2350\n"
+}
+
+# fat bits to (total sectors, sectors per cluster)
+LAYOUTS = {
+    12: (4096, 4),
+    16: (65536, 4)
+}
+
+def dir_entry(name: bytes, attr: int, cluster: int, size: int) -> bytes:
+    return struct.pack("<11sBBBHHHHHHHI", name, attr, 0, 0, 0, 0x21, 0x21, 0, 0, 0x21, cluster, size)
+
+def set_fat_entry(fat: bytearray, bits: int, cluster: int, value: int):
+    if bits == 16:
+        struct.pack_into("<H", fat, cluster * 2, value)
+        return
+
+    offset = cluster * 3 // 2
+    current, = struct.unpack_from("<H", fat, offset)
+    if cluster & 1:
+        current = (current & 0x000F) | (value << 4)
+    else:
+        current = (current & 0xF000) | value
+    struct.pack_into("<H", fat, offset, current)
+
+def get_fat_entry(fat: bytes, bits: int, cluster: int) -> int:
+    if bits == 16:
+        return struct.unpack_from("<H", fat, cluster * 2)[0]
+
+    value, = struct.unpack_from("<H", fat, cluster * 3 // 2)
+    return value >> 4 if cluster & 1 else value & 0xFFF
+
+def format_image(path, bits: int, files: dict[str, bytes]):
+    """Formats path like the bootloader drive, with a volume label and files in the root directory."""
+    total, cluster_sectors = LAYOUTS[bits]
+    fat_sectors = ((total // cluster_sectors + 2) * bits // 8 + SECTOR) // SECTOR
+    root_sectors = ROOT_ENTRIES * 32 // SECTOR
+    data_start = 1 + 2 * fat_sectors + root_sectors
+
+    boot = bytearray(SECTOR)
+    boot[0:3] = b"\xeb\x3c\x90"
+    boot[3:11] = b"UF2 UF2 "
+    struct.pack_into("<HBHBHHBHHHII", boot, 11, SECTOR, cluster_sectors, 1, 2, ROOT_ENTRIES,
+                     total if total < 0x10000 else 0, 0xF8, fat_sectors, 1, 1, 0, total if total >= 0x10000 else 0)
+    boot[510:512] = b"\x55\xaa"
+
+    fat = bytearray(fat_sectors * SECTOR)
+    set_fat_entry(fat, bits, 0, 0xFF8 if bits == 12 else 0xFFF8)
+    set_fat_entry(fat, bits, 1, 0xFFF if bits == 12 else 0xFFFF)
+
+    root = bytearray(root_sectors * SECTOR)
+    root[0:32] = dir_entry(b"RP2350     ", 0x08, 0, 0)
+
+    cluster_size = cluster_sectors * SECTOR
+    data = {}
+    cluster = 2
+
+    for i, (name, contents) in enumerate(files.items(), start=1):
+        base, _, ext = name.partition(".")
+        count = max(1, -(-len(contents) // cluster_size))
+        chain = list(range(cluster, cluster + count))
+
+        for current, following in zip(chain, chain[1:] + [0xFFF if bits == 12 else 0xFFFF]):
+            set_fat_entry(fat, bits, current, following)
+
+        root[i * 32:(i + 1) * 32] = dir_entry((base.ljust(8) + ext.ljust(3)).encode(), 0x20, cluster, len(contents))
+        data[cluster] = contents
+        cluster += count
+
+    with open(path, "wb") as f:
+        f.truncate(total * SECTOR)
+        f.write(boot)
+        f.seek(SECTOR)
+        f.write(fat)
+        f.write(fat)
+        f.write(root)
+
+        for start, contents in data.items():
+            f.seek((data_start + (start - 2) * cluster_sectors) * SECTOR)
+            f.write(contents)
+
+def read_file(path, name: str) -> bytes:
+    """Reads a file from the root directory of an image by following its cluster chain."""
+    with open(path, "rb") as f:
+        image = f.read()
+
+    sector, cluster_sectors, reserved, fats, root_entries, total16, _, fat_sectors = \
+        struct.unpack_from("<HBHBHHBH", image, 11)
+    total = total16 or struct.unpack_from("<I", image, 32)[0]
+    root_offset = (reserved + fats * fat_sectors) * sector
+    data_offset = root_offset + root_entries * 32
+    bits = 12 if (total - data_offset // sector) // cluster_sectors < 4085 else 16
+    fat = image[reserved * sector:(reserved + fat_sectors) * sector]
+    cluster_size = sector * cluster_sectors
+
+    for offset in range(root_offset, data_offset, 32):
+        entry = image[offset:offset + 32]
+        if entry[0] == 0:
+            break
+
+        if entry[0] == 0xE5:
+            continue
+
+        base, ext = entry[0:8].decode().rstrip(), entry[8:11].decode().rstrip()
+        if f"{base}.{ext}" != name:
+            continue
+
+        cluster, = struct.unpack_from("<H", entry, 26)
+        size, = struct.unpack_from("<I", entry, 28)
+        contents = b""
+
+        while cluster < (0xFF8 if bits == 12 else 0xFFF8):
+            start = data_offset + (cluster - 2) * cluster_size
+            contents += image[start:start + cluster_size]
+            cluster = get_fat_entry(fat, bits, cluster)
+
+        return contents[:size]
+
+    raise FileNotFoundError(name)
+
+@pytest.fixture
+def firmware(tmp_path):
+    path = tmp_path / "firmware.uf2"
+    path.write_bytes(os.urandom(SECTOR * 300))
+    return path
+
+@pytest.mark.parametrize("bits", [12, 16])
+def test_upload_reads_back(tmp_path, firmware, bits):
+    image = tmp_path / f"fat{bits}.img"
+    format_image(image, bits, BOOTLOADER_CONTENTS)
+
+    assert upload_firmware_path(str(image), str(tmp_path / "mount"), str(firmware))
+
+    assert read_file(image, FIRMWARE_NAME) == firmware.read_bytes()
+    for name, contents in BOOTLOADER_CONTENTS.items():
+        assert read_file(image, name) == contents
+
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        volume = FatVolume(fd)
+        assert volume.bits == bits
+        assert volume.listRoot() == sorted([FIRMWARE_NAME, *BOOTLOADER_CONTENTS])
+        # every copy of the FAT is updated
+        assert os.pread(fd, volume.fat_bytes, volume.fat_offset) == \
+               os.pread(fd, volume.fat_bytes, volume.fat_offset + volume.fat_bytes)
+    finally:
+        os.close(fd)
+
+@pytest.mark.parametrize("bits", [12, 16])
+def test_second_write_refused(tmp_path, firmware, bits):
+    image = tmp_path / f"fat{bits}.img"
+    format_image(image, bits, BOOTLOADER_CONTENTS)
+
+    assert write_bootloader_file(str(image), FIRMWARE_NAME, firmware.read_bytes())
+    assert not write_bootloader_file(str(image), FIRMWARE_NAME, firmware.read_bytes())
+
+@pytest.mark.parametrize("bits", [12, 16])
+def test_other_drive_refused(tmp_path, firmware, bits):
+    image = tmp_path / f"fat{bits}.img"
+    format_image(image, bits, {"README.TXT": b"not a bootloader"})
+
+    assert not write_bootloader_file(str(image), FIRMWARE_NAME, firmware.read_bytes())
+
+def test_fragmented_free_space(tmp_path, firmware):
+    image = tmp_path / "fat16.img"
+    files = {f"F{i}.BIN": os.urandom(3000 + i * 777) for i in range(10)}
+    format_image(image, 16, files)
+
+    # free every other file to leave holes between the remaining ones
+    fd = os.open(image, os.O_RDWR)
+    try:
+        volume = FatVolume(fd)
+        for i in range(0, 10, 2):
+            offset = volume.root_offset + (i + 1) * 32
+            cluster, = struct.unpack_from("<H", os.pread(fd, 32, offset), 26)
+            fat = bytearray(os.pread(fd, volume.fat_bytes, volume.fat_offset))
+            while cluster < 0xFFF8:
+                following = get_fat_entry(fat, 16, cluster)
+                set_fat_entry(fat, 16, cluster, 0)
+                cluster = following
+            for copy in range(volume.fats):
+                os.pwrite(fd, fat, volume.fat_offset + copy * volume.fat_bytes)
+            os.pwrite(fd, b"\xe5", offset)
+
+        volume = FatVolume(fd)
+        data = firmware.read_bytes()
+        volume.writeFile(FIRMWARE_NAME, data)
+    finally:
+        os.close(fd)
+
+    assert read_file(image, FIRMWARE_NAME) == data
+    for i in range(1, 10, 2):
+        assert read_file(image, f"F{i}.BIN") == files[f"F{i}.BIN"]
+
+def test_not_enough_space(tmp_path):
+    image = tmp_path / "fat12.img"
+    format_image(image, 12, BOOTLOADER_CONTENTS)
+
+    fd = os.open(image, os.O_RDWR)
+    try:
+        with pytest.raises(FatError):
+            FatVolume(fd).writeFile(FIRMWARE_NAME, bytes(LAYOUTS[12][0] * SECTOR))
+    finally:
+        os.close(fd)
+
+def test_not_fat(tmp_path, firmware):
+    image = tmp_path / "zero.img"
+    image.write_bytes(bytes(1024 * 1024))
+
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        with pytest.raises(FatError):
+            FatVolume(fd)
+    finally:
+        os.close(fd)
+
+    assert not write_bootloader_file(str(image), FIRMWARE_NAME, firmware.read_bytes())